@@ -0,0 +1,579 @@
+"""
+ASGI mode of the email ingest service.
+
+/handle_pubsub validates the push envelope, queues the notification in
+process and returns 204 straight away, so a slow Gmail response never holds
+a Pub/Sub push open. A bounded pool of async workers drains the queue using
+async Gmail HTTP calls and psycopg's AsyncConnection; on shutdown the queue
+is drained before the process exits.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from ingest_core import (
+    DEAD_LETTER_ENABLED,
+    GMAIL_BATCH_RETRY_DELAY,
+    GMAIL_BATCH_SIZE,
+    GMAIL_FALLBACK_QUERY,
+    GMAIL_RETRY_STATUSES,
+    GMAIL_WATCH_LABEL,
+    HISTORY_PAGE_SIZE,
+    _CURSOR_SELECT_SQL,
+    _FAILURE_RECORD_SQL,
+    _failure_params,
+    _label_ids,
+    _write_batch_params,
+    _write_batch_sql,
+    cache_label_id,
+    is_transient,
+    match_label_id,
+)
+from main import (
+    DB_POOL_MAX_IDLE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_PREPARE_THRESHOLD,
+    OVERLOAD_RETRY_AFTER,
+    SUPABASE_DB_URL,
+    UnknownUserError,
+    _gmail_clients,
+    _log_dead_letter,
+    _mailbox_cursors,
+    _pack_emails,
+    _parse_raw_message,
+    _user_ids,
+    invalidate_user_id,
+    verify_google_jwt,
+)
+
+logger = logging.getLogger(__name__)
+
+# Worker pool and queue sizing. Pushes beyond ASYNC_QUEUE_SIZE mailboxes get
+# a 503 so Pub/Sub redelivers them later. Cloud Run allows 10s between
+# SIGTERM and SIGKILL, so the drain has to finish inside that.
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 8))
+ASYNC_QUEUE_SIZE = int(os.environ.get('ASYNC_QUEUE_SIZE', 1000))
+ASYNC_DRAIN_TIMEOUT = float(os.environ.get('ASYNC_DRAIN_TIMEOUT', 8))
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users'
+GMAIL_HTTP_TIMEOUT = 30
+
+class GmailHTTPError(Exception):
+    """A Gmail REST call that returned an error status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Gmail API returned {status}: {message}")
+        self.status = status
+
+class AsyncGmail:
+    """Minimal async Gmail REST client using the cached per-mailbox credentials."""
+
+    def __init__(self, client: httpx.AsyncClient):
+        self._client = client
+
+    async def get(self, user_email: str, path: str, **params) -> Dict[str, Any]:
+        # Token refreshes block, so they happen off the event loop
+        credentials = await asyncio.to_thread(_gmail_clients.credentials, user_email)
+        response = await self._client.get(
+            f"{GMAIL_API_URL}/{quote(user_email)}/{path}",
+            params={key: value for key, value in params.items() if value is not None},
+            headers={'Authorization': f"Bearer {credentials.token}"}
+        )
+        if response.status_code >= 400:
+            raise GmailHTTPError(response.status_code, response.text[:200])
+        return response.json()
+
+class AsyncHistoryReader:
+    """
+    Async counterpart of ingest_core.HistoryReader.
+
+    Yields the ids of messages added since start_history_id, one history page
+    at a time, falling back to the watched label's recent messages if the
+    history ID has expired (404). Both filter by the watched label's id,
+    resolved through the label cache in ingest_core.
+    """
+
+    def __init__(self, gmail: AsyncGmail, user_email: str, start_history_id: str):
+        self.gmail = gmail
+        self.user_email = user_email
+        self.start_history_id = str(start_history_id)
+        # Newest mailbox history ID reported by Gmail while reading
+        self.history_id: Optional[str] = None
+        self.fell_back = False
+        self._seen = set()
+        self._label_id: Optional[str] = None
+
+    async def _resolve_label_id(self) -> Optional[str]:
+        cached = _label_ids.get(self.user_email)
+        if cached is not None:
+            return cached or None
+        response = await self.gmail.get(self.user_email, 'labels', fields='labels(id,name)')
+        label_id = match_label_id(response.get('labels', []), GMAIL_WATCH_LABEL)
+        cache_label_id(self.user_email, label_id)
+        return label_id
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        self._label_id = await self._resolve_label_id()
+        if self._label_id is None:
+            return
+        page_token = None
+        while True:
+            try:
+                response = await self.gmail.get(
+                    self.user_email, 'history',
+                    startHistoryId=self.start_history_id,
+                    labelId=self._label_id,
+                    historyTypes='messageAdded',
+                    maxResults=HISTORY_PAGE_SIZE,
+                    pageToken=page_token
+                )
+            except GmailHTTPError as e:
+                if e.status == 400:
+                    # The label may have been deleted and recreated under a new id
+                    _label_ids.pop(self.user_email)
+                if e.status != 404:
+                    raise
+                logger.warning(
+                    f"History ID {self.start_history_id} not found, "
+                    f"reading recent messages instead"
+                )
+                self.fell_back = True
+                async for message_id in self._recent_message_ids():
+                    yield message_id
+                return
+
+            self.history_id = response.get('historyId', self.history_id)
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    if self._unseen(added['message']['id']):
+                        yield added['message']['id']
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    async def _recent_message_ids(self) -> AsyncIterator[str]:
+        page_token = None
+        while True:
+            response = await self.gmail.get(
+                self.user_email, 'messages',
+                labelIds=self._label_id,
+                q=GMAIL_FALLBACK_QUERY,
+                maxResults=HISTORY_PAGE_SIZE,
+                pageToken=page_token
+            )
+            for message in response.get('messages', []):
+                if self._unseen(message['id']):
+                    yield message['id']
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _unseen(self, message_id: str) -> bool:
+        # A message can show up in several history records
+        if message_id in self._seen:
+            return False
+        self._seen.add(message_id)
+        return True
+
+async def _achunked(items: AsyncIterator[Any], size: int) -> AsyncIterator[List[Any]]:
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def _achunked_last(items: AsyncIterator[Any], size: int) -> AsyncIterator[Tuple[List[Any], bool]]:
+    """Async counterpart of ingest_core._chunked_last."""
+    chunk, started = [], False
+    async for following in _achunked(items, size):
+        if started:
+            yield chunk, False
+        chunk, started = following, True
+    yield chunk, True
+
+async def fetch_email_contents_async(gmail: AsyncGmail, user_email: str,
+                                     message_ids: List[str]) -> List[Dict[str, Any]]:
+    """
+    Fetch messages concurrently, keeping the order of message_ids.
+
+    Rate-limited or 5xx fetches are retried once; messages deleted since the
+    notification (404) are skipped.
+    """
+    async def fetch(message_id: str) -> Optional[Dict[str, Any]]:
+        for attempt in range(2):
+            try:
+                response = await gmail.get(user_email, f"messages/{message_id}", format='raw')
+                return _parse_raw_message(response, message_id)
+            except GmailHTTPError as e:
+                if e.status == 404:
+                    logger.warning(f"Message {message_id} no longer exists, skipping")
+                    return None
+                if e.status in GMAIL_RETRY_STATUSES and attempt == 0:
+                    await asyncio.sleep(GMAIL_BATCH_RETRY_DELAY)
+                    continue
+                logger.error(f"Failed to fetch message {message_id}: {e}")
+                raise
+
+    results = await asyncio.gather(*(fetch(message_id) for message_id in message_ids))
+    return [email_data for email_data in results if email_data is not None]
+
+_async_db_pool: Optional[AsyncConnectionPool] = None
+_async_db_pool_lock = asyncio.Lock()
+
+async def get_async_db_pool() -> AsyncConnectionPool:
+    """Return the process-wide async Postgres pool, opening it on first use."""
+    global _async_db_pool
+    if _async_db_pool is not None:
+        return _async_db_pool
+    # Concurrent first requests wait for one pool instead of each opening one
+    async with _async_db_pool_lock:
+        if _async_db_pool is None:
+            pool = AsyncConnectionPool(
+                SUPABASE_DB_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_idle=DB_POOL_MAX_IDLE,
+                timeout=DB_POOL_TIMEOUT,
+                check=AsyncConnectionPool.check_connection,
+                kwargs={
+                    'prepare_threshold': int(DB_PREPARE_THRESHOLD) if DB_PREPARE_THRESHOLD else None
+                },
+                name='inbound-emails-async',
+                open=False
+            )
+            await pool.open()
+            _async_db_pool = pool
+    return _async_db_pool
+
+def _write_params(user_email: str, user_id: Optional[str], rows: List[tuple],
+                  blobs: Dict[str, bytes], cursor: Optional[int]) -> List[Any]:
+    """Parameters for ingest_core._write_batch_sql with every row and the cursor from one mailbox."""
+    return _write_batch_params(
+        [(user_email, user_id, ord_) + row for ord_, row in enumerate(rows)], blobs,
+        cursors=[(user_email, user_id, cursor)] if cursor is not None else []
+    )
+
+async def store_emails_async(user_email: str, emails: List[Dict[str, Any]], history_id: str,
+                             cursor: Optional[int] = None) -> bool:
+    """Async counterpart of main.store_emails_in_database."""
+    if not emails and cursor is None:
+        return True
+    try:
+        # Compression is CPU-bound; keep it off the event loop
+        packed_rows, blobs = await asyncio.to_thread(_pack_emails, emails, history_id)
+        sql = _write_batch_sql()
+
+        pool = await get_async_db_pool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                user_id = _user_ids.get(user_email)
+                try:
+                    await cur.execute(sql, _write_params(user_email, user_id, packed_rows, blobs, cursor))
+                except psycopg.errors.ForeignKeyViolation:
+                    # Cached user was deleted; fall back to resolving it again
+                    await conn.rollback()
+                    invalidate_user_id(user_email)
+                    await cur.execute(sql, _write_params(user_email, None, packed_rows, blobs, cursor))
+                result_rows = await cur.fetchall()
+                user_id = result_rows[0][1] if result_rows else None
+                if user_id is None:
+                    raise UnknownUserError(f"User not found for email: {user_email}")
+                _user_ids.set(user_email, str(user_id))
+
+                await conn.commit()
+                for ord_, _, _, _, stored_cursor in result_rows:
+                    if ord_ is None and stored_cursor is not None:
+                        _mailbox_cursors.remember(user_email, int(stored_cursor))
+                inserted = sum(1 for _, _, was_inserted, _, _ in result_rows if was_inserted)
+                logger.info(
+                    f"Stored {inserted} new of {len(emails)} emails for user {user_email}, "
+                    f"history_id: {history_id}"
+                )
+                return True
+
+    except UnknownUserError:
+        raise
+    except Exception as e:
+        # Let the worker dead-letter an overloaded or unreachable database
+        # as transient rather than as a failed store
+        if is_transient(e):
+            raise
+        logger.error(f"Database error: {e}")
+        return False
+
+async def get_mailbox_cursor_async(email_address: str, min_history_id: Optional[int] = None) -> Optional[int]:
+    """Async counterpart of main.get_mailbox_cursor."""
+    cached = _mailbox_cursors.cached(email_address)
+    if cached is not None and min_history_id is not None and cached >= min_history_id:
+        return cached
+
+    pool = await get_async_db_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(_CURSOR_SELECT_SQL, (email_address,))
+        row = await cur.fetchone()
+    if row is None:
+        return cached
+    return _mailbox_cursors.remember(email_address, int(row[0]))
+
+def _is_transient(error: BaseException) -> bool:
+    """ingest_core.is_transient, plus the errors of the async Gmail client."""
+    if isinstance(error, GmailHTTPError):
+        return error.status in GMAIL_RETRY_STATUSES
+    if isinstance(error, httpx.TransportError):
+        return True
+    return is_transient(error)
+
+async def record_ingest_failure_async(email_address: str, history_id: int, error: BaseException) -> bool:
+    """Async counterpart of main.record_ingest_failure."""
+    if not DEAD_LETTER_ENABLED:
+        return False
+    error_class = 'transient' if _is_transient(error) else 'permanent'
+    try:
+        pool = await get_async_db_pool()
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                _FAILURE_RECORD_SQL, _failure_params(email_address, history_id, error, error_class)
+            )
+            attempts = (await cur.fetchone())[0]
+    except Exception as e:
+        logger.error(f"Failed to record ingest failure for {email_address}: {e}")
+        return False
+    _log_dead_letter(email_address, history_id, error, error_class, attempts)
+    return True
+
+class AsyncKeyedLocks:
+    """An asyncio lock per key, created on demand and dropped when nobody holds it."""
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+_mailbox_locks = AsyncKeyedLocks()
+
+async def process_notification(gmail: AsyncGmail, email_address: str, history_id: int) -> int:
+    """
+    Store every message added to a mailbox since its cursor.
+
+    Returns the number of messages fetched; raises if Gmail or the database
+    fails or no user has the address, leaving the cursor where it was so the
+    next push retries the gap.
+    """
+    async with _mailbox_locks.hold(email_address):
+        # Skip pushes already covered by an earlier scan before any Gmail call
+        cursor = await get_mailbox_cursor_async(email_address, history_id)
+        if cursor is not None and history_id <= cursor:
+            logger.info(f"History {history_id} already processed for {email_address} (cursor {cursor})")
+            return 0
+
+        start_history_id = str(cursor) if cursor is not None else str(history_id)
+        reader = AsyncHistoryReader(gmail, email_address, start_history_id)
+        processed = 0
+        async for chunk, last in _achunked_last(reader, GMAIL_BATCH_SIZE):
+            emails = await fetch_email_contents_async(gmail, email_address, chunk) if chunk else []
+            # The reader is exhausted once the last chunk comes, so the cursor
+            # moves to the newest history Gmail reported along with its emails
+            advance_to = max(int(reader.history_id or 0), history_id) if last else None
+            if not await store_emails_async(email_address, emails, str(history_id), advance_to):
+                raise RuntimeError(f"Failed to store emails for {email_address}")
+            processed += len(emails)
+
+        logger.info(f"Processed {processed} emails for {email_address}")
+        return processed
+
+class IngestQueue:
+    """
+    Bounded in-process queue of mailboxes to scan, drained by async workers.
+
+    Notifications for a mailbox that is already queued are folded into the
+    queued entry (keeping the highest history ID), so a burst of pushes for
+    one mailbox costs one scan.
+    """
+
+    def __init__(self, gmail: AsyncGmail, workers: int = ASYNC_WORKERS,
+                 maxsize: int = ASYNC_QUEUE_SIZE):
+        self._gmail = gmail
+        self._workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._pending: Dict[str, int] = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._closed = False
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+
+    def submit(self, email_address: str, history_id: int) -> bool:
+        """Queue a notification; False if the queue is full or shutting down."""
+        if self._closed:
+            return False
+        if email_address in self._pending:
+            self._pending[email_address] = max(self._pending[email_address], history_id)
+            return True
+        try:
+            self._queue.put_nowait(email_address)
+        except asyncio.QueueFull:
+            return False
+        self._pending[email_address] = history_id
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {'queued': self._queue.qsize(), 'workers': len(self._tasks)}
+
+    async def drain(self, timeout: float = ASYNC_DRAIN_TIMEOUT) -> None:
+        """Stop taking work, finish what is queued (up to timeout) and stop the workers."""
+        self._closed = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._queue.qsize()} notifications still queued at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self) -> None:
+        while True:
+            email_address = await self._queue.get()
+            history_id = self._pending.pop(email_address)
+            try:
+                await process_notification(self._gmail, email_address, history_id)
+            except UnknownUserError as e:
+                # Nothing to retry until the user signs up
+                logger.warning(str(e))
+            except Exception as e:
+                # The push was acknowledged on arrival; without a dead-letter
+                # row this notification is lost until the next one
+                if not await record_ingest_failure_async(email_address, history_id, e):
+                    logger.error(f"Failed to process history {history_id} for {email_address}: {e}")
+            finally:
+                self._queue.task_done()
+
+_ingest_queue: Optional[IngestQueue] = None
+
+async def handle_pubsub(request: Request) -> Response:
+    """Validate a Gmail Pub/Sub push, queue it and acknowledge immediately."""
+    try:
+        try:
+            envelope = await request.json()
+        except ValueError:
+            envelope = None
+
+        if not envelope:
+            logger.error("No JSON body received")
+            return JSONResponse({'error': 'No JSON body'}, status_code=400)
+
+        if 'message' not in envelope:
+            logger.error("No message in envelope")
+            return JSONResponse({'error': 'No message in envelope'}, status_code=400)
+
+        pubsub_message = envelope['message']
+
+        if 'attributes' in pubsub_message and 'jwt' in pubsub_message['attributes']:
+            jwt_token = pubsub_message['attributes']['jwt']
+            # A JWKS refresh is a blocking fetch
+            if not await asyncio.to_thread(verify_google_jwt, jwt_token):
+                logger.error("JWT verification failed")
+                return JSONResponse({'error': 'Invalid JWT'}, status_code=400)
+
+        if 'data' not in pubsub_message:
+            logger.error("No data in pubsub message")
+            return JSONResponse({'error': 'No data in message'}, status_code=400)
+
+        try:
+            message_data = json.loads(base64.b64decode(pubsub_message['data']).decode('utf-8'))
+        except ValueError:
+            logger.error("Undecodable data in pubsub message")
+            return JSONResponse({'error': 'Invalid message data'}, status_code=400)
+        history_id = message_data.get('historyId')
+        email_address = message_data.get('emailAddress')
+
+        if not history_id or not email_address:
+            logger.error(f"Missing required fields: historyId={history_id}, emailAddress={email_address}")
+            return JSONResponse({'error': 'Missing required fields'}, status_code=400)
+
+        # Redelivering a malformed push can't help, so reject it as a 400
+        try:
+            history_id = int(history_id)
+        except (TypeError, ValueError):
+            logger.error(f"Invalid historyId: {history_id}")
+            return JSONResponse({'error': 'Invalid historyId'}, status_code=400)
+
+        if _ingest_queue is None or not _ingest_queue.submit(email_address, history_id):
+            logger.warning("Ingest queue full, asking for redelivery")
+            return JSONResponse(
+                {'error': 'Ingest queue full'}, status_code=503,
+                headers={'Retry-After': str(OVERLOAD_RETRY_AFTER)}
+            )
+
+        return Response(status_code=204)
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+async def health_check(request: Request) -> Response:
+    """Health check endpoint."""
+    body: Dict[str, Any] = {'status': 'healthy'}
+    if _ingest_queue is not None:
+        body['queue'] = _ingest_queue.stats()
+    if _async_db_pool is not None:
+        body['db_pool'] = _async_db_pool.get_stats()
+    return JSONResponse(body)
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    global _ingest_queue, _async_db_pool
+    await get_async_db_pool()
+    async with httpx.AsyncClient(timeout=GMAIL_HTTP_TIMEOUT) as client:
+        _ingest_queue = IngestQueue(AsyncGmail(client))
+        _ingest_queue.start()
+        try:
+            yield
+        finally:
+            # Flush work already acknowledged to Pub/Sub before exiting
+            await _ingest_queue.drain()
+            _ingest_queue = None
+            await _async_db_pool.close()
+            _async_db_pool = None
+
+app = Starlette(
+    routes=[
+        Route('/handle_pubsub', handle_pubsub, methods=['POST']),
+        Route('/health', health_check, methods=['GET']),
+    ],
+    lifespan=lifespan
+)
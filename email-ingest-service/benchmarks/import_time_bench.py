@@ -0,0 +1,126 @@
+"""
+Benchmark cold-start import time of the ingest entry points.
+
+Imports each entry point in a fresh interpreter under ``python -X importtime``
+and reports the median time spent importing ``main`` itself. The server
+module (flask for the service, functions_framework for the Cloud Function)
+is imported first, since it is already loaded when the server imports main.
+
+Exits non-zero if the median exceeds the budget, or if importing main pulls
+in any of the modules it is meant to defer until first use.
+
+Usage:
+    python benchmarks/import_time_bench.py [--target service function] [--repeat 7]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import List, NamedTuple, Tuple
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(SERVICE_DIR)
+
+class Target(NamedTuple):
+    cwd: str
+    server_module: str
+    budget_ms: float
+
+TARGETS = {
+    'service': Target(SERVICE_DIR, 'flask', 25.0),
+    'function': Target(REPO_ROOT, 'functions_framework', 25.0),
+}
+
+# Modules main must not import at load time
+DEFERRED = (
+    'google.auth.transport.requests',
+    'google.oauth2.service_account',
+    'googleapiclient',
+    'jwt',
+    'psycopg',
+    'psycopg_pool',
+    'zstandard',
+)
+
+# Placeholders so the Cloud Function sees a complete configuration
+ENV = {
+    'SUPABASE_DB_URL': 'postgresql://localhost/ingest',
+    'SUPABASE_SERVICE_ROLE_KEY': 'service-role-key',
+    'GOOGLE_CLIENT_EMAIL': 'ingest@example.iam.gserviceaccount.com',
+    'GOOGLE_PRIVATE_KEY': 'private-key',
+    'GOOGLE_PROJECT_ID': 'example-project',
+}
+
+def import_main(target: Target) -> Tuple[int, List[Tuple[str, int]]]:
+    """
+    Import main in a fresh interpreter.
+
+    Returns main's cumulative import time in microseconds and the
+    (module, self time) pairs of everything main imported.
+    """
+    env = {'PATH': os.environ.get('PATH', ''), **ENV}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target.server_module}; import main'],
+        cwd=target.cwd, env=env, capture_output=True, text=True, check=True
+    )
+    section: List[Tuple[str, int]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name == ' ' + target.server_module:
+            # Everything after the server module was imported by main
+            section = []
+        elif name == ' main':
+            return int(cumulative_us), section
+        else:
+            section.append((name.strip(), int(self_us)))
+    raise RuntimeError(f"main was not imported:\n{result.stderr[-2000:]}")
+
+def deferred_imports(modules: List[Tuple[str, int]]) -> List[str]:
+    """The entries of DEFERRED that main imported, or any of their submodules."""
+    return [
+        deferred for deferred in DEFERRED
+        if any(name == deferred or name.startswith(deferred + '.') for name, _ in modules)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--target', nargs='+', choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float,
+                        help='override the per-target budget for main\'s import time')
+    parser.add_argument('--top', type=int, default=5,
+                        help='slowest modules imported by main to list')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'target':<9} {'median ms':>10} {'min ms':>8} {'budget ms':>10}")
+    for name in args.target:
+        target = TARGETS[name]
+        budget = args.budget_ms if args.budget_ms is not None else target.budget_ms
+        # The first run writes bytecode caches; don't count it
+        import_main(target)
+        runs = [import_main(target) for _ in range(args.repeat)]
+        timings = [cumulative / 1000 for cumulative, _ in runs]
+        median = statistics.median(timings)
+        print(f"{name:<9} {median:>10.1f} {min(timings):>8.1f} {budget:>10.1f}")
+
+        modules = runs[-1][1]
+        for module, self_us in sorted(modules, key=lambda item: -item[1])[:args.top]:
+            print(f"{'':<9} {self_us / 1000:>10.1f}  {module}")
+
+        leaked = deferred_imports(modules)
+        if leaked:
+            print(f"FAIL {name}: main imports deferred modules: {', '.join(leaked)}")
+            failed = True
+        if median > budget:
+            print(f"FAIL {name}: import takes {median:.1f} ms, budget is {budget:.1f} ms")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+"""
+Benchmark handle_pubsub end to end against a fake Gmail API and local Postgres.
+
+A fake Gmail HTTP server (labels.list, history.list, messages.get and the
+batch endpoint, with configurable message sizes and latency) runs in its own
+process. The Gmail client is built from a copy of the bundled discovery
+document that points at it. Each scenario then runs in a fresh process that
+imports main, sends Pub/Sub pushes through the Flask app from a pool of
+worker threads and writes to a real Postgres, so peak RSS is that of the
+ingest side alone.
+
+Reports requests/sec, p50/p95/p99 handler latency, peak RSS and how many
+emails were inserted or found to be duplicates for each scenario:
+
+    small-steady  small messages at a fixed arrival rate (open loop)
+    small-burst   small messages, every push queued at once
+    large         10 MB attachments, every push queued at once
+    duplicates    small messages where 90% of each history delta was
+                  already stored by an earlier push
+
+The database needs the tables from README_EmailIngest.md; they are created
+if missing, and inbound_emails, email_blobs and mailbox_cursors are TRUNCATED
+before each scenario, so never point this at a real database.
+
+Usage:
+    python benchmarks/ingest_bench.py --db-url postgresql://localhost/ingest_bench \\
+        [--scenarios small-burst large] [--scale 0.2] [--gmail-latency-ms 20]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+WATCH_LABEL = 'school-events'
+
+class Scenario(NamedTuple):
+    pushes: int                  # Pub/Sub pushes sent
+    mailboxes: int               # distinct users the pushes are spread over
+    concurrency: int             # worker threads calling handle_pubsub
+    rate: Optional[float]        # pushes/sec for open-loop arrival; None = burst
+    attachment_bytes: int        # attachment size of every message
+    messages_per_push: int       # messages in each history record
+    new_per_push: int            # of which never seen by an earlier record
+
+SCENARIOS = {
+    'small-steady': Scenario(400, 50, 16, 25.0, 2 * 1024, 3, 3),
+    'small-burst': Scenario(400, 50, 16, None, 2 * 1024, 3, 3),
+    'large': Scenario(16, 8, 4, None, 10 * 1024 * 1024, 1, 1),
+    'duplicates': Scenario(400, 50, 16, None, 2 * 1024, 10, 1),
+}
+
+SCHEMA_SQL = """
+CREATE SCHEMA IF NOT EXISTS auth;
+CREATE TABLE IF NOT EXISTS auth.users (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    email TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS inbound_emails (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID REFERENCES auth.users(id),
+    raw_body BYTEA NOT NULL,
+    raw_parts JSONB NOT NULL DEFAULT '[]',
+    headers JSONB,
+    gmail_history TEXT,
+    gmail_message_id TEXT,
+    arrived_at TIMESTAMPTZ DEFAULT now(),
+    UNIQUE (user_id, gmail_message_id)
+);
+CREATE TABLE IF NOT EXISTS email_blobs (
+    hash TEXT PRIMARY KEY,
+    content BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS mailbox_cursors (
+    email_address TEXT PRIMARY KEY,
+    history_id BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+def mailbox(index: int) -> str:
+    return f'bench{index}@example.com'
+
+# --- Fake Gmail -------------------------------------------------------------
+
+class FakeGmail:
+    """
+    In-memory Gmail state shared by the request handler threads.
+
+    History record r of a mailbox adds messages_per_push messages whose ids
+    start at r * new_per_push, so consecutive records overlap when
+    new_per_push is smaller. A message's raw body is a unique header block
+    followed by one of a few pre-encoded bodies; the header block is padded
+    to a multiple of 3 bytes so the two base64 encodings simply concatenate.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest: Dict[str, int] = {}
+        self.config: Dict[str, Any] = {}
+        self.bodies: List[Tuple[str, bytes]] = []
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        bodies = []
+        for i in range(config['distinct_bodies']):
+            message = MIMEMultipart()
+            message.attach(MIMEText('Please see the attached newsletter.\n' * 20))
+            rng = random.Random(i)
+            attachment = rng.randbytes(config['attachment_bytes'])
+            message.attach(MIMEApplication(attachment, Name=f'newsletter{i}.pdf'))
+            # Keep the body; the headers, boundary included, go in raw_message()
+            body = message.as_bytes().partition(b'\n\n')[2]
+            content_type = message['Content-Type']
+            body = body + b'\n' * (-len(body) % 3)
+            bodies.append((content_type, base64.urlsafe_b64encode(body)))
+        with self.lock:
+            self.latest.clear()
+            self.config = config
+            self.bodies = bodies
+
+    def publish(self, email_address: str, history_id: int) -> None:
+        with self.lock:
+            self.latest[email_address] = max(self.latest.get(email_address, 0), history_id)
+
+    def history(self, email_address: str, start_history_id: int) -> Dict[str, Any]:
+        per_push = self.config['messages_per_push']
+        stride = self.config['new_per_push']
+        local = email_address.split('@')[0]
+        latest = self.latest.get(email_address, start_history_id)
+        records = []
+        for record in range(start_history_id + 1, latest + 1):
+            first = record * stride
+            records.append({'id': str(record), 'messagesAdded': [
+                {'message': {'id': f'{local}-{n}', 'labelIds': [WATCH_LABEL]}}
+                for n in range(first, first + per_push)
+            ]})
+        return {'history': records, 'historyId': str(max(latest, start_history_id))}
+
+    def raw_message(self, email_address: str, message_id: str) -> bytes:
+        content_type, body = self.bodies[zlib.crc32(message_id.encode()) % len(self.bodies)]
+        header = (
+            f'From: School Office <office@school.example.com>\r\n'
+            f'To: {email_address}\r\n'
+            f'Subject: Newsletter {message_id}\r\n'
+            f'Message-ID: <{message_id}@school.example.com>\r\n'
+            f'MIME-Version: 1.0\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'X-Pad: '
+        ).encode()
+        header += b' ' * (-(len(header) + 2) % 3) + b'\r\n'
+        encoded = base64.urlsafe_b64encode(header) + body
+        return b'{"id": "' + message_id.encode() + b'", "raw": "' + encoded + b'"}'
+
+_PATH = re.compile(r'^/gmail/v1/users/([^/]+)/(history|labels|messages/([^/?]+))$')
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    gmail: FakeGmail
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json; charset=UTF-8') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _latency(self) -> None:
+        latency = self.gmail.config.get('latency_ms', 0)
+        if latency:
+            time.sleep(latency / 1000)
+
+    def _api_response(self, target: str) -> Tuple[int, bytes]:
+        parsed = urlparse(target)
+        match = _PATH.match(parsed.path)
+        if not match:
+            return 404, b'{"error": {"code": 404, "message": "Not found"}}'
+        email_address = unquote(match.group(1))
+        if match.group(2) == 'history':
+            start = int(parse_qs(parsed.query)['startHistoryId'][0])
+            return 200, json.dumps(self.gmail.history(email_address, start)).encode()
+        if match.group(2) == 'labels':
+            return 200, b'{"labels": [{"id": "Label_1", "name": "school-events"}]}'
+        return 200, self.gmail.raw_message(email_address, unquote(match.group(3)))
+
+    def do_GET(self):
+        self._latency()
+        self._send(*self._api_response(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/_config':
+            self.gmail.configure(json.loads(body))
+            return self._send(204, b'')
+        if self.path == '/_publish':
+            push = json.loads(body)
+            self.gmail.publish(push['emailAddress'], push['historyId'])
+            return self._send(204, b'')
+        if self.path in ('/batch', '/batch/gmail/v1'):
+            self._latency()
+            return self._batch(body)
+        self._send(404, b'')
+
+    def _batch(self, body: bytes) -> None:
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers['Content-Type']).group(1).encode()
+        parts = []
+        for part in body.split(b'--' + boundary)[1:]:
+            if part.startswith(b'--'):
+                break
+            headers, _, inner = part.partition(b'\r\n\r\n') if b'\r\n\r\n' in part else part.partition(b'\n\n')
+            content_id = re.search(rb'Content-ID:\s*<([^>]*)>', headers, re.I).group(1)
+            content_id = re.sub(rb'\s+', b' ', content_id)
+            request_line = inner.lstrip().split(b'\n', 1)[0].decode()
+            status, payload = self._api_response(request_line.split(' ')[1])
+            parts.append(
+                b'--batch_bench\r\nContent-Type: application/http\r\n'
+                b'Content-ID: <response-' + content_id + b'>\r\n\r\n'
+                + f'HTTP/1.1 {status} OK\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                  f'Content-Length: {len(payload)}\r\n\r\n'.encode()
+                + payload + b'\r\n'
+            )
+        self._send(200, b''.join(parts) + b'--batch_bench--\r\n', 'multipart/mixed; boundary=batch_bench')
+
+def serve_gmail(port: int) -> None:
+    FakeGmailHandler.gmail = FakeGmail()
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeGmailHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+def discovery_document(gmail_url: str) -> Dict[str, Any]:
+    """The bundled Gmail discovery document, pointed at the fake server."""
+    from googleapiclient.discovery_cache import get_static_doc
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    document['rootUrl'] = gmail_url + '/'
+    document['mtlsRootUrl'] = gmail_url + '/'
+    document['baseUrl'] = gmail_url + '/gmail/v1/'
+    return document
+
+# --- Scenario process -------------------------------------------------------
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_scenario(name: str, scenario: Scenario, gmail_port: int) -> Dict[str, Any]:
+    """Send the scenario's pushes through the Flask app; runs in its own process."""
+    import main
+    from google.oauth2.credentials import Credentials
+
+    # Token refresh is the one call the fake server can't answer
+    credentials = Credentials('bench-token')
+    main._gmail_clients.credentials = lambda subject=None: credentials
+
+    pushes = Queue()
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    results_lock = threading.Lock()
+
+    def worker():
+        control = http.client.HTTPConnection('127.0.0.1', gmail_port)
+        client = main.app.test_client()
+        while True:
+            push = pushes.get()
+            if push is None:
+                return
+            email_address, history_id = push
+            control.request('POST', '/_publish', json.dumps(
+                {'emailAddress': email_address, 'historyId': history_id}))
+            control.getresponse().read()
+            data = base64.b64encode(json.dumps(
+                {'emailAddress': email_address, 'historyId': history_id}).encode()).decode()
+            started = time.perf_counter()
+            response = client.post('/handle_pubsub', json={'message': {'data': data}})
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(scenario.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    schedule = [(mailbox(i % scenario.mailboxes), i // scenario.mailboxes + 1) for i in range(scenario.pushes)]
+    started = time.perf_counter()
+    for i, push in enumerate(schedule):
+        if scenario.rate:
+            delay = started + i / scenario.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        pushes.put(push)
+    for _ in threads:
+        pushes.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    with main.get_db_pool().connection() as conn:
+        stored = conn.execute('SELECT count(*) FROM inbound_emails').fetchone()[0]
+    counts = {
+        line.split('"')[1]: int(float(line.rsplit(' ', 1)[1]))
+        for line in main._emails_total.render() if not line.startswith('#')
+    }
+    return {
+        'scenario': name,
+        'pushes': scenario.pushes,
+        'seconds': elapsed,
+        'rps': scenario.pushes / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'statuses': statuses,
+        'inserted': counts.get('inserted', 0),
+        'duplicates': counts.get('duplicate', 0),
+        'stored_rows': stored,
+    }
+
+# --- Orchestration ----------------------------------------------------------
+
+def scaled(scenario: Scenario, scale: float) -> Scenario:
+    pushes = max(scenario.concurrency, int(scenario.pushes * scale))
+    return scenario._replace(pushes=pushes, mailboxes=min(scenario.mailboxes, pushes))
+
+def prepare_database(db_url: str, mailboxes: int) -> None:
+    import psycopg
+    with psycopg.connect(db_url, autocommit=True) as conn:
+        conn.execute(SCHEMA_SQL)
+        conn.execute('TRUNCATE inbound_emails, email_blobs, mailbox_cursors')
+        conn.execute(
+            'INSERT INTO auth.users (email) SELECT unnest(%s::text[]) ON CONFLICT (email) DO NOTHING',
+            ([mailbox(i) for i in range(mailboxes)],)
+        )
+        # As if watch() had just been called: the first push scans from history 0
+        conn.execute(
+            'INSERT INTO mailbox_cursors (email_address, history_id) SELECT unnest(%s::text[]), 0',
+            ([mailbox(i) for i in range(mailboxes)],)
+        )
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--db-url', default=os.environ.get('BENCH_DB_URL'),
+                        help='scratch Postgres database (default: $BENCH_DB_URL)')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of pushes of every scenario')
+    parser.add_argument('--gmail-latency-ms', type=float, default=20,
+                        help='added to every fake Gmail request, batch requests included')
+    parser.add_argument('--distinct-bodies', type=int, default=8,
+                        help='distinct attachments; messages sharing one share a blob row')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per scenario')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--gmail-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        scenario = scaled(SCENARIOS[args.run], args.scale)
+        print(json.dumps(run_scenario(args.run, scenario, args.gmail_port)))
+        return
+    if not args.db_url:
+        parser.error('--db-url or BENCH_DB_URL is required')
+
+    port = free_port()
+    gmail = multiprocessing.Process(target=serve_gmail, args=(port,), daemon=True)
+    gmail.start()
+    wait_for_port(port)
+    gmail_url = f'http://127.0.0.1:{port}'
+
+    results = []
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as discovery:
+        json.dump(discovery_document(gmail_url), discovery)
+        discovery.flush()
+        env = {
+            **os.environ,
+            'SUPABASE_DB_URL': args.db_url,
+            'GMAIL_DISCOVERY_DOC': discovery.name,
+            'GMAIL_WATCH_LABEL': WATCH_LABEL,
+            'GOOGLE_PROJECT_ID': 'bench-project',
+            'GOOGLE_CLIENT_EMAIL': 'bench@example.com',
+            'GOOGLE_PRIVATE_KEY': 'unused',
+        }
+        env.setdefault('DB_POOL_MAX_SIZE', '20')
+        control = http.client.HTTPConnection('127.0.0.1', port)
+
+        for name in args.scenarios:
+            scenario = scaled(SCENARIOS[name], args.scale)
+            prepare_database(args.db_url, scenario.mailboxes)
+            control.request('POST', '/_config', json.dumps({
+                'attachment_bytes': scenario.attachment_bytes,
+                'messages_per_push': scenario.messages_per_push,
+                'new_per_push': scenario.new_per_push,
+                'distinct_bodies': args.distinct_bodies,
+                'latency_ms': args.gmail_latency_ms,
+            }))
+            control.getresponse().read()
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', name, '--scale', str(args.scale),
+                 '--gmail-port', str(port)],
+                cwd=SERVICE_DIR, env=env, capture_output=True, text=True
+            )
+            if output.returncode != 0:
+                print(output.stderr[-3000:], file=sys.stderr)
+                sys.exit(f"Scenario {name} failed")
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+            if args.json:
+                print(json.dumps(results[-1]))
+
+    gmail.terminate()
+    if args.json:
+        return
+
+    print(f"{'scenario':<13} {'pushes':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'RSS MiB':>8} {'inserted':>9} {'dups':>6}  statuses")
+    for r in results:
+        statuses = ' '.join(f'{code}:{count}' for code, count in sorted(r['statuses'].items()))
+        print(f"{r['scenario']:<13} {r['pushes']:>6} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['peak_rss_mib']:>8.1f} "
+              f"{r['inserted']:>9} {r['duplicates']:>6}  {statuses}")
+
+if __name__ == '__main__':
+    main()
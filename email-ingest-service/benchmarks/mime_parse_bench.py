@@ -0,0 +1,79 @@
+"""
+Benchmark header extraction from format='raw' Gmail messages.
+
+Compares the previous full MIME parse (build the complete message tree)
+with the header-only, bytes-native parse used by the ingest service, on
+synthetic multipart emails carrying large attachments. Both decode the
+base64 payload once, as the packer needs the whole message anyway.
+
+Usage:
+    python benchmarks/mime_parse_bench.py [--sizes 1 10 25] [--repeat 5]
+"""
+
+import argparse
+import base64
+import email
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import parse_headers
+
+def build_fixture(attachment_mb: int) -> str:
+    """Build a base64url-encoded multipart email with an attachment of the given size."""
+    message = MIMEMultipart()
+    message['From'] = 'School Office <office@school.example.com>'
+    message['To'] = 'parent@example.com'
+    message['Subject'] = f'Newsletter with {attachment_mb} MB attachment'
+    for hop in range(20):
+        message['Received'] = f'from relay{hop}.example.com by mx.example.com; Mon, 1 Sep 2025 08:00:{hop:02d} +0000'
+    message.attach(MIMEText('Please see the attached newsletter.\n' * 50))
+    message.attach(MIMEApplication(os.urandom(attachment_mb * 1024 * 1024), Name='newsletter.pdf'))
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('ascii')
+
+def full_parse(raw_b64: str) -> dict:
+    """Previous implementation: decode everything, parse everything."""
+    raw_bytes = base64.urlsafe_b64decode(raw_b64)
+    return {key.lower(): value for key, value in email.message_from_bytes(raw_bytes).items()}
+
+def header_only(raw_b64: str) -> dict:
+    raw_bytes = base64.urlsafe_b64decode(raw_b64)
+    return {key.lower(): value for key, value in parse_headers(raw_bytes).items()}
+
+def measure(func, raw_b64: str, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(raw_b64)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(raw_b64)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 25],
+                        help='attachment sizes in MB')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'parser':<12} {'median ms':>10} {'peak MiB':>9}")
+    for size in args.sizes:
+        raw_b64 = build_fixture(size)
+        assert full_parse(raw_b64) == header_only(raw_b64)
+        for name, func in (('full', full_parse), ('header-only', header_only)):
+            median, peak = measure(func, raw_b64, args.repeat)
+            print(f"{size:>4}MB {name:<12} {median * 1000:>10.2f} {peak / 2**20:>9.2f}")
+
+if __name__ == '__main__':
+    main()
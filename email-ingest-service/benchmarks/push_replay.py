@@ -0,0 +1,281 @@
+"""
+Replay recorded Pub/Sub push traffic against a running ingest endpoint.
+
+Set PUSH_RECORD_FILE on the service or the Cloud Function to capture pushes.
+Each push is appended to a JSON-lines log as {"t": arrival time,
+"e": envelope, "a": Authorization header}. Logs may be gzipped.
+
+Pushes are sent open loop: each is scheduled up front and sent at its
+scheduled time whether or not earlier pushes have returned, the way Pub/Sub
+delivers them. Arrival times are either the recorded ones scaled by --speed,
+or Poisson arrivals at --rate pushes/sec cycling through the log. Each step
+reports:
+
+    offered/achieved  scheduled and successfully handled pushes/sec
+    errors            share of non-2xx responses and transport failures
+    queue             how late pushes were sent relative to their schedule,
+                      because --max-in-flight requests were outstanding
+    latency           response time once sent
+
+With --ramp the load is multiplied step by step (e.g. 1 2 5 10), and the
+saturation throughput is the achieved rate of the highest step that stays
+within --max-error-rate and --max-queue-delay-ms.
+
+Recorded JWTs will have expired by the time they are replayed:
+
+    keep     send them unchanged
+    strip    drop attributes.jwt and the Authorization header; use this for
+             the Flask service, which skips verification when the attribute
+             is absent
+    refresh  re-sign them with fresh iat/exp claims (HS256 with
+             --jwt-secret); use this for the Cloud Function, which checks
+             the claims but not the signature
+
+Pushes whose history ID is at or below a mailbox's stored cursor are acked
+without calling Gmail, so reset mailbox_cursors before each replay to measure
+the full ingest path.
+
+Usage:
+    python benchmarks/push_replay.py pushes.jsonl.gz --url http://localhost:8080/handle_pubsub \\
+        [--speed 10 | --rate 50] [--ramp 1 2 5 10] [--step-seconds 30] [--jwt strip]
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import json
+import random
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+JWT_LIFETIME = 3600
+
+class Push(NamedTuple):
+    t: float                          # recorded arrival time
+    envelope: Dict[str, Any]
+    authorization: Optional[str]
+
+class Result(NamedTuple):
+    queue_delay: float                # seconds sent after the scheduled time
+    latency: float                    # seconds from send to response
+    status: str                       # HTTP status code, or the exception name
+
+def load_log(path: str) -> List[Push]:
+    """Read a recorded push log, ordered by arrival time."""
+    opener = gzip.open if path.endswith('.gz') else open
+    pushes = []
+    with opener(path, 'rt') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if isinstance(entry.get('e'), dict):
+                pushes.append(Push(entry['t'], entry['e'], entry.get('a')))
+    pushes.sort(key=lambda push: push.t)
+    return pushes
+
+def arrivals(pushes: List[Push], speed: float, rate: Optional[float],
+             duration: Optional[float], rng: random.Random) -> Iterator[Tuple[float, Push]]:
+    """
+    Yield (offset in seconds, push) pairs for one run.
+
+    Without a rate the recorded inter-arrival times are divided by speed. With
+    a duration the log is looped (or cut short) to fill it; without one it is
+    played once.
+    """
+    if rate is not None:
+        offset = 0.0
+        index = 0
+        while duration is not None or index < len(pushes):
+            offset += rng.expovariate(rate)
+            if duration is not None and offset >= duration:
+                return
+            yield offset, pushes[index % len(pushes)]
+            index += 1
+        return
+
+    start = pushes[0].t
+    # Leave a mean gap between the end of one pass and the start of the next
+    span = pushes[-1].t - start
+    span += span / max(len(pushes) - 1, 1)
+    loop = 0
+    while True:
+        for push in pushes:
+            offset = (loop * span + push.t - start) / speed
+            if duration is not None and offset >= duration:
+                return
+            yield offset, push
+        loop += 1
+        if duration is None or span <= 0:
+            return
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def refresh_jwt(token: str, secret: bytes, now: float) -> str:
+    """Re-sign a JWT with HS256 and iat/exp moved to now; other claims are kept."""
+    payload_segment = token.split('.')[1]
+    payload = json.loads(base64.urlsafe_b64decode(payload_segment + '=' * (-len(payload_segment) % 4)))
+    payload['iat'] = int(now)
+    payload['exp'] = int(now) + JWT_LIFETIME
+    signing_input = (
+        _b64url(json.dumps({'alg': 'HS256', 'typ': 'JWT'}, separators=(',', ':')).encode()) + '.' +
+        _b64url(json.dumps(payload, separators=(',', ':')).encode())
+    )
+    signature = hmac.new(secret, signing_input.encode('ascii'), hashlib.sha256).digest()
+    return signing_input + '.' + _b64url(signature)
+
+def prepare(push: Push, jwt_mode: str, secret: bytes) -> Tuple[bytes, Dict[str, str]]:
+    """The request body and headers to replay a push with."""
+    envelope = push.envelope
+    headers = {'Content-Type': 'application/json'}
+    authorization = push.authorization
+    if jwt_mode != 'keep':
+        message = dict(envelope.get('message') or {})
+        attributes = dict(message.get('attributes') or {})
+        if jwt_mode == 'strip':
+            attributes.pop('jwt', None)
+            authorization = None
+        else:
+            now = time.time()
+            if 'jwt' in attributes:
+                attributes['jwt'] = refresh_jwt(attributes['jwt'], secret, now)
+            if authorization and authorization.startswith('Bearer '):
+                authorization = 'Bearer ' + refresh_jwt(authorization[7:], secret, now)
+        message['attributes'] = attributes
+        envelope = {**envelope, 'message': message}
+    if authorization:
+        headers['Authorization'] = authorization
+    return json.dumps(envelope, separators=(',', ':')).encode(), headers
+
+async def send(client: httpx.AsyncClient, url: str, body: bytes, headers: Dict[str, str],
+               scheduled: float, in_flight: asyncio.Semaphore) -> Result:
+    async with in_flight:
+        sent = time.perf_counter()
+        try:
+            response = await client.post(url, content=body, headers=headers)
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        return Result(sent - scheduled, time.perf_counter() - sent, status)
+
+async def run_step(pushes: List[Push], args: argparse.Namespace, multiplier: float,
+                   duration: Optional[float], rng: random.Random) -> Tuple[List[Result], float, float]:
+    """Replay one load step. Returns the results, the step length and the elapsed time."""
+    speed = args.speed * multiplier
+    rate = args.rate * multiplier if args.rate is not None else None
+    schedule = list(arrivals(pushes, speed, rate, duration, rng))
+    secret = args.jwt_secret.encode()
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        tasks = []
+        for offset, push in schedule:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            body, headers = prepare(push, args.jwt, secret)
+            tasks.append(asyncio.create_task(
+                send(client, args.url, body, headers, start + offset, in_flight)
+            ))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    length = duration if duration is not None else (schedule[-1][0] if schedule else 0.0)
+    return results, length, elapsed
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(results: List[Result], length: float, elapsed: float) -> Dict[str, Any]:
+    statuses = Counter(result.status for result in results)
+    errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+    queue = sorted(result.queue_delay for result in results)
+    latency = sorted(result.latency for result in results)
+    return {
+        'pushes': len(results),
+        'offered_rps': len(results) / length if length > 0 else 0.0,
+        'achieved_rps': (len(results) - errors) / elapsed if elapsed > 0 else 0.0,
+        'error_rate': errors / len(results) if results else 0.0,
+        'statuses': dict(statuses),
+        'queue_p50_ms': percentile(queue, 0.50) * 1000,
+        'queue_p95_ms': percentile(queue, 0.95) * 1000,
+        'queue_p99_ms': percentile(queue, 0.99) * 1000,
+        'latency_p50_ms': percentile(latency, 0.50) * 1000,
+        'latency_p95_ms': percentile(latency, 0.95) * 1000,
+        'latency_p99_ms': percentile(latency, 0.99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('log', help='push log written via PUSH_RECORD_FILE (.jsonl or .jsonl.gz)')
+    parser.add_argument('--url', required=True,
+                        help='handle_pubsub URL: /handle_pubsub on the service, / on the function')
+    arrival = parser.add_mutually_exclusive_group()
+    arrival.add_argument('--speed', type=float, default=1.0,
+                         help='multiple of the recorded arrival rate')
+    arrival.add_argument('--rate', type=float, help='Poisson arrivals at this many pushes/sec')
+    parser.add_argument('--ramp', type=float, nargs='+',
+                        help='load multipliers to step through, e.g. 1 2 5 10 20')
+    parser.add_argument('--step-seconds', type=float, default=30.0,
+                        help='length of each ramp step')
+    parser.add_argument('--duration', type=float,
+                        help='length of a single run; default plays the log once')
+    parser.add_argument('--max-in-flight', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--jwt', choices=('keep', 'strip', 'refresh'), default='keep')
+    parser.add_argument('--jwt-secret', default='push-replay')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--max-queue-delay-ms', type=float, default=100.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    pushes = load_log(args.log)
+    if not pushes:
+        sys.exit(f"{args.log} has no recorded pushes")
+    rng = random.Random(args.seed)
+    steps = [(m, args.step_seconds) for m in args.ramp] if args.ramp else [(1.0, args.duration)]
+
+    reports = []
+    if not args.json:
+        print(f"{'load':>6} {'pushes':>7} {'offered/s':>10} {'achieved/s':>11} {'errors':>7} "
+              f"{'queue p50/p95/p99 ms':>22} {'latency p50/p95/p99 ms':>24}")
+    for multiplier, duration in steps:
+        results, length, elapsed = asyncio.run(run_step(pushes, args, multiplier, duration, rng))
+        report = {'load': multiplier, **summarize(results, length, elapsed)}
+        reports.append(report)
+        if not args.json:
+            queue = f"{report['queue_p50_ms']:.0f}/{report['queue_p95_ms']:.0f}/{report['queue_p99_ms']:.0f}"
+            latency = f"{report['latency_p50_ms']:.0f}/{report['latency_p95_ms']:.0f}/{report['latency_p99_ms']:.0f}"
+            print(f"{multiplier:>5g}x {report['pushes']:>7} {report['offered_rps']:>10.1f} "
+                  f"{report['achieved_rps']:>11.1f} {report['error_rate']:>6.1%} {queue:>22} {latency:>24}")
+            failures = {s: n for s, n in report['statuses'].items() if not s.startswith('2')}
+            if failures:
+                print(f"{'':>7} {', '.join(f'{s}: {n}' for s, n in sorted(failures.items()))}")
+
+    healthy = [
+        report for report in reports
+        if report['error_rate'] <= args.max_error_rate and report['queue_p95_ms'] <= args.max_queue_delay_ms
+    ]
+    saturation = max((report['achieved_rps'] for report in healthy), default=None)
+    if args.json:
+        print(json.dumps({'steps': reports, 'saturation_rps': saturation}, indent=2))
+    elif args.ramp:
+        if saturation is None:
+            print("saturated at every step")
+        else:
+            print(f"saturation throughput: {saturation:.1f} pushes/sec "
+                  f"(error rate <= {args.max_error_rate:.1%}, p95 queue delay <= {args.max_queue_delay_ms:g} ms)")
+
+if __name__ == '__main__':
+    main()
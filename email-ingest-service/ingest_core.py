@@ -0,0 +1,1248 @@
+"""
+Ingest pieces shared by the email ingest service (main.py, asgi.py) and the
+Cloud Function in the repository root.
+
+Both entry points build Gmail clients, read history and fetch messages the
+same way, pack raw messages the same way, write inbound_emails through the
+same batched statement and keep mailbox cursors and dead-lettered pushes in
+the same tables; only their error types, metrics, connection pools and
+inbound_emails columns differ, and those are supplied by the caller. Keep this module free of third-party
+imports at load time so neither entry point's cold start grows.
+"""
+
+import functools
+import hashlib
+import importlib
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.parser import BytesHeaderParser
+from typing import Dict, Any, Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+psycopg = LazyModule('psycopg')
+http_requests = LazyModule('requests')
+requests = LazyModule('google.auth.transport.requests')
+service_account = LazyModule('google.oauth2.service_account')
+discovery = LazyModule('googleapiclient.discovery')
+discovery_cache = LazyModule('googleapiclient.discovery_cache')
+googleapiclient_http = LazyModule('googleapiclient.http')
+google_auth_httplib2 = LazyModule('google_auth_httplib2')
+googleapiclient_errors = LazyModule('googleapiclient.errors')
+zstandard = LazyModule('zstandard')
+
+GOOGLE_CLIENT_EMAIL = os.environ.get('GOOGLE_CLIENT_EMAIL')
+GOOGLE_PRIVATE_KEY = os.environ.get('GOOGLE_PRIVATE_KEY', '').replace('\\n', '\n')
+GOOGLE_PROJECT_ID = os.environ.get('GOOGLE_PROJECT_ID')
+
+# Discovery document to build the Gmail client from; defaults to the copy
+# bundled with google-api-python-client so no discovery fetch is ever made.
+GMAIL_DISCOVERY_DOC = os.environ.get('GMAIL_DISCOVERY_DOC')
+# Act as each mailbox's user through domain-wide delegation; false reads
+# every mailbox with the service account's own identity.
+GMAIL_DELEGATION = os.environ.get('GMAIL_DELEGATION', 'true').lower() == 'true'
+
+GMAIL_WATCH_LABEL = os.environ.get('GMAIL_WATCH_LABEL', 'school-events')
+# Mailboxes whose delegated credentials and clients are kept; the least
+# recently used are dropped beyond this.
+GMAIL_CLIENT_CACHE_SIZE = int(os.environ.get('GMAIL_CLIENT_CACHE_SIZE', 1000))
+
+# Gmail accepts up to 100 calls per batch but starts rate limiting the
+# inner calls well before that, so default to its recommended 50.
+GMAIL_BATCH_SIZE = min(int(os.environ.get('GMAIL_BATCH_SIZE', 50)), 100)
+GMAIL_RETRY_STATUSES = {429, 500, 502, 503, 504}
+GMAIL_BATCH_RETRY_DELAY = 1.0
+
+HISTORY_PAGE_SIZE = 500
+# Window scanned when a notification's history ID has expired (Gmail keeps
+# history for roughly a week); duplicates are dropped by the insert.
+GMAIL_FALLBACK_QUERY = os.environ.get('GMAIL_FALLBACK_QUERY', 'newer_than:7d')
+
+# GMAIL_WATCH_LABEL is usually a label name, but history and message listing
+# filter by label id, which differs per mailbox. Ids are resolved once per
+# mailbox and kept for GMAIL_LABEL_CACHE_TTL seconds; a mailbox without the
+# label is looked up again after GMAIL_LABEL_MISSING_TTL.
+GMAIL_LABEL_CACHE_TTL = int(os.environ.get('GMAIL_LABEL_CACHE_TTL', 3600))
+GMAIL_LABEL_MISSING_TTL = 300
+
+RAW_BODY_ZSTD_LEVEL = int(os.environ.get('RAW_BODY_ZSTD_LEVEL', 3))
+BLOB_MIN_SIZE = int(os.environ.get('BLOB_MIN_SIZE', 4096))
+
+# Micro-batched inbound_emails writes: rows from concurrent requests are
+# collected for up to WRITE_BATCH_ROWS rows or WRITE_BATCH_DELAY_MS and
+# committed together, so bursts don't turn into one commit per request.
+WRITE_BATCH_ROWS = int(os.environ.get('WRITE_BATCH_ROWS', 500))
+WRITE_BATCH_DELAY_MS = float(os.environ.get('WRITE_BATCH_DELAY_MS', 5))
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+_label_ids = TTLCache(maxsize=GMAIL_CLIENT_CACHE_SIZE, ttl=GMAIL_LABEL_CACHE_TTL)
+
+def match_label_id(labels: Iterable[Dict[str, Any]], label: str) -> Optional[str]:
+    """Return the id of the label whose id or name is label; names also match ignoring case."""
+    labels = list(labels)
+    for candidate in labels:
+        if label in (candidate.get('id'), candidate.get('name')):
+            return candidate['id']
+    folded = label.casefold()
+    for candidate in labels:
+        if candidate.get('name', '').casefold() == folded:
+            return candidate['id']
+    return None
+
+def cache_label_id(user_email: str, label_id: Optional[str]) -> None:
+    """Remember a mailbox's resolved label id, or that it has no such label."""
+    if label_id is None:
+        logger.warning(f"Mailbox {user_email} has no label {GMAIL_WATCH_LABEL}, nothing to ingest")
+        # Stored as '' since the cache treats None as a miss
+        _label_ids.set(user_email, '', ttl=GMAIL_LABEL_MISSING_TTL)
+    else:
+        _label_ids.set(user_email, label_id)
+
+GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+def _service_account_info() -> Dict[str, str]:
+    """Service account credentials info built from the environment."""
+    return {
+        "type": "service_account",
+        "project_id": GOOGLE_PROJECT_ID,
+        "private_key_id": "",
+        "private_key": GOOGLE_PRIVATE_KEY,
+        "client_email": GOOGLE_CLIENT_EMAIL,
+        "client_id": "",
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs"
+    }
+
+def _load_discovery_document(service_name: str, version: str) -> Dict[str, Any]:
+    """Load a discovery document from GMAIL_DISCOVERY_DOC or the bundled copy."""
+    if GMAIL_DISCOVERY_DOC:
+        with open(GMAIL_DISCOVERY_DOC, 'r') as f:
+            return json.load(f)
+    content = discovery_cache.get_static_doc(service_name, version)
+    if content is None:
+        raise RuntimeError(f"No bundled discovery document for {service_name} {version}")
+    return json.loads(content)
+
+class GmailClientFactory:
+    """
+    Gmail API clients that live for the life of the instance, one per mailbox.
+
+    With domain-wide delegation each mailbox is read as its own user, so it
+    needs its own credentials. Those are derived from the shared service
+    account key and kept in an LRU of at most maxsize mailboxes. A mailbox's
+    token is refreshed under that mailbox's lock only when it is close to
+    expiry, so a busy mailbox costs one token exchange an hour and a slow
+    exchange for one mailbox never holds up another. httplib2 is not
+    thread-safe, so each thread builds its own service per mailbox from the
+    shared discovery document, all on one connection pool per thread.
+    """
+
+    def __init__(self, maxsize: int = GMAIL_CLIENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._base = None
+        self._discovery = None
+        self._mailboxes: 'OrderedDict[Optional[str], Tuple[Any, threading.Lock]]' = OrderedDict()
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'token_refreshes': 0}
+
+    def prepare(self) -> None:
+        """Load the service account key and the discovery document."""
+        with self._lock:
+            self._load_base()
+            self._load_discovery()
+
+    def _load_base(self) -> None:
+        if self._base is None:
+            self._base = service_account.Credentials.from_service_account_info(
+                _service_account_info(),
+                scopes=GMAIL_SCOPES
+            )
+
+    def _load_discovery(self) -> None:
+        if self._discovery is None:
+            self._discovery = _load_discovery_document('gmail', 'v1')
+
+    def credentials(self, subject: Optional[str] = None):
+        """Return credentials for the mailbox holding a token valid for a while yet."""
+        if not GMAIL_DELEGATION:
+            subject = None
+        with self._lock:
+            entry = self._mailboxes.get(subject)
+            if entry is not None:
+                self._mailboxes.move_to_end(subject)
+                self._stats['hits'] += 1
+            else:
+                self._load_base()
+                credentials = self._base.with_subject(subject) if subject else self._base
+                entry = self._mailboxes[subject] = (credentials, threading.Lock())
+                self._stats['misses'] += 1
+                while len(self._mailboxes) > self.maxsize:
+                    self._mailboxes.popitem(last=False)
+                    self._stats['evictions'] += 1
+        credentials, refresh_lock = entry
+        with refresh_lock:
+            if self._token_expiring(credentials):
+                credentials.refresh(requests.Request())
+                with self._lock:
+                    self._stats['token_refreshes'] += 1
+        return credentials
+
+    def service(self, subject: Optional[str] = None):
+        """Return this thread's Gmail service for the mailbox."""
+        if not GMAIL_DELEGATION:
+            subject = None
+        credentials = self.credentials(subject)
+        services = getattr(self._local, 'services', None)
+        if services is None:
+            services = self._local.services = OrderedDict()
+            self._local.http = googleapiclient_http.build_http()
+        cached = services.get(subject)
+        if cached is not None and cached[0] is credentials:
+            services.move_to_end(subject)
+            return cached[1]
+        with self._lock:
+            self._load_discovery()
+            document = self._discovery
+        service = discovery.build_from_document(
+            document, http=google_auth_httplib2.AuthorizedHttp(credentials, http=self._local.http)
+        )
+        services[subject] = (credentials, service)
+        services.move_to_end(subject)
+        while len(services) > self.maxsize:
+            services.popitem(last=False)
+        return service
+
+    def stats(self) -> Dict[str, int]:
+        """The number of cached mailboxes and the hit, miss, eviction and token refresh counts."""
+        with self._lock:
+            return {'size': len(self._mailboxes), **self._stats}
+
+    def reset(self) -> None:
+        """Drop cached credentials and clients (e.g. after a key rotation)."""
+        with self._lock:
+            self._base = None
+            self._discovery = None
+            self._mailboxes.clear()
+            self._local = threading.local()
+
+    @staticmethod
+    def _token_expiring(credentials) -> bool:
+        if not credentials.token or credentials.expiry is None:
+            return True
+        return credentials.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
+class HistoryCheckpoint(NamedTuple):
+    """Resumable position in a history scan."""
+    start_history_id: str
+    page_token: Optional[str] = None
+
+class HistoryReader:
+    """
+    Lazily pages through users.history.list, yielding added message ids.
+
+    Only the current page is held in memory and the next one is requested
+    when the consumer gets to it. ``checkpoint`` is the start of the page
+    being consumed; passing it back as ``resume_from`` restarts the scan
+    there, and ids already handled on that page are dropped by the insert's
+    ON CONFLICT. If the start history ID has expired (404) the reader pages
+    through the watched label's recent messages instead. Both filter by the
+    watched label's id, so a mailbox without the label yields nothing.
+
+    Gmail errors other than the expired history ID are raised as HttpError;
+    each entry point maps them onto its own error handling.
+    """
+
+    def __init__(self, service, user_email: str, start_history_id: str,
+                 resume_from: Optional[HistoryCheckpoint] = None):
+        self.service = service
+        self.user_email = user_email
+        self.checkpoint = resume_from or HistoryCheckpoint(str(start_history_id))
+        # Newest mailbox history ID reported by Gmail while reading
+        self.history_id: Optional[str] = None
+        self.fell_back = False
+        self._seen = set()
+        self._label_id: Optional[str] = None
+
+    def _execute(self, request) -> Dict[str, Any]:
+        """Run one Gmail list request; subclasses override this to time the calls."""
+        return request.execute()
+
+    def resolve_label_id(self) -> Optional[str]:
+        """Return the id of GMAIL_WATCH_LABEL in the mailbox, or None if it has no such label."""
+        cached = _label_ids.get(self.user_email)
+        if cached is not None:
+            return cached or None
+        response = self._execute(self.service.users().labels().list(
+            userId=self.user_email, fields='labels(id,name)'
+        ))
+        label_id = match_label_id(response.get('labels', []), GMAIL_WATCH_LABEL)
+        cache_label_id(self.user_email, label_id)
+        return label_id
+
+    def __iter__(self) -> Iterator[str]:
+        self._label_id = self.resolve_label_id()
+        if self._label_id is None:
+            return
+        page_token = self.checkpoint.page_token
+        while True:
+            try:
+                response = self._execute(self.service.users().history().list(
+                    userId=self.user_email,
+                    startHistoryId=self.checkpoint.start_history_id,
+                    labelId=self._label_id,
+                    historyTypes='messageAdded',
+                    maxResults=HISTORY_PAGE_SIZE,
+                    pageToken=page_token
+                ))
+            except googleapiclient_errors.HttpError as e:
+                if e.resp.status == 400:
+                    # The label may have been deleted and recreated under a new id
+                    _label_ids.pop(self.user_email)
+                if e.resp.status != 404:
+                    raise
+                logger.warning(
+                    f"History ID {self.checkpoint.start_history_id} not found, "
+                    f"reading recent messages instead"
+                )
+                self.fell_back = True
+                yield from self._recent_message_ids()
+                return
+
+            self.checkpoint = HistoryCheckpoint(self.checkpoint.start_history_id, page_token)
+            self.history_id = response.get('historyId', self.history_id)
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    yield from self._unseen(added['message']['id'])
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _recent_message_ids(self) -> Iterator[str]:
+        page_token = None
+        while True:
+            response = self._execute(self.service.users().messages().list(
+                userId=self.user_email,
+                labelIds=[self._label_id],
+                q=GMAIL_FALLBACK_QUERY,
+                maxResults=HISTORY_PAGE_SIZE,
+                pageToken=page_token
+            ))
+            for message in response.get('messages', []):
+                yield from self._unseen(message['id'])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def _unseen(self, message_id: str) -> Iterator[str]:
+        # A message can show up in several history records
+        if message_id not in self._seen:
+            self._seen.add(message_id)
+            yield message_id
+
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Group an iterable into lists of at most size items."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+def _chunked_last(items: Iterable[Any], size: int) -> Iterator[Tuple[List[Any], bool]]:
+    """
+    _chunked, with each chunk paired with whether it is the last one.
+
+    An empty iterable gives a single empty last chunk. The chunk after each
+    one is read before it is yielded, so when the last chunk comes the
+    iterable is exhausted.
+    """
+    chunks = _chunked(items, size)
+    chunk = next(chunks, [])
+    for following in chunks:
+        yield chunk, False
+        chunk = following
+    yield chunk, True
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+def _clean_header_value(value: str) -> str:
+    # Undecodable 8-bit bytes come back as surrogates, which jsonb rejects
+    if not any('\udc80' <= c <= '\udcff' for c in value):
+        return value
+    raw = value.encode('ascii', 'surrogateescape')
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+def parse_headers(raw_message: bytes) -> Dict[str, str]:
+    """Parse only the header block of a raw MIME message; the body is never scanned."""
+    view = memoryview(raw_message)
+    match = _HEADER_END.search(raw_message)
+    block = view[:match.end()] if match else view
+    message = BytesHeaderParser().parsebytes(bytes(block))
+    return {key: _clean_header_value(value) for key, value in message.raw_items()}
+
+def fetch_messages(service, user_email: str, message_ids: List[str],
+                   parse: Callable[[Dict[str, Any], str], Dict[str, Any]],
+                   observe: Optional[Callable[[float], None]] = None) -> List[Dict[str, Any]]:
+    """
+    Fetch messages through Gmail batch requests of GMAIL_BATCH_SIZE.
+
+    parse turns a format='raw' messages.get response and its message id
+    into the email dict returned for it; observe, if given, is called with
+    the seconds each batch spent waiting on Gmail, parsing excluded.
+    Rate-limited or 5xx items are retried once in a follow-up batch;
+    messages deleted since the notification (404) are skipped and any other
+    failure is raised. Results keep the order of message_ids.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    failures: Dict[str, Exception] = {}
+    # Responses are parsed inside batch.execute()
+    parse_seconds = [0.0]
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            failures[request_id] = exception
+            return
+        started = time.perf_counter()
+        try:
+            results[request_id] = parse(response, request_id)
+        except Exception as e:
+            failures[request_id] = e
+        parse_seconds[0] += time.perf_counter() - started
+
+    def run_batches(ids: List[str]) -> None:
+        for i in range(0, len(ids), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=on_response)
+            for message_id in ids[i:i + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(userId=user_email, id=message_id, format='raw'),
+                    request_id=message_id
+                )
+            started = time.perf_counter()
+            parse_seconds[0] = 0.0
+            batch.execute()
+            if observe is not None:
+                observe(time.perf_counter() - started - parse_seconds[0])
+
+    run_batches(message_ids)
+
+    retry_ids = [
+        mid for mid, e in failures.items()
+        if isinstance(e, googleapiclient_errors.HttpError) and e.resp.status in GMAIL_RETRY_STATUSES
+    ]
+    if retry_ids:
+        logger.warning(f"Retrying {len(retry_ids)} throttled Gmail fetches")
+        for mid in retry_ids:
+            del failures[mid]
+        time.sleep(GMAIL_BATCH_RETRY_DELAY)
+        run_batches(retry_ids)
+
+    for message_id, e in failures.items():
+        if isinstance(e, googleapiclient_errors.HttpError) and e.resp.status == 404:
+            logger.warning(f"Message {message_id} no longer exists, skipping")
+            continue
+        logger.error(f"Failed to fetch message {message_id}: {e}")
+        raise e
+
+    return [results[mid] for mid in message_ids if mid in results]
+
+_zstd = threading.local()
+
+class PackedMessage(NamedTuple):
+    body: bytes                 # zstd-compressed message with attachment bodies cut out
+    parts: List[List[Any]]      # [offset in the cut message, sha256] per cut, in order
+    blobs: Dict[str, bytes]     # sha256 -> zstd-compressed attachment body
+
+def _compressor() -> 'zstandard.ZstdCompressor':
+    # Compressor objects are not safe to share between threads
+    if not hasattr(_zstd, 'compressor'):
+        _zstd.compressor = zstandard.ZstdCompressor(level=RAW_BODY_ZSTD_LEVEL)
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.compressor
+
+def _decompress(data: bytes) -> bytes:
+    _compressor()
+    return _zstd.decompressor.decompress(data)
+
+def _attachment_spans(raw: bytes, start: int, end: int) -> List[Tuple[int, int]]:
+    """Byte ranges of the attachment bodies inside the MIME entity raw[start:end]."""
+    if raw.startswith(b'\r\n', start) or raw.startswith(b'\n', start):
+        header_end = start  # entity without headers
+        body_start = raw.index(b'\n', start) + 1
+    else:
+        match = _HEADER_END.search(raw, start, end)
+        if not match:
+            return []
+        header_end = body_start = match.end()
+    headers = BytesHeaderParser().parsebytes(bytes(memoryview(raw)[start:header_end]))
+    content_type = headers.get_content_type()
+
+    if headers.get_content_maintype() == 'multipart':
+        boundary = headers.get_boundary()
+        if not boundary:
+            return []
+        delimiter = re.compile(
+            rb'\r?\n--' + re.escape(boundary.encode('utf-8', 'surrogateescape')) +
+            rb'(--)?[ \t]*(?:\r?\n|$)'
+        )
+        spans = []
+        part_start = None
+        # The first delimiter may directly follow the blank line after the headers
+        for match in delimiter.finditer(raw, max(body_start - 2, start), end):
+            if part_start is not None:
+                spans.extend(_attachment_spans(raw, part_start, match.start()))
+            if match.group(1):
+                break
+            part_start = match.end()
+        return spans
+
+    if content_type == 'message/rfc822':
+        return _attachment_spans(raw, body_start, end)
+
+    is_attachment = (headers.get_content_disposition() == 'attachment'
+                     or headers.get_content_maintype() != 'text')
+    if is_attachment and end - body_start >= BLOB_MIN_SIZE:
+        return [(body_start, end)]
+    return []
+
+def pack_raw_message(raw: bytes) -> PackedMessage:
+    """Compress a raw message, splitting attachment bodies out as content-addressed blobs."""
+    try:
+        spans = _attachment_spans(raw, 0, len(raw))
+    except Exception as e:
+        logger.warning(f"Failed to split attachments, storing message whole: {e}")
+        spans = []
+
+    view = memoryview(raw)
+    compressor = _compressor()
+    pieces, parts, blobs = [], [], {}
+    offset = position = 0
+    for span_start, span_end in spans:
+        pieces.append(view[position:span_start])
+        offset += span_start - position
+        digest = hashlib.sha256(view[span_start:span_end]).hexdigest()
+        if digest not in blobs:
+            blobs[digest] = compressor.compress(view[span_start:span_end])
+        parts.append([offset, digest])
+        position = span_end
+    pieces.append(view[position:])
+
+    return PackedMessage(compressor.compress(b''.join(pieces)), parts, blobs)
+
+def unpack_raw_message(body: bytes, parts: List[List[Any]], blobs: List[bytes]) -> bytes:
+    """Reassemble a packed message; blobs are the compressed bodies in parts order."""
+    skeleton = _decompress(bytes(body))
+    if len(blobs) != len(parts):
+        raise ValueError(f"Expected {len(parts)} attachment blobs, got {len(blobs)}")
+    pieces = []
+    position = 0
+    for (offset, _), blob in zip(parts, blobs):
+        pieces.append(skeleton[position:offset])
+        pieces.append(_decompress(bytes(blob)))
+        position = offset
+    pieces.append(skeleton[position:])
+    return b''.join(pieces)
+
+class EmailColumns(NamedTuple):
+    """How a deployment's packed email rows map onto its inbound_emails table."""
+    values: Tuple[Tuple[str, str], ...]             # (column, Postgres type) per row value; gmail_message_id last
+    computed: Tuple[Tuple[str, str], ...] = ()      # (column, SQL expression) filled in by the statement
+
+# The schema in README_EmailIngest.md, as written by main._pack_emails
+INBOUND_EMAIL_COLUMNS = EmailColumns(
+    values=(
+        ('raw_body', 'bytea'),
+        ('raw_parts', 'jsonb'),
+        ('headers', 'jsonb'),
+        ('gmail_history', 'text'),
+        ('gmail_message_id', 'text'),
+    ),
+    computed=(('arrived_at', 'now()'),),
+)
+
+class WriteResult(NamedTuple):
+    """Outcome of one caller's emails within a batched write."""
+    user_id: Optional[str]      # None when no user has the mailbox address
+    inserted: List[str]         # gmail_message_ids stored by this write
+    duplicates: List[str]       # gmail_message_ids that were already stored
+                                # (both empty when the user is unknown)
+    cursor: Optional[int] = None    # mailbox cursor after the write, if one was
+                                    # given and the user is known
+
+class _PendingWrite(NamedTuple):
+    mailbox: str
+    user_id: Optional[str]
+    rows: List[tuple]
+    blobs: Dict[str, bytes]
+    cursor: Optional[int]
+    future: Future
+    queued_at: float
+
+@functools.lru_cache(maxsize=None)
+def _write_batch_sql(columns: EmailColumns = INBOUND_EMAIL_COLUMNS) -> str:
+    """
+    Build the statement that writes one batch of emails for many mailboxes.
+
+    It takes one array per column, as built by _write_batch_params: mailbox,
+    cached user id or NULL, ordinal, then one per columns.values; the
+    hashes and contents of the blobs; and mailbox, cached user id or NULL
+    and history id of each mailbox cursor to advance. Rows and cursors
+    without a cached id resolve the user from auth.users, and only blobs
+    referenced by a row with a user and cursors of mailboxes with a user are
+    written. The text doesn't depend on the batch size, so each connection
+    prepares it once. Returns (ordinal, user_id, inserted, NULL, NULL) per
+    input row, then (NULL, user_id, false, mailbox, cursor after) per cursor.
+    """
+    names = [name for name, _ in columns.values]
+    arrays = ", ".join(["%s::text[]", "%s::uuid[]", "%s::int[]"] + [f"%s::{kind}[]" for _, kind in columns.values])
+    insert_columns = ", ".join(names + [name for name, _ in columns.computed])
+    select_columns = ", ".join([f"r.{name}" for name in names] + [expr for _, expr in columns.computed])
+    return f"""
+        WITH v AS (
+            SELECT * FROM unnest({arrays}) AS v(mailbox, cached_user_id, ord, {", ".join(names)})
+        ), r AS (
+            SELECT v.*, COALESCE(v.cached_user_id, au.id) AS user_id
+            FROM v
+            LEFT JOIN auth.users au ON v.cached_user_id IS NULL AND au.email = v.mailbox
+        ), ins AS (
+            INSERT INTO inbound_emails(id, user_id, {insert_columns})
+            SELECT gen_random_uuid(), r.user_id, {select_columns}
+            FROM r
+            WHERE r.user_id IS NOT NULL
+            ON CONFLICT (user_id, gmail_message_id) DO NOTHING
+            RETURNING user_id, gmail_message_id
+        ), blobs AS (
+            INSERT INTO email_blobs(hash, content)
+            SELECT b.hash, b.content FROM unnest(%s::text[], %s::bytea[]) AS b(hash, content)
+            WHERE b.hash IN (
+                SELECT p.part->>1 FROM r, jsonb_array_elements(r.raw_parts) AS p(part)
+                WHERE r.user_id IS NOT NULL
+            )
+            ON CONFLICT (hash) DO NOTHING
+        ), c AS (
+            SELECT u.mailbox, COALESCE(u.cached_user_id, au.id) AS user_id, u.history_id
+            FROM unnest(%s::text[], %s::uuid[], %s::bigint[]) AS u(mailbox, cached_user_id, history_id)
+            LEFT JOIN auth.users au ON u.cached_user_id IS NULL AND au.email = u.mailbox
+        ), cursors AS (
+            INSERT INTO mailbox_cursors (email_address, history_id, updated_at)
+            SELECT c.mailbox, max(c.history_id), now() FROM c
+            WHERE c.user_id IS NOT NULL
+            GROUP BY c.mailbox
+            ON CONFLICT (email_address) DO UPDATE
+            SET history_id = GREATEST(mailbox_cursors.history_id, EXCLUDED.history_id),
+                updated_at = now()
+            RETURNING email_address, history_id
+        )
+        SELECT r.ord, r.user_id, (r.user_id, r.gmail_message_id) IN (SELECT user_id, gmail_message_id FROM ins),
+               NULL::text, NULL::bigint
+        FROM r
+        UNION ALL
+        SELECT NULL, c.user_id, false, c.mailbox, m.history_id
+        FROM c
+        LEFT JOIN cursors m ON m.email_address = c.mailbox
+    """
+
+def _write_batch_params(rows: List[tuple], blobs: Dict[str, bytes],
+                        columns: EmailColumns = INBOUND_EMAIL_COLUMNS,
+                        cursors: List[tuple] = ()) -> List[list]:
+    """
+    _write_batch_sql parameters from (mailbox, cached user id, ordinal, *values)
+    rows, blobs and (mailbox, cached user id, history id) cursors.
+    """
+    arrays = [list(column) for column in zip(*rows)] or [[] for _ in range(3 + len(columns.values))]
+    cursor_arrays = [list(column) for column in zip(*cursors)] or [[], [], []]
+    return arrays + [list(blobs), list(blobs.values())] + cursor_arrays
+
+class EmailWriter:
+    """
+    Process-wide write buffer for inbound_emails.
+
+    Callers hand over their emails and block on a future; a background
+    thread commits everything queued within WRITE_BATCH_DELAY_MS (or as soon
+    as WRITE_BATCH_ROWS rows are waiting) in a single statement, then
+    resolves each caller's future with its own inserted and duplicate ids.
+    A caller can also hand over the history id its emails complete, and the
+    mailbox cursor moves to it in the same statement.
+
+    Entry points subclass it to supply how emails are packed into rows for
+    ``columns``, where connections come from, and the user id cache.
+    """
+
+    columns = INBOUND_EMAIL_COLUMNS
+
+    def __init__(self, max_rows: int = WRITE_BATCH_ROWS, max_delay_ms: float = WRITE_BATCH_DELAY_MS):
+        self._max_rows = max_rows
+        self._max_delay = max_delay_ms / 1000
+        self._condition = threading.Condition()
+        self._pending: List[_PendingWrite] = []
+        self._rows = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def pack(self, emails: List[Dict[str, Any]], history_id: str) -> Tuple[List[tuple], Dict[str, bytes]]:
+        """Pack emails into rows of ``columns`` values and the blobs they reference."""
+        raise NotImplementedError
+
+    def connection(self):
+        """Context manager yielding a database connection."""
+        raise NotImplementedError
+
+    def cached_user_id(self, mailbox: str) -> Optional[str]:
+        """The cached user id for a mailbox, or None to resolve it in the statement."""
+        return None
+
+    def forget_user_id(self, mailbox: str) -> None:
+        """Drop a mailbox's cached user id after its user turned out to be deleted."""
+
+    def submit(self, mailbox: str, emails: List[Dict[str, Any]], history_id: str,
+               cursor: Optional[int] = None) -> Future:
+        """Queue a mailbox's emails, and optionally its cursor advance, for the next batch."""
+        rows, blobs = self.pack(emails, history_id)
+        future: Future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='email-writer', daemon=True)
+                self._thread.start()
+            self._pending.append(_PendingWrite(
+                mailbox, self.cached_user_id(mailbox), rows, blobs, cursor, future, time.monotonic()
+            ))
+            self._rows += len(rows)
+            self._condition.notify()
+        return future
+
+    def write(self, mailbox: str, emails: List[Dict[str, Any]], history_id: str,
+              cursor: Optional[int] = None) -> WriteResult:
+        """Queue a mailbox's emails and wait for the batch they land in to commit."""
+        if not emails and cursor is None:
+            return WriteResult(self.cached_user_id(mailbox), [], [])
+        return self.submit(mailbox, emails, history_id, cursor).result()
+
+    def _next_batch(self) -> List[_PendingWrite]:
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = self._pending[0].queued_at + self._max_delay
+            while self._rows < self._max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            # Whole requests only; one larger than max_rows goes alone
+            batch, rows = [], 0
+            while self._pending and (not batch or rows + len(self._pending[0].rows) <= self._max_rows):
+                pending = self._pending.pop(0)
+                batch.append(pending)
+                rows += len(pending.rows)
+            self._rows -= rows
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._flush(batch)
+            except Exception as e:
+                if len(batch) == 1 or isinstance(e, psycopg.OperationalError):
+                    # The database is unreachable or overloaded for everyone
+                    for pending in batch:
+                        pending.future.set_exception(e)
+                    continue
+                # One bad row (say a header with a NUL, which jsonb rejects)
+                # must not fail the requests it happened to be batched with
+                for pending in batch:
+                    self._flush_alone(pending)
+                continue
+            for pending, result in zip(batch, results):
+                pending.future.set_result(result)
+
+    def _flush_alone(self, pending: _PendingWrite) -> None:
+        try:
+            pending.future.set_result(self._flush([pending])[0])
+        except Exception as e:
+            pending.future.set_exception(e)
+
+    def _flush(self, batch: List[_PendingWrite]) -> List[WriteResult]:
+        # A message in two requests for the same mailbox is written once; the
+        # later copy is reported as a duplicate, as it would be on its own.
+        # Gmail message ids are only unique within a mailbox.
+        seen = set()
+        entries = []
+        for index, pending in enumerate(batch):
+            for row in pending.rows:
+                key = (pending.mailbox, row[-1])
+                if key not in seen:
+                    seen.add(key)
+                    entries.append((index, row))
+        blobs: Dict[str, bytes] = {}
+        for pending in batch:
+            blobs.update(pending.blobs)
+        sql = _write_batch_sql(self.columns)
+
+        def params(use_cache: bool) -> list:
+            rows = [
+                (batch[index].mailbox, batch[index].user_id if use_cache else None, ord_) + row
+                for ord_, (index, row) in enumerate(entries)
+            ]
+            cursors = [
+                (pending.mailbox, pending.user_id if use_cache else None, pending.cursor)
+                for pending in batch if pending.cursor is not None
+            ]
+            return _write_batch_params(rows, blobs, self.columns, cursors)
+
+        used_cache = True
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute(sql, params(True))
+                except psycopg.errors.ForeignKeyViolation:
+                    # A cached user was deleted; resolve every mailbox again
+                    conn.rollback()
+                    for pending in batch:
+                        self.forget_user_id(pending.mailbox)
+                    used_cache = False
+                    cur.execute(sql, params(False))
+                result_rows = cur.fetchall()
+            conn.commit()
+
+        mailbox_users: Dict[str, Optional[str]] = {}
+        cursors: Dict[str, int] = {}
+        inserted = set()
+        for ord_, user_id, was_inserted, cursor_mailbox, cursor in result_rows:
+            if ord_ is None:
+                mailbox_users[cursor_mailbox] = str(user_id) if user_id else None
+                if cursor is not None:
+                    cursors[cursor_mailbox] = int(cursor)
+                continue
+            index, row = entries[ord_]
+            mailbox = batch[index].mailbox
+            mailbox_users[mailbox] = str(user_id) if user_id else None
+            if was_inserted:
+                inserted.add((mailbox, row[-1]))
+
+        results = []
+        for pending in batch:
+            # A request with no rows of its own in the statement keeps the
+            # user id it was queued with
+            user_id = mailbox_users.get(pending.mailbox, pending.user_id if used_cache else None)
+            ids = [row[-1] for row in pending.rows] if user_id else []
+            results.append(WriteResult(
+                user_id,
+                [mid for mid in ids if (pending.mailbox, mid) in inserted],
+                [mid for mid in ids if (pending.mailbox, mid) not in inserted],
+                cursors.get(pending.mailbox) if pending.cursor is not None else None
+            ))
+            # Only the request that actually wrote a message reports it
+            inserted.difference_update((pending.mailbox, mid) for mid in ids)
+        return results
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that follows the latency of the work it admits.
+
+    A gradient limiter: the ratio of the long-run average latency to the
+    recent one shrinks the limit as requests start queueing behind a slow
+    dependency and lets it grow back, by about the square root of the limit
+    per round trip, while latency stays near the baseline. The baseline is
+    only learned while requests aren't queueing. A failed request cuts the
+    limit multiplicatively.
+    """
+
+    SHORT_WINDOW = 10
+    LONG_WINDOW = 600
+    TOLERANCE = 1.5      # latency may reach this multiple of the baseline before the limit shrinks
+    SMOOTHING = 0.2
+    BACKOFF_RATIO = 0.9
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Admit a request unless the limit is reached; admitted requests must be released."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: Optional[float] = None, dropped: bool = False) -> None:
+        """
+        Release an admitted request.
+
+        latency is the time spent on the limited work, if it completed;
+        dropped marks a failure caused by an overloaded or unavailable
+        dependency.
+        """
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if dropped:
+                self.limit = max(self.min_limit, self.limit * self.BACKOFF_RATIO)
+            elif latency is not None:
+                self._update(latency, in_flight)
+
+    def _update(self, latency: float, in_flight: int) -> None:
+        # Latency seen well below the limit says nothing about where it should be
+        underused = in_flight < self.limit / 2
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+        else:
+            self._short_latency += (latency - self._short_latency) / self.SHORT_WINDOW
+            # Only learn the baseline from requests that weren't queueing, or
+            # sustained overload would slowly become the new normal
+            queueing = self._short_latency > self.TOLERANCE * self._long_latency
+            if not queueing or underused or self.limit <= self.min_limit:
+                self._long_latency += (latency - self._long_latency) / self.LONG_WINDOW
+            # Let the baseline follow latency down quickly after a slow spell
+            if self._long_latency > 2 * self._short_latency:
+                self._long_latency *= 0.95
+        if underused:
+            return
+        gradient = max(0.5, min(1.0, self.TOLERANCE * self._long_latency / max(self._short_latency, 1e-6)))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.SMOOTHING) + target * self.SMOOTHING
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def render(self) -> List[str]:
+        with self._lock:
+            limit, in_flight = int(self.limit), self.in_flight
+        return [
+            "# HELP ingest_concurrency_limit Pushes processed at once before new ones are shed.",
+            "# TYPE ingest_concurrency_limit gauge",
+            f"ingest_concurrency_limit {limit}",
+            "# HELP ingest_in_flight Pushes being processed.",
+            "# TYPE ingest_in_flight gauge",
+            f"ingest_in_flight {in_flight}",
+        ]
+
+# Per-mailbox history cursors. Only one history scan per mailbox runs at a
+# time in a process; pushes that arrive meanwhile wait for it and are then
+# usually already covered by the cursor it left behind.
+MAILBOX_LOCK_TIMEOUT = float(os.environ.get('MAILBOX_LOCK_TIMEOUT', 30))
+
+class KeyedLocks:
+    """A lock per key, created on demand and dropped when nobody holds it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[str, list] = {}
+
+    @contextmanager
+    def hold(self, key: str, timeout: float = -1):
+        """Acquire the lock for key; yields whether it was acquired in time."""
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+_CURSOR_SELECT_SQL = "SELECT history_id FROM mailbox_cursors WHERE email_address = %s"
+
+class MailboxCursors:
+    """
+    The last fully processed history ID of each mailbox, in mailbox_cursors.
+
+    The in-process copy answers without a query when it already covers the
+    push; otherwise the table is read, since other instances may have moved
+    it on. The table is advanced by EmailWriter, in the statement that
+    stores a scan's last emails, and the writer's result is remembered here.
+    Cursors only ever move forward. Entry points subclass it to supply where
+    connections come from.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors: Dict[str, int] = {}
+
+    def connection(self):
+        """Context manager yielding a database connection."""
+        raise NotImplementedError
+
+    def cached(self, email_address: str) -> Optional[int]:
+        """The in-process copy of a mailbox's cursor, if any."""
+        with self._lock:
+            return self._cursors.get(email_address)
+
+    def remember(self, email_address: str, history_id: int) -> int:
+        """Move the in-process copy forward to history_id; returns the cursor after."""
+        with self._lock:
+            current = self._cursors.get(email_address)
+            if current is None or history_id > current:
+                self._cursors[email_address] = history_id
+            return self._cursors[email_address]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cursors.clear()
+
+    def get(self, email_address: str, min_history_id: Optional[int] = None) -> Optional[int]:
+        """Return a mailbox's cursor, or None if it has never been processed."""
+        cached = self.cached(email_address)
+        if cached is not None and min_history_id is not None and cached >= min_history_id:
+            return cached
+        with self.connection() as conn:
+            row = conn.execute(_CURSOR_SELECT_SQL, (email_address,)).fetchone()
+        if row is None:
+            return cached
+        return self.remember(email_address, int(row[0]))
+
+# Seconds Pub/Sub is asked to wait after a transient failure when Gmail
+# didn't say how long
+TRANSIENT_RETRY_AFTER = int(os.environ.get('TRANSIENT_RETRY_AFTER', 30))
+
+def _error_chain(error: BaseException) -> Iterator[BaseException]:
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether an error is likely to clear on its own: Gmail throttling or 5xx,
+    timeouts, dropped connections, and Postgres being unreachable,
+    overloaded or out of pool connections. Wrapping exceptions are unwound.
+    """
+    for e in _error_chain(error):
+        if isinstance(e, (TimeoutError, ConnectionError)):
+            return True
+        # Only check libraries that are loaded; an error can't come from the others
+        if 'googleapiclient.errors' in sys.modules and isinstance(e, googleapiclient_errors.HttpError):
+            return e.resp.status in GMAIL_RETRY_STATUSES
+        if 'requests' in sys.modules and isinstance(
+            e, (http_requests.exceptions.ConnectionError, http_requests.exceptions.Timeout)
+        ):
+            return True
+        if 'psycopg' in sys.modules and isinstance(e, psycopg.OperationalError):
+            return True
+    return False
+
+def retry_after(error: BaseException) -> int:
+    """Seconds to ask Pub/Sub to wait after a transient error, as Gmail asked if it did."""
+    for e in _error_chain(error):
+        resp = getattr(e, 'resp', None)
+        value = resp.get('retry-after') if hasattr(resp, 'get') else None
+        if isinstance(value, str) and value.isdigit():
+            return int(value)
+    return TRANSIENT_RETRY_AFTER
+
+# Dead-lettered notifications. A push whose ingest fails is recorded in
+# ingest_failures and acknowledged; replay_failures.py retries it once the
+# dependency has recovered, with exponential backoff between attempts.
+DEAD_LETTER_ENABLED = os.environ.get('DEAD_LETTER_ENABLED', 'true').lower() == 'true'
+DEAD_LETTER_RETRY_BASE = int(os.environ.get('DEAD_LETTER_RETRY_BASE', 60))
+DEAD_LETTER_RETRY_MAX = int(os.environ.get('DEAD_LETTER_RETRY_MAX', 3600))
+DEAD_LETTER_ERROR_LENGTH = 1000
+
+# One row per mailbox: the newest failed history ID covers the older ones,
+# since a scan always runs from the mailbox cursor
+_FAILURE_RECORD_SQL = """
+    INSERT INTO ingest_failures AS f
+        (email_address, history_id, error_class, error_type, error, next_attempt_at)
+    VALUES (%(email)s, %(history_id)s, %(error_class)s, %(error_type)s, %(error)s,
+            now() + make_interval(secs => %(base)s))
+    ON CONFLICT (email_address) DO UPDATE
+    SET history_id = GREATEST(f.history_id, EXCLUDED.history_id),
+        error_class = EXCLUDED.error_class,
+        error_type = EXCLUDED.error_type,
+        error = EXCLUDED.error,
+        attempts = f.attempts + 1,
+        last_failed_at = now(),
+        next_attempt_at = now() + make_interval(secs => LEAST(%(base)s * power(2, f.attempts), %(max)s))
+    RETURNING attempts
+"""
+_FAILURE_CLAIM_SQL = """
+    UPDATE ingest_failures SET next_attempt_at = now() + make_interval(secs => %(lease)s)
+    WHERE email_address IN (
+        SELECT email_address FROM ingest_failures
+        WHERE next_attempt_at <= now() AND attempts < %(max_attempts)s
+        ORDER BY next_attempt_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING email_address, history_id, attempts
+"""
+_FAILURE_RESOLVE_SQL = "DELETE FROM ingest_failures WHERE email_address = %s AND history_id <= %s"
+
+class IngestFailure(NamedTuple):
+    email_address: str
+    history_id: int
+    attempts: int
+
+def _failure_params(email_address: str, history_id: Any, error: BaseException, error_class: str) -> Dict[str, Any]:
+    return {
+        'email': email_address,
+        'history_id': int(history_id),
+        'error_class': error_class,
+        'error_type': type(error).__name__,
+        'error': str(error)[:DEAD_LETTER_ERROR_LENGTH],
+        'base': DEAD_LETTER_RETRY_BASE,
+        'max': DEAD_LETTER_RETRY_MAX,
+    }
+
+class IngestFailures:
+    """
+    Failed notifications in ingest_failures, waiting to be replayed.
+
+    Entry points subclass it to supply where connections come from.
+    """
+
+    def connection(self):
+        """Context manager yielding a database connection."""
+        raise NotImplementedError
+
+    def record(self, email_address: str, history_id: Any, error: BaseException, error_class: str) -> int:
+        """Record a failure, or another one for the mailbox; returns its attempt count."""
+        with self.connection() as conn:
+            return conn.execute(
+                _FAILURE_RECORD_SQL, _failure_params(email_address, history_id, error, error_class)
+            ).fetchone()[0]
+
+    def claim(self, limit: int, lease: float, max_attempts: int) -> List[IngestFailure]:
+        """
+        Claim up to limit failures that are due for another attempt.
+
+        Claimed rows are not due again for lease seconds, so concurrent replays
+        don't pick them up; recording or resolving a failure ends the lease.
+        """
+        with self.connection() as conn:
+            rows = conn.execute(_FAILURE_CLAIM_SQL, {
+                'lease': lease, 'max_attempts': max_attempts, 'limit': limit
+            }).fetchall()
+        return [IngestFailure(email, int(history_id), attempts) for email, history_id, attempts in rows]
+
+    def resolve(self, email_address: str, history_id: int) -> None:
+        """Drop a mailbox's failure once history_id is stored, unless a newer one was recorded meanwhile."""
+        with self.connection() as conn:
+            conn.execute(_FAILURE_RESOLVE_SQL, (email_address, history_id))
+
+class PushRecorder:
+    """
+    Appends push envelopes to a JSON-lines log, one compact line per push.
+
+    Each line is {"t": arrival time, "e": envelope} plus "a" for the
+    Authorization header when there is one. Recording never fails a push.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, envelope: Any, authorization: Optional[str] = None) -> None:
+        entry = {'t': round(time.time(), 3), 'e': envelope}
+        if authorization:
+            entry['a'] = authorization
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.path, 'a', buffering=1)
+                self._file.write(line)
+        except OSError as e:
+            logger.warning(f"Failed to record push: {e}")
+
+_warm_up_thread: Optional[threading.Thread] = None
+_warm_up_lock = threading.Lock()
+
+def warm_up(steps: Iterable[Tuple[str, Callable[[], Any]]]) -> None:
+    """Run each named warm-up step; a failure is logged and left for the first request to hit again."""
+    started = time.monotonic()
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"Warm-up of {name} failed: {e}")
+    logger.info(f"Warm-up finished in {time.monotonic() - started:.2f}s")
+
+def start_warm_up(target: Callable[[], None]) -> threading.Thread:
+    """Run target on a daemon thread, once per process."""
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=target, name='warm-up', daemon=True)
+            _warm_up_thread.start()
+        return _warm_up_thread
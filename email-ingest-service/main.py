@@ -1,53 +1,335 @@
+import atexit
+import base64
+import bisect
+import hashlib
 import json
 import logging
 import os
-from datetime import datetime
-from typing import Dict, Any, Optional
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
-import psycopg
-from google.auth.transport import requests
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from flask import Flask, request, jsonify
-import jwt
-from jwt import PyJWTError
+
+import ingest_core
+from ingest_core import (
+    AdaptiveLimiter,
+    DEAD_LETTER_ENABLED,
+    GMAIL_BATCH_SIZE,
+    GOOGLE_PRIVATE_KEY,
+    GOOGLE_PROJECT_ID,
+    HistoryCheckpoint,
+    IngestFailure,
+    KeyedLocks,
+    LazyModule,
+    MAILBOX_LOCK_TIMEOUT,
+    PushRecorder,
+    TTLCache,
+    _chunked_last,
+    discovery,
+    discovery_cache,
+    google_auth_httplib2,
+    googleapiclient_errors,
+    googleapiclient_http,
+    http_requests,
+    is_transient,
+    pack_raw_message,
+    parse_headers,
+    psycopg,
+    requests,
+    retry_after,
+    service_account,
+    unpack_raw_message,
+    zstandard,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The Google client libraries, psycopg and PyJWT dominate cold start, and a
+# push only needs them once it gets past envelope validation. See
+# benchmarks/import_time_bench.py for the import budget. The ones ingest_core
+# uses are its LazyModules.
+psycopg_pool = LazyModule('psycopg_pool')
+jwt = LazyModule('jwt')
+_DEFERRED_MODULES = (
+    psycopg, psycopg_pool, http_requests, requests, service_account, discovery,
+    discovery_cache, googleapiclient_http, google_auth_httplib2, googleapiclient_errors, jwt, zstandard
+)
+
 app = Flask(__name__)
 
 # Environment variables
 SUPABASE_DB_URL = os.environ.get('SUPABASE_DB_URL')
 SUPABASE_SERVICE_ROLE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
-GOOGLE_CLIENT_EMAIL = os.environ.get('GOOGLE_CLIENT_EMAIL')
-GOOGLE_PRIVATE_KEY = os.environ.get('GOOGLE_PRIVATE_KEY', '').replace('\\n', '\n')
-GOOGLE_PROJECT_ID = os.environ.get('GOOGLE_PROJECT_ID')
-GMAIL_WATCH_LABEL = os.environ.get('GMAIL_WATCH_LABEL', 'school-events')
 SUPABASE_JWT_SECRET = os.environ.get('SUPABASE_JWT_SECRET')
 
+# Postgres connection pool sizing; keep DB_POOL_MAX_SIZE in line with the
+# Cloud Run concurrency setting so requests rarely wait for a connection.
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Executions before psycopg server-side prepares a statement; empty disables
+# prepared statements (needed behind a transaction-mode pgbouncer < 1.21).
+DB_PREPARE_THRESHOLD = os.environ.get('DB_PREPARE_THRESHOLD', '1')
+
+_db_pool: Optional['psycopg_pool.ConnectionPool'] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> 'psycopg_pool.ConnectionPool':
+    """Return the process-wide Postgres connection pool, opening it on first use."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = psycopg_pool.ConnectionPool(
+                    SUPABASE_DB_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    timeout=DB_POOL_TIMEOUT,
+                    check=psycopg_pool.ConnectionPool.check_connection,
+                    kwargs={
+                        'prepare_threshold': int(DB_PREPARE_THRESHOLD) if DB_PREPARE_THRESHOLD else None
+                    },
+                    name='inbound-emails',
+                    open=True
+                )
+                atexit.register(pool.close)
+                _db_pool = pool
+    return _db_pool
+
+def db_pool_stats() -> Dict[str, int]:
+    """Pool size, saturation and wait-time counters, empty until the pool is opened."""
+    if _db_pool is None:
+        return {}
+    return _db_pool.get_stats()
+
+# JWT verification caching
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+JWKS_DEFAULT_MAX_AGE = 3600          # used when the certs response has no max-age
+JWKS_MIN_REFRESH_INTERVAL = 30       # throttle refreshes triggered by unknown kids
+JWKS_FETCH_TIMEOUT = 10
+VERIFIED_TOKEN_TTL = int(os.environ.get('VERIFIED_TOKEN_TTL', 300))
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 10000))
+
+# Prometheus metrics, served on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+    """
+    Thread-safe Prometheus histogram with one series per label value.
+
+    An observation is a bisect and two additions under a lock, cheap enough
+    to record on every request.
+    """
+
+    def __init__(self, name: str, documentation: str, label: str,
+                 label_values: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[str, list] = {value: self._new_series() for value in label_values}
+
+    def _new_series(self) -> list:
+        return [[0] * (len(self.buckets) + 1), 0.0]
+
+    def observe(self, label_value: str, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = self._new_series()
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, label_value: str) -> Iterator[None]:
+        """Observe the seconds spent in the block, whether or not it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - started)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = [(value, list(counts), total) for value, (counts, total) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for value, counts, total in sorted(series):
+            labels = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total!r}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+class Counter:
+    """Thread-safe Prometheus counter with one series per label value."""
+
+    def __init__(self, name: str, documentation: str, label: str, label_values: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = {value: 0 for value in label_values}
+
+    def inc(self, label_value: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(f'{self.name}{{{self.label}="{value}"}} {count}' for value, count in values)
+        return lines
+
+INGEST_STAGES = ('verify', 'extract', 'cursor', 'gmail_history', 'gmail_get', 'mime_parse', 'db_insert')
+_stage_seconds = Histogram(
+    'ingest_stage_seconds', 'Seconds spent in each stage of handling a push.', 'stage', INGEST_STAGES
+)
+_emails_total = Counter(
+    'ingest_emails_total', 'Fetched emails by whether they were new or already stored.', 'result',
+    ('inserted', 'duplicate')
+)
+
+_rejected_total = Counter(
+    'ingest_rejected_total', 'Pushes handed back to Pub/Sub for redelivery, by reason.', 'reason',
+    ('overloaded', 'transient', 'mailbox_busy')
+)
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = (
+        _stage_seconds.render() + _emails_total.render() + _rejected_total.render() +
+        _dead_lettered_total.render() + _ingest_limiter.render() + _gmail_clients.render()
+    )
+    return '\n'.join(lines) + '\n'
+
+def _parse_max_age(cache_control: str) -> int:
+    """Return the max-age directive of a Cache-Control header in seconds."""
+    match = re.search(r'max-age=(\d+)', cache_control or '')
+    return int(match.group(1)) if match else JWKS_DEFAULT_MAX_AGE
+
+class JWKSCache:
+    """
+    Process-wide cache of Google's JWT signing keys, keyed by ``kid``.
+
+    Keys are kept for the Cache-Control max-age of the certs response. Once
+    stale they keep being served while a single background refresh runs. An
+    unknown ``kid`` (key rotation) triggers one refresh that every concurrent
+    caller waits on, so only one fetch is ever in flight.
+    """
+
+    def __init__(self, url: str = GOOGLE_CERTS_URL):
+        self.url = url
+        self._keys: Dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._last_fetch: Optional[float] = None
+        self._inflight: Optional[threading.Event] = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid: str):
+        """Return the public key for ``kid``, or None if Google doesn't publish it."""
+        with self._lock:
+            key = self._keys.get(kid)
+            now = time.monotonic()
+            stale = now >= self._expires_at
+            throttled = (
+                self._last_fetch is not None
+                and now - self._last_fetch < JWKS_MIN_REFRESH_INTERVAL
+            )
+
+        if key is not None:
+            if stale:
+                self.refresh(wait=False)
+            return key
+
+        # Don't let tokens with bogus kids hammer the certs endpoint
+        if not throttled:
+            self.refresh(wait=True)
+
+        with self._lock:
+            return self._keys.get(kid)
+
+    def refresh(self, wait: bool = True) -> None:
+        """Fetch the key set, joining the in-flight fetch if there is one."""
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                event = self._inflight = threading.Event()
+
+        if not leader:
+            if wait:
+                event.wait(JWKS_FETCH_TIMEOUT)
+            return
+
+        if wait:
+            self._fetch(event)
+        else:
+            threading.Thread(target=self._fetch, args=(event,), daemon=True).start()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_fetch = None
+
+    def _fetch(self, event: threading.Event) -> None:
+        try:
+            response = http_requests.get(self.url, timeout=JWKS_FETCH_TIMEOUT)
+            response.raise_for_status()
+
+            keys = {}
+            for jwk in response.json().get('keys', []):
+                try:
+                    keys[jwk['kid']] = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+                except (KeyError, ValueError, jwt.PyJWTError) as e:
+                    logger.warning(f"Skipping unusable JWK {jwk.get('kid')}: {e}")
+
+            max_age = _parse_max_age(response.headers.get('Cache-Control', ''))
+            with self._lock:
+                self._keys = keys
+                self._last_fetch = time.monotonic()
+                self._expires_at = self._last_fetch + max_age
+        except Exception as e:
+            logger.error(f"Failed to refresh Google public keys: {e}")
+            with self._lock:
+                self._last_fetch = time.monotonic()
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
+
+_jwks_cache = JWKSCache()
+_verified_tokens = TTLCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE, ttl=VERIFIED_TOKEN_TTL)
+
 def verify_google_jwt(token: str) -> bool:
     """Verify Google-signed JWT from Pub/Sub push notification."""
     try:
-        # Google's public keys endpoint
-        req = requests.Request()
-        
+        # Pub/Sub redelivers the same token, so skip the RSA verify for tokens
+        # we have already accepted.
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        if _verified_tokens.get(token_hash) is not None:
+            return True
+
         # Decode without verification first to get the header
         unverified_header = jwt.get_unverified_header(token)
-        
-        # Get Google's public keys
-        import requests as http_requests
-        response = http_requests.get('https://www.googleapis.com/oauth2/v3/certs')
-        keys = response.json()
-        
-        # Find the key that matches the token's kid
-        key = None
-        for k in keys['keys']:
-            if k['kid'] == unverified_header['kid']:
-                key = jwt.algorithms.RSAAlgorithm.from_jwk(k)
-                break
-        
+
+        key = _jwks_cache.get_key(unverified_header.get('kid'))
         if not key:
             logger.error("Unable to find appropriate key")
             return False
@@ -60,114 +342,341 @@ def verify_google_jwt(token: str) -> bool:
             audience=GOOGLE_PROJECT_ID,
             issuer='https://accounts.google.com'
         )
+
+        # Never cache a token past its own expiry
+        ttl = VERIFIED_TOKEN_TTL
+        if payload.get('exp'):
+            ttl = min(ttl, payload['exp'] - time.time())
+        if ttl > 0:
+            _verified_tokens.set(token_hash, payload, ttl=ttl)
         
         return True
         
-    except PyJWTError as e:
+    except jwt.PyJWTError as e:
         logger.error(f"JWT verification failed: {e}")
         return False
     except Exception as e:
         logger.error(f"Unexpected error during JWT verification: {e}")
         return False
 
-def get_gmail_service():
-    """Create Gmail API service using service account credentials."""
+class GmailClientFactory(ingest_core.GmailClientFactory):
+    """ingest_core.GmailClientFactory whose counters are exported on /metrics."""
+
+    def render(self) -> List[str]:
+        """The number of cached mailboxes as a gauge, and the cache's counters."""
+        stats = self.stats()
+        return [
+            "# HELP gmail_client_cache_size Mailboxes with cached Gmail credentials.",
+            "# TYPE gmail_client_cache_size gauge",
+            f"gmail_client_cache_size {stats['size']}",
+            "# HELP gmail_client_cache_total Lookups of per-mailbox Gmail credentials, "
+            "and evictions and token refreshes.",
+            "# TYPE gmail_client_cache_total counter",
+            f'gmail_client_cache_total{{event="eviction"}} {stats["evictions"]}',
+            f'gmail_client_cache_total{{event="hit"}} {stats["hits"]}',
+            f'gmail_client_cache_total{{event="miss"}} {stats["misses"]}',
+            f'gmail_client_cache_total{{event="token_refresh"}} {stats["token_refreshes"]}',
+        ]
+
+_gmail_clients = GmailClientFactory()
+
+def get_gmail_service(email_address: Optional[str] = None):
+    """Return a Gmail API service acting as the mailbox's user, or as the service account."""
     try:
-        credentials_info = {
-            "type": "service_account",
-            "project_id": GOOGLE_PROJECT_ID,
-            "private_key_id": "",
-            "private_key": GOOGLE_PRIVATE_KEY,
-            "client_email": GOOGLE_CLIENT_EMAIL,
-            "client_id": "",
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs"
-        }
-        
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info,
-            scopes=['https://www.googleapis.com/auth/gmail.readonly']
-        )
-        
-        service = build('gmail', 'v1', credentials=credentials)
-        return service
-        
+        return _gmail_clients.service(email_address)
     except Exception as e:
         logger.error(f"Failed to create Gmail service: {e}")
         raise
 
+class HistoryReader(ingest_core.HistoryReader):
+    """HistoryReader whose Gmail calls count towards the gmail_history stage."""
+
+    def _execute(self, request) -> Dict[str, Any]:
+        with _stage_seconds.time('gmail_history'):
+            return request.execute()
+
+def iter_new_message_ids(service, user_email: str, history_id: str,
+                         resume_from: Optional[HistoryCheckpoint] = None) -> HistoryReader:
+    """Stream ids of messages added since history_id, oldest first."""
+    return HistoryReader(service, user_email, history_id, resume_from)
+
+def list_new_message_ids(service, user_email: str, history_id: str) -> List[str]:
+    """List ids of messages added since history_id, oldest first."""
+    return list(iter_new_message_ids(service, user_email, history_id))
+
+def _parse_raw_message(message: Dict[str, Any], message_id: str) -> Dict[str, Any]:
+    """
+    Turn a format='raw' messages.get response into the stored email dict.
+    
+    The message is decoded once, for the packer to reuse; only its header
+    block is parsed.
+    """
+    with _stage_seconds.time('mime_parse'):
+        raw_body = base64.urlsafe_b64decode(message['raw'])
+        headers = parse_headers(raw_body)
+    
+    return {
+        'raw_body': raw_body,
+        'headers': {key.lower(): value for key, value in headers.items()},
+        'message_id': message_id
+    }
+
+def load_raw_message(user_id: str, gmail_message_id: str) -> Optional[bytes]:
+    """Return the original raw message a user received under a Gmail message id, or None."""
+    with get_db_pool().connection() as conn:
+        row = conn.execute("""
+            SELECT e.raw_body, e.raw_parts, ARRAY(
+                SELECT b.content
+                FROM jsonb_array_elements(e.raw_parts) WITH ORDINALITY AS p(part, n)
+                JOIN email_blobs b ON b.hash = p.part->>1
+                ORDER BY p.n
+            )
+            FROM inbound_emails e
+            WHERE e.user_id = %s AND e.gmail_message_id = %s
+        """, (user_id, gmail_message_id)).fetchone()
+    if not row:
+        return None
+    return unpack_raw_message(row[0], row[1], row[2])
+
 def fetch_email_content(service, user_email: str, message_id: str) -> Dict[str, Any]:
     """Fetch full email content using Gmail API."""
     try:
         # Get the message in raw format
-        message = service.users().messages().get(
-            userId=user_email,
-            id=message_id,
-            format='raw'
-        ).execute()
-        
-        # Extract headers from the raw message
-        import base64
-        import email
-        
-        raw_data = base64.urlsafe_b64decode(message['raw'])
-        email_message = email.message_from_bytes(raw_data)
-        
-        # Extract headers
-        headers = {}
-        for key, value in email_message.items():
-            headers[key.lower()] = value
+        with _stage_seconds.time('gmail_get'):
+            message = service.users().messages().get(
+                userId=user_email,
+                id=message_id,
+                format='raw'
+            ).execute()
         
-        return {
-            'raw_body': message['raw'],
-            'headers': headers,
-            'message_id': message_id
-        }
+        return _parse_raw_message(message, message_id)
         
     except Exception as e:
         logger.error(f"Failed to fetch email content: {e}")
         raise
 
+def fetch_email_contents(service, user_email: str, message_ids: List[str]) -> List[Dict[str, Any]]:
+    """ingest_core.fetch_messages, timing the gmail_get stage."""
+    return ingest_core.fetch_messages(
+        service, user_email, message_ids, _parse_raw_message,
+        lambda seconds: _stage_seconds.observe('gmail_get', seconds)
+    )
+
+# email address -> auth.users id; mailboxes repeat constantly so most
+# notifications skip the lookup entirely.
+USER_ID_CACHE_TTL = int(os.environ.get('USER_ID_CACHE_TTL', 600))
+USER_ID_CACHE_SIZE = int(os.environ.get('USER_ID_CACHE_SIZE', 1000))
+
+_user_ids = TTLCache(maxsize=USER_ID_CACHE_SIZE, ttl=USER_ID_CACHE_TTL)
+
+def invalidate_user_id(email_address: Optional[str] = None) -> None:
+    """Forget the cached user id for an address, or for every address."""
+    if email_address is None:
+        _user_ids.clear()
+    else:
+        _user_ids.pop(email_address)
+
+class MailboxCursors(ingest_core.MailboxCursors):
+    """ingest_core.MailboxCursors on this service's connection pool."""
+
+    def connection(self):
+        return get_db_pool().connection()
+
+_mailbox_locks = KeyedLocks()
+_mailbox_cursors = MailboxCursors()
+
+def get_mailbox_cursor(email_address: str, min_history_id: Optional[int] = None) -> Optional[int]:
+    """Return the last fully processed history ID for a mailbox; see ingest_core.MailboxCursors."""
+    return _mailbox_cursors.get(email_address, min_history_id)
+
+def _pack_emails(emails: List[Dict[str, Any]], history_id: str) -> Tuple[List[tuple], Dict[str, bytes]]:
+    """
+    Pack emails into inbound_emails column values and the blobs they reference.
+    
+    Each row is (raw_body, raw_parts, headers, gmail_history, gmail_message_id).
+    """
+    rows = []
+    blobs: Dict[str, bytes] = {}
+    for email_data in emails:
+        packed = pack_raw_message(email_data['raw_body'])
+        blobs.update(packed.blobs)
+        rows.append((
+            packed.body,
+            json.dumps(packed.parts),
+            json.dumps(email_data['headers']),
+            history_id,
+            email_data['message_id']
+        ))
+    return rows, blobs
+
+class EmailWriter(ingest_core.EmailWriter):
+    """EmailWriter for this service's schema, connection pool and user id cache."""
+
+    def pack(self, emails: List[Dict[str, Any]], history_id: str) -> Tuple[List[tuple], Dict[str, bytes]]:
+        return _pack_emails(emails, history_id)
+
+    def connection(self):
+        return get_db_pool().connection()
+
+    def cached_user_id(self, mailbox: str) -> Optional[str]:
+        return _user_ids.get(mailbox)
+
+    def forget_user_id(self, mailbox: str) -> None:
+        invalidate_user_id(mailbox)
+
+_email_writer = EmailWriter()
+
+class StoreError(RuntimeError):
+    """Fetched emails could not be written to inbound_emails."""
+
+class UnknownUserError(StoreError):
+    """No user has the mailbox address, so replaying the push cannot help."""
+
+def store_emails_in_database(user_email: str, emails: List[Dict[str, Any]], history_id: str,
+                             cursor: Optional[int] = None) -> bool:
+    """
+    Store a batch of emails in the inbound_emails table through the shared write buffer.
+    
+    If cursor is given, the mailbox cursor moves forward to it in the same
+    statement. Transient database errors are raised, as is UnknownUserError
+    when no user has the address; any other failure is logged and returns False.
+    """
+    if not emails and cursor is None:
+        return True
+    try:
+        with _stage_seconds.time('db_insert'):
+            result = _email_writer.write(user_email, emails, history_id, cursor)
+    except Exception as e:
+        # Let the handler back off from an overloaded or unreachable database
+        if is_transient(e):
+            raise
+        logger.error(f"Database error: {e}")
+        return False
+    
+    if result.user_id is None:
+        raise UnknownUserError(f"User not found for email: {user_email}")
+    _user_ids.set(user_email, result.user_id)
+    if result.cursor is not None:
+        _mailbox_cursors.remember(user_email, result.cursor)
+    _emails_total.inc('inserted', len(result.inserted))
+    _emails_total.inc('duplicate', len(result.duplicates))
+    logger.info(
+        f"Stored {len(result.inserted)} new of {len(emails)} emails for user {user_email}, "
+        f"history_id: {history_id}"
+    )
+    return True
+
 def store_email_in_database(user_email: str, email_data: Dict[str, Any], history_id: str) -> bool:
     """Store email data in the inbound_emails table."""
     try:
-        with psycopg.connect(SUPABASE_DB_URL) as conn:
-            with conn.cursor() as cur:
-                # Find user_id based on email address
-                cur.execute(
-                    "SELECT id FROM auth.users WHERE email = %s",
-                    (user_email,)
-                )
-                user_result = cur.fetchone()
-                
-                if not user_result:
-                    logger.error(f"User not found for email: {user_email}")
-                    return False
-                
-                user_id = user_result[0]
-                
-                # Insert email data with conflict handling for idempotency
-                cur.execute("""
-                    INSERT INTO inbound_emails(
-                        id, user_id, raw_body, headers, gmail_history, arrived_at
-                    )
-                    VALUES(gen_random_uuid(), %s, %s, %s, %s, now())
-                    ON CONFLICT (gmail_history) DO NOTHING
-                """, (
-                    user_id,
-                    email_data['raw_body'],
-                    json.dumps(email_data['headers']),
-                    history_id
-                ))
-                
-                conn.commit()
-                logger.info(f"Email stored successfully for user {user_email}, history_id: {history_id}")
-                return True
-                
+        return store_emails_in_database(user_email, [email_data], history_id)
+    except UnknownUserError as e:
+        logger.error(str(e))
+        return False
+
+def ingest_mailbox(email_address: str, history_id: str) -> int:
+    """
+    Store every message added to a mailbox since its cursor, advancing it
+    in the same statement as the last of them.
+    
+    The caller must hold the mailbox's lock. Returns the number of messages
+    fetched; raises StoreError (UnknownUserError if no user has the address)
+    if they could not be stored and lets Gmail errors through, leaving the
+    cursor where it was in both cases.
+    """
+    # Skip pushes already covered by an earlier scan before any Gmail call
+    with _stage_seconds.time('cursor'):
+        cursor = get_mailbox_cursor(email_address, int(history_id))
+    if cursor is not None and int(history_id) <= cursor:
+        logger.info(f"History {history_id} already processed for {email_address} (cursor {cursor})")
+        return 0
+    
+    gmail_service = get_gmail_service(email_address)
+    
+    # Stream every message added since the last processed history ID and
+    # handle it one Gmail batch at a time, so a large gap never has to fit
+    # in memory at once
+    start_history_id = str(cursor) if cursor is not None else history_id
+    message_ids = iter_new_message_ids(gmail_service, email_address, start_history_id)
+    processed = 0
+    
+    for chunk, last in _chunked_last(message_ids, GMAIL_BATCH_SIZE):
+        emails = fetch_email_contents(gmail_service, email_address, chunk) if chunk else []
+        
+        # The reader is exhausted once the last chunk comes, so the cursor
+        # moves to the newest history Gmail reported along with its emails
+        advance_to = max(int(getattr(message_ids, 'history_id', None) or 0), int(history_id)) if last else None
+        if not store_emails_in_database(email_address, emails, history_id, advance_to):
+            raise StoreError(f"Failed to store emails for {email_address}")
+        processed += len(emails)
+    
+    if not processed:
+        logger.info("No messages found")
+    else:
+        logger.info(f"Processed {processed} emails successfully")
+    return processed
+
+# Load shedding. Pushes beyond the adaptive concurrency limit get a 429 and
+# transient Gmail or Postgres failures a 503, both with Retry-After, so
+# Pub/Sub backs off instead of redelivering into an overloaded service.
+CONCURRENCY_LIMIT_INITIAL = int(os.environ.get('CONCURRENCY_LIMIT_INITIAL', 20))
+CONCURRENCY_LIMIT_MIN = int(os.environ.get('CONCURRENCY_LIMIT_MIN', 2))
+CONCURRENCY_LIMIT_MAX = int(os.environ.get('CONCURRENCY_LIMIT_MAX', 200))
+OVERLOAD_RETRY_AFTER = int(os.environ.get('OVERLOAD_RETRY_AFTER', 5))
+
+_ingest_limiter = AdaptiveLimiter(CONCURRENCY_LIMIT_INITIAL, CONCURRENCY_LIMIT_MIN, CONCURRENCY_LIMIT_MAX)
+
+_dead_lettered_total = Counter(
+    'ingest_dead_lettered_total', 'Failed pushes recorded in ingest_failures and acknowledged.', 'error_class',
+    ('transient', 'permanent')
+)
+
+class IngestFailures(ingest_core.IngestFailures):
+    """ingest_core.IngestFailures on this service's connection pool."""
+
+    def connection(self):
+        return get_db_pool().connection()
+
+_ingest_failures = IngestFailures()
+
+def record_ingest_failure(email_address: str, history_id: str, error: BaseException) -> bool:
+    """
+    Persist a failed notification to ingest_failures for a later replay.
+
+    Returns False if it could not be recorded (or dead-lettering is off), in
+    which case the push has to be redelivered instead.
+    """
+    if not DEAD_LETTER_ENABLED:
+        return False
+    error_class = 'transient' if is_transient(error) else 'permanent'
+    try:
+        attempts = _ingest_failures.record(email_address, history_id, error, error_class)
     except Exception as e:
-        logger.error(f"Database error: {e}")
+        logger.error(f"Failed to record ingest failure for {email_address}: {e}")
         return False
+    _log_dead_letter(email_address, history_id, error, error_class, attempts)
+    return True
+
+def _log_dead_letter(email_address: str, history_id: Any, error: BaseException,
+                     error_class: str, attempts: int) -> None:
+    _dead_lettered_total.inc(error_class)
+    logger.warning(
+        f"Dead-lettered history {history_id} for {email_address} after {error_class} "
+        f"{type(error).__name__} (attempt {attempts}): {error}"
+    )
+
+def claim_ingest_failures(limit: int, lease: float, max_attempts: int) -> List[IngestFailure]:
+    """Claim up to limit failures that are due for another attempt; see ingest_core.IngestFailures.claim."""
+    return _ingest_failures.claim(limit, lease, max_attempts)
+
+def resolve_ingest_failure(email_address: str, history_id: int) -> None:
+    """Drop a mailbox's failure once history_id is stored, unless a newer one was recorded meanwhile."""
+    _ingest_failures.resolve(email_address, history_id)
+
+# Append every push envelope to this file for benchmarks/push_replay.py
+PUSH_RECORD_FILE = os.environ.get('PUSH_RECORD_FILE')
+
+_push_recorder = PushRecorder(PUSH_RECORD_FILE) if PUSH_RECORD_FILE else None
 
 @app.route('/handle_pubsub', methods=['POST'])
 def handle_pubsub():
@@ -175,6 +684,8 @@ def handle_pubsub():
     try:
         # Get the request data
         envelope = request.get_json()
+        if _push_recorder is not None:
+            _push_recorder.record(envelope, request.headers.get('Authorization'))
         
         if not envelope:
             logger.error("No JSON body received")
@@ -190,7 +701,9 @@ def handle_pubsub():
         # Verify JWT if present
         if 'attributes' in pubsub_message and 'jwt' in pubsub_message['attributes']:
             jwt_token = pubsub_message['attributes']['jwt']
-            if not verify_google_jwt(jwt_token):
+            with _stage_seconds.time('verify'):
+                verified = verify_google_jwt(jwt_token)
+            if not verified:
                 logger.error("JWT verification failed")
                 return jsonify({'error': 'Invalid JWT'}), 400
         
@@ -200,7 +713,8 @@ def handle_pubsub():
             return jsonify({'error': 'No data in message'}), 400
         
         import base64
-        message_data = json.loads(base64.b64decode(pubsub_message['data']).decode('utf-8'))
+        with _stage_seconds.time('extract'):
+            message_data = json.loads(base64.b64decode(pubsub_message['data']).decode('utf-8'))
         
         # Extract required fields
         history_id = message_data.get('historyId')
@@ -210,39 +724,47 @@ def handle_pubsub():
             logger.error(f"Missing required fields: historyId={history_id}, emailAddress={email_address}")
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Get Gmail service
-        gmail_service = get_gmail_service()
+        if not _ingest_limiter.acquire():
+            logger.warning(f"Concurrency limit {int(_ingest_limiter.limit)} reached, shedding push for {email_address}")
+            _rejected_total.inc('overloaded')
+            return jsonify({'error': 'Overloaded'}), 429, {'Retry-After': str(OVERLOAD_RETRY_AFTER)}
         
-        # Get the latest message for this user
-        # Note: In a real implementation, you'd use the history API to get specific messages
-        # For this example, we'll get the most recent message
+        latency = None
+        dropped = False
         try:
-            messages = gmail_service.users().messages().list(
-                userId=email_address,
-                labelIds=[GMAIL_WATCH_LABEL],
-                maxResults=1
-            ).execute()
-            
-            if not messages.get('messages'):
-                logger.info("No messages found")
-                return '', 204
-            
-            message_id = messages['messages'][0]['id']
-            
-            # Fetch email content
-            email_data = fetch_email_content(gmail_service, email_address, message_id)
-            
-            # Store in database
-            if store_email_in_database(email_address, email_data, history_id):
-                logger.info("Email processed successfully")
-                return '', 204
-            else:
-                logger.error("Failed to store email in database")
-                return jsonify({'error': 'Database error'}), 500
+            with _mailbox_locks.hold(email_address, timeout=MAILBOX_LOCK_TIMEOUT) as acquired:
+                if not acquired:
+                    logger.warning(f"History scan for {email_address} still running, asking for redelivery")
+                    _rejected_total.inc('mailbox_busy')
+                    return jsonify({'error': 'Mailbox busy'}), 503, {'Retry-After': str(OVERLOAD_RETRY_AFTER)}
                 
-        except Exception as e:
-            logger.error(f"Gmail API error: {e}")
-            return jsonify({'error': 'Gmail API error'}), 500
+                started = time.perf_counter()
+                try:
+                    ingest_mailbox(email_address, history_id)
+                    latency = time.perf_counter() - started
+                    return '', 204
+                except UnknownUserError as e:
+                    # Nothing to retry until the user signs up; acknowledge
+                    # without dead-lettering
+                    logger.warning(str(e))
+                    return '', 204
+                except Exception as e:
+                    dropped = is_transient(e)
+                    # Acknowledge once the failure is recorded; replay_failures.py
+                    # retries it at a controlled rate
+                    if record_ingest_failure(email_address, history_id, e):
+                        return '', 204
+                    if isinstance(e, StoreError):
+                        logger.error("Failed to store email in database")
+                        return jsonify({'error': 'Database error'}), 500
+                    if dropped:
+                        logger.warning(f"Transient error for {email_address}, asking for redelivery later: {e}")
+                        _rejected_total.inc('transient')
+                        return jsonify({'error': 'Temporarily unavailable'}), 503, {'Retry-After': str(retry_after(e))}
+                    logger.error(f"Gmail API error: {e}")
+                    return jsonify({'error': 'Gmail API error'}), 500
+        finally:
+            _ingest_limiter.release(latency, dropped)
         
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
@@ -251,8 +773,44 @@ def handle_pubsub():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({'status': 'healthy'}), 200
+    body = {'status': 'healthy'}
+    stats = db_pool_stats()
+    if stats:
+        body['db_pool'] = stats
+    return jsonify(body), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics endpoint."""
+    return render_metrics(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+# Build clients in the background once the server is up, so the first push
+# doesn't pay for imports, the token fetch and opening the pool
+WARM_UP = os.environ.get('WARM_UP', 'false').lower() == 'true'
+
+def warm_up() -> None:
+    """Import the deferred modules and build the Gmail, JWKS and database clients."""
+    steps = [
+        ('imports', lambda: [module.load() for module in _DEFERRED_MODULES]),
+        ('Google certs', _jwks_cache.refresh),
+    ]
+    if GOOGLE_PRIVATE_KEY:
+        steps.append(('Gmail client', _gmail_clients.prepare))
+    if SUPABASE_DB_URL:
+        steps.append(('database pool', get_db_pool))
+    ingest_core.warm_up(steps)
+
+def start_warm_up() -> threading.Thread:
+    """
+    Run warm_up() on a daemon thread, once per process.
+
+    Call it after the port is bound, e.g. from gunicorn's post_worker_init.
+    """
+    return ingest_core.start_warm_up(warm_up)
 
 if __name__ == '__main__':
+    if WARM_UP:
+        # Binding the port below takes milliseconds; the warm-up runs alongside
+        start_warm_up()
     # For local development
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=False)
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Replay notifications dead-lettered in ingest_failures.
+
+When a push can't be ingested, the handler records the mailbox and history
+ID in ingest_failures and acknowledges the push, so an outage doesn't turn
+into a redelivery storm. This command works through the rows that are due,
+in parallel batches at a bounded rate. Each row gets a history scan from the
+mailbox cursor, as the original push would have. Stored rows are deleted.
+Failed ones are recorded again with their attempt count raised and the next
+attempt pushed back exponentially. It stops early when consecutive replays
+keep failing transiently, since the dependency hasn't recovered yet.
+
+Run with:
+    python replay_failures.py [--target service|function] [--rate 5] [--workers 8]
+    python replay_failures.py --status
+
+--target function replays with the Cloud Function's main.py from the
+repository root, for deployments that write its inbound_emails schema.
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGET_DIRS = {
+    'service': SERVICE_DIR,
+    'function': os.path.dirname(SERVICE_DIR),
+}
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1/rate seconds apart; a rate of 0 means no limit."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+            now = self._next
+        self._next = now + self.interval
+
+def load_target(target: str) -> ModuleType:
+    """Import the main module of the service or of the Cloud Function."""
+    directory = TARGET_DIRS[target]
+    if directory in sys.path:
+        sys.path.remove(directory)
+    sys.path.insert(0, directory)
+    ingest = importlib.import_module('main')
+    if hasattr(ingest, 'validate_env'):
+        ingest.validate_env()
+    return ingest
+
+def replay_one(ingest: ModuleType, failure) -> str:
+    """
+    Replay one dead-lettered notification; returns 'resolved', 'transient',
+    'permanent' or 'busy'.
+
+    The scan holds the mailbox lock pushes take, so it never overlaps one in
+    the same process. Scans from other processes are safe to overlap, since
+    stores are idempotent and the cursor only moves forward. A mailbox still
+    locked after MAILBOX_LOCK_TIMEOUT is left to come due again.
+    """
+    with ingest._mailbox_locks.hold(failure.email_address, timeout=ingest.MAILBOX_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            logger.warning(f"History scan for {failure.email_address} still running, replaying it later")
+            return 'busy'
+        try:
+            ingest.ingest_mailbox(failure.email_address, str(failure.history_id))
+        except ingest.UnknownUserError as e:
+            # Nothing to retry until the user signs up; drop it as the push handler does
+            logger.warning(f"Dropping history {failure.history_id} for {failure.email_address}: {e}")
+        except Exception as e:
+            outcome = 'transient' if ingest.is_transient(e) else 'permanent'
+            if not ingest.record_ingest_failure(failure.email_address, str(failure.history_id), e):
+                logger.error(f"Replay of {failure.email_address} failed and could not be recorded: {e}")
+            return outcome
+        else:
+            logger.info(f"Replayed history {failure.history_id} for {failure.email_address} "
+                        f"after {failure.attempts} failed attempts")
+    ingest.resolve_ingest_failure(failure.email_address, failure.history_id)
+    return 'resolved'
+
+def replay(ingest: ModuleType, batch_size: int = 50, workers: int = 8, rate: float = 5.0,
+           lease: float = 300.0, max_attempts: int = 10, limit: Optional[int] = None,
+           stop_after: int = 20) -> Counter:
+    """
+    Replay due failures until none are left, limit rows were tried, or
+    stop_after replays in a row failed transiently. Returns outcome counts.
+    """
+    limiter = RateLimiter(rate)
+    results: Counter = Counter()
+    consecutive_transient = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while limit is None or sum(results.values()) < limit:
+            claim = batch_size if limit is None else min(batch_size, limit - sum(results.values()))
+            failures = ingest.claim_ingest_failures(claim, lease, max_attempts)
+            if not failures:
+                break
+            futures = []
+            for failure in failures:
+                limiter.wait()
+                futures.append(executor.submit(replay_one, ingest, failure))
+            for future in futures:
+                outcome = future.result()
+                results[outcome] += 1
+                consecutive_transient = consecutive_transient + 1 if outcome == 'transient' else 0
+            if stop_after and consecutive_transient >= stop_after:
+                logger.warning(f"{consecutive_transient} replays in a row failed transiently, stopping")
+                break
+    return results
+
+def print_status(ingest: ModuleType, max_attempts: int) -> None:
+    """Print dead-lettered notifications by error class and whether they are due, waiting or parked."""
+    with ingest.get_db_pool().connection() as conn:
+        rows = conn.execute("""
+            SELECT error_class,
+                   CASE WHEN attempts >= %s THEN 'parked'
+                        WHEN next_attempt_at <= now() THEN 'due'
+                        ELSE 'waiting' END AS state,
+                   count(*), max(attempts), min(first_failed_at)
+            FROM ingest_failures
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """, (max_attempts,)).fetchall()
+    print(f"{'class':<10} {'state':<8} {'mailboxes':>9} {'max attempts':>12}  oldest")
+    for error_class, state, count, attempts, oldest in rows:
+        print(f"{error_class:<10} {state:<8} {count:>9} {attempts:>12}  {oldest:%Y-%m-%d %H:%M}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--target', choices=sorted(TARGET_DIRS), default='service')
+    parser.add_argument('--batch-size', type=int, default=50, help='rows claimed at a time')
+    parser.add_argument('--workers', type=int, default=8, help='replays run in parallel')
+    parser.add_argument('--rate', type=float, default=5.0, help='replays started per second; 0 for no limit')
+    parser.add_argument('--lease', type=float, default=300.0,
+                        help='seconds before a claimed row is due again if this run dies')
+    parser.add_argument('--max-attempts', type=int, default=10,
+                        help='rows that failed this often are parked for inspection')
+    parser.add_argument('--limit', type=int, help='most rows to replay')
+    parser.add_argument('--stop-after', type=int, default=20,
+                        help='stop after this many transient failures in a row; 0 never stops')
+    parser.add_argument('--status', action='store_true', help='summarize ingest_failures and exit')
+    args = parser.parse_args()
+
+    ingest = load_target(args.target)
+    if args.status:
+        print_status(ingest, args.max_attempts)
+        return
+
+    results = replay(
+        ingest, batch_size=args.batch_size, workers=args.workers, rate=args.rate, lease=args.lease,
+        max_attempts=args.max_attempts, limit=args.limit, stop_after=args.stop_after
+    )
+    logger.info(
+        f"Replayed {sum(results.values())}: {results['resolved']} resolved, "
+        f"{results['transient']} transient and {results['permanent']} permanent failures, "
+        f"{results['busy']} mailboxes busy"
+    )
+    sys.exit(1 if results['transient'] or results['permanent'] else 0)
+
+if __name__ == '__main__':
+    main()
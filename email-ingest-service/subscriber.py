@@ -0,0 +1,233 @@
+"""
+Pub/Sub streaming-pull consumer for email ingest.
+
+An alternative to the /handle_pubsub push endpoint for high volume: one
+streaming pull replaces an HTTP request per notification. Messages are
+collected into batches, the notifications of a batch are folded into one
+history scan per mailbox, and the whole batch is acknowledged together
+once its emails are stored. Flow control bounds the messages and bytes held
+by the process, and the client library keeps extending their leases (up to
+SUBSCRIBER_MAX_LEASE seconds) while slow Gmail fetches run.
+
+Run with:
+    PUBSUB_SUBSCRIPTION=gmail-notifications-sub python subscriber.py
+
+Set PUBSUB_EMULATOR_HOST=localhost:8085 to consume from the local emulator.
+"""
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from google.cloud import pubsub_v1
+
+from main import (
+    GOOGLE_PROJECT_ID, MAILBOX_LOCK_TIMEOUT, UnknownUserError, _mailbox_locks, ingest_mailbox,
+    record_ingest_failure,
+)
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_SUBSCRIPTION = os.environ.get('PUBSUB_SUBSCRIPTION', 'gmail-notifications-sub')
+
+# Flow control: messages and bytes held (leased but not yet acked) at once
+SUBSCRIBER_MAX_MESSAGES = int(os.environ.get('SUBSCRIBER_MAX_MESSAGES', 1000))
+SUBSCRIBER_MAX_BYTES = int(os.environ.get('SUBSCRIBER_MAX_BYTES', 10 * 1024 * 1024))
+# Longest a message's lease is extended before Pub/Sub redelivers it
+SUBSCRIBER_MAX_LEASE = int(os.environ.get('SUBSCRIBER_MAX_LEASE', 600))
+# Smallest lease extension; keeps modacks rare while a slow scan runs
+SUBSCRIBER_MIN_LEASE_EXTENSION = int(os.environ.get('SUBSCRIBER_MIN_LEASE_EXTENSION', 60))
+
+# A batch is processed once it has SUBSCRIBER_BATCH_SIZE messages or its
+# first message has waited SUBSCRIBER_BATCH_WAIT seconds
+SUBSCRIBER_BATCH_SIZE = int(os.environ.get('SUBSCRIBER_BATCH_SIZE', 100))
+SUBSCRIBER_BATCH_WAIT = float(os.environ.get('SUBSCRIBER_BATCH_WAIT', 0.5))
+# Mailboxes of one batch scanned in parallel
+SUBSCRIBER_WORKERS = int(os.environ.get('SUBSCRIBER_WORKERS', 8))
+
+def _parse_notification(message) -> Optional[Tuple[str, int]]:
+    """Return (email_address, history_id) from a Gmail notification, or None."""
+    try:
+        data = json.loads(message.data.decode('utf-8'))
+        return data['emailAddress'], int(data['historyId'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _ingest(email_address: str, history_id: int) -> bool:
+    with _mailbox_locks.hold(email_address, timeout=MAILBOX_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            logger.warning(f"History scan for {email_address} still running, redelivering")
+            return False
+        try:
+            ingest_mailbox(email_address, str(history_id))
+            return True
+        except UnknownUserError as e:
+            # Nothing to retry until the user signs up
+            logger.warning(str(e))
+            return True
+        except Exception as e:
+            # Ack once dead-lettered; replay_failures.py retries it
+            if record_ingest_failure(email_address, str(history_id), e):
+                return True
+            logger.error(f"Failed to ingest history {history_id} for {email_address}: {e}")
+            return False
+
+def process_batch(messages: List, executor: ThreadPoolExecutor,
+                  ingest: Callable[[str, int], bool] = _ingest) -> None:
+    """
+    Ingest a batch of notifications, one history scan per mailbox.
+
+    Messages of mailboxes that were stored are acked together; those of
+    mailboxes that failed are nacked for redelivery. Malformed messages are
+    acked, since redelivering them cannot help.
+    """
+    mailboxes: Dict[str, list] = {}
+    done = []
+    for message in messages:
+        notification = _parse_notification(message)
+        if notification is None:
+            logger.error(f"Dropping malformed notification {message.message_id}")
+            done.append(message)
+            continue
+        email_address, history_id = notification
+        entry = mailboxes.setdefault(email_address, [history_id, []])
+        entry[0] = max(entry[0], history_id)
+        entry[1].append(message)
+
+    results = executor.map(
+        lambda item: (item[1][1], ingest(item[0], item[1][0])),
+        mailboxes.items()
+    )
+    failed = []
+    for mailbox_messages, ok in results:
+        (done if ok else failed).extend(mailbox_messages)
+
+    # The client's dispatcher sends these as batched ack/modack requests
+    for message in done:
+        message.ack()
+    for message in failed:
+        message.nack()
+    logger.info(
+        f"Processed {len(messages)} notifications for {len(mailboxes)} mailboxes: "
+        f"{len(done)} acked, {len(failed)} nacked"
+    )
+
+class NotificationBatcher:
+    """
+    Collects messages from the subscriber's callback threads into batches.
+
+    A single thread processes one batch at a time, which bounds the Gmail and
+    database load regardless of how many messages flow control lets in.
+    """
+
+    def __init__(self, batch_size: int = SUBSCRIBER_BATCH_SIZE,
+                 max_wait: float = SUBSCRIBER_BATCH_WAIT,
+                 workers: int = SUBSCRIBER_WORKERS,
+                 process: Callable = process_batch):
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._process = process
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+        self._condition = threading.Condition()
+        self._messages: List = []
+        self._first_at = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='notification-batcher', daemon=True)
+        self._thread.start()
+
+    def add(self, message) -> None:
+        """Subscriber callback: queue a message for the next batch."""
+        with self._condition:
+            if self._closed:
+                message.nack()
+                return
+            if not self._messages:
+                # Wake the batch thread to start the max_wait clock
+                self._first_at = time.monotonic()
+                self._condition.notify()
+            self._messages.append(message)
+            if len(self._messages) >= self._batch_size:
+                self._condition.notify()
+
+    def close(self) -> None:
+        """Stop taking messages, process what is buffered and wait for it."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def _next_batch(self) -> List:
+        with self._condition:
+            while True:
+                if len(self._messages) >= self._batch_size or (self._closed and self._messages):
+                    break
+                if self._closed:
+                    return []
+                if self._messages:
+                    remaining = self._first_at + self._max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+            batch = self._messages[:self._batch_size]
+            self._messages = self._messages[self._batch_size:]
+            self._first_at = time.monotonic()
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self._process(batch, self._executor)
+            except Exception as e:
+                logger.error(f"Failed to process batch of {len(batch)} notifications: {e}")
+                for message in batch:
+                    message.nack()
+
+def subscription_path(subscription: str) -> str:
+    """Accept either a full subscription path or a name in GOOGLE_PROJECT_ID."""
+    if subscription.startswith('projects/'):
+        return subscription
+    return pubsub_v1.SubscriberClient.subscription_path(GOOGLE_PROJECT_ID, subscription)
+
+def run(subscription: str = PUBSUB_SUBSCRIPTION) -> None:
+    """Consume notifications until SIGTERM or SIGINT, then flush and exit."""
+    subscriber = pubsub_v1.SubscriberClient()
+    batcher = NotificationBatcher()
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=SUBSCRIBER_MAX_MESSAGES,
+        max_bytes=SUBSCRIBER_MAX_BYTES,
+        max_lease_duration=SUBSCRIBER_MAX_LEASE,
+        min_duration_per_lease_extension=SUBSCRIBER_MIN_LEASE_EXTENSION
+    )
+    path = subscription_path(subscription)
+    future = subscriber.subscribe(path, callback=batcher.add, flow_control=flow_control)
+    logger.info(f"Listening on {path}")
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    with subscriber:
+        while not stopping.wait(1):
+            if future.done():
+                break
+        # Finish (and ack) buffered work while the stream is still open
+        batcher.close()
+        future.cancel()
+        try:
+            future.result(timeout=30)
+        except Exception as e:
+            logger.info(f"Subscriber stopped: {e!r}")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,281 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from starlette.testclient import TestClient
+
+# Add the parent directory to the path so we can import asgi
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asgi
+import ingest_core
+import main
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """Clear process-wide caches so tests don't leak state into each other."""
+    main._user_ids.clear()
+    main._mailbox_cursors.clear()
+    ingest_core._label_ids.clear()
+    yield
+
+@pytest.fixture
+def client():
+    """Run the ASGI app with its lifespan, without a real database."""
+    pool = MagicMock()
+    pool.close = AsyncMock()
+    with patch('asgi.get_async_db_pool', new=AsyncMock(return_value=pool)), \
+         patch('asgi._async_db_pool', pool):
+        with TestClient(asgi.app) as client:
+            yield client
+
+def _envelope(history_id='12345', email_address='test@example.com'):
+    data = json.dumps({'historyId': history_id, 'emailAddress': email_address})
+    return {'message': {'data': base64.b64encode(data.encode()).decode()}}
+
+class TestAsyncHandler:
+    """Test the ASGI push handler."""
+
+    @patch('asgi.process_notification', new_callable=AsyncMock)
+    def test_acks_and_processes_in_background(self, mock_process, client):
+        """Test that a push is acknowledged and then processed by a worker."""
+        response = client.post('/handle_pubsub', json=_envelope())
+
+        assert response.status_code == 204
+        client.portal.call(asyncio.sleep, 0.05)
+        mock_process.assert_awaited_once()
+        assert mock_process.call_args[0][1:] == ('test@example.com', 12345)
+
+    def test_rejects_missing_fields(self, client):
+        """Test that malformed pushes are rejected before queueing."""
+        response = client.post('/handle_pubsub', json=_envelope(history_id=None))
+
+        assert response.status_code == 400
+        assert asgi._ingest_queue.stats()['queued'] == 0
+
+    def test_rejects_invalid_history_id(self, client):
+        """Test that a non-numeric historyId is rejected instead of failing with a 500."""
+        response = client.post('/handle_pubsub', json=_envelope(history_id='abc'))
+
+        assert response.status_code == 400
+        assert asgi._ingest_queue.stats()['queued'] == 0
+
+    @patch('asgi.verify_google_jwt', return_value=False)
+    def test_rejects_invalid_jwt(self, mock_verify, client):
+        """Test that a push with a bad JWT is rejected."""
+        envelope = _envelope()
+        envelope['message']['attributes'] = {'jwt': 'bad'}
+
+        response = client.post('/handle_pubsub', json=envelope)
+
+        assert response.status_code == 400
+        mock_verify.assert_called_once_with('bad')
+
+    def test_queue_full_returns_503(self, client):
+        """Test that a full queue asks Pub/Sub to redeliver."""
+        with patch.object(asgi._ingest_queue, 'submit', return_value=False):
+            response = client.post('/handle_pubsub', json=_envelope())
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(asgi.OVERLOAD_RETRY_AFTER)
+
+    def test_health_reports_queue(self, client):
+        """Test that /health reports queue depth and workers."""
+        asgi._async_db_pool.get_stats.return_value = {'pool_size': 1}
+
+        body = client.get('/health').json()
+
+        assert body['status'] == 'healthy'
+        assert body['queue']['workers'] == asgi.ASYNC_WORKERS
+        assert body['db_pool'] == {'pool_size': 1}
+
+class TestAsyncDbPool:
+    """Test the lazily opened async pool."""
+
+    @patch('asgi._async_db_pool', None)
+    @patch('asgi.AsyncConnectionPool')
+    def test_concurrent_first_use_opens_one_pool(self, mock_pool_cls):
+        """Test that concurrent first requests share one pool."""
+        async def slow_open():
+            await asyncio.sleep(0.01)
+        mock_pool_cls.return_value.open = AsyncMock(side_effect=slow_open)
+
+        async def first_requests():
+            return await asyncio.gather(*(asgi.get_async_db_pool() for _ in range(5)))
+
+        pools = asyncio.run(first_requests())
+
+        mock_pool_cls.assert_called_once()
+        assert all(pool is mock_pool_cls.return_value for pool in pools)
+
+class TestIngestQueue:
+    """Test queueing, coalescing and drain-on-shutdown."""
+
+    def test_coalesces_pushes_for_queued_mailbox(self):
+        """Test that pushes for an already queued mailbox keep one entry at the highest history ID."""
+        async def run():
+            queue = asgi.IngestQueue(MagicMock(), workers=1, maxsize=10)
+            assert queue.submit('a@example.com', 5)
+            assert queue.submit('a@example.com', 9)
+            assert queue.submit('a@example.com', 7)
+            assert queue.submit('b@example.com', 3)
+            return queue.stats()['queued'], dict(queue._pending)
+
+        queued, pending = asyncio.run(run())
+
+        assert queued == 2
+        assert pending == {'a@example.com': 9, 'b@example.com': 3}
+
+    def test_full_queue_rejects(self):
+        """Test that submit fails once maxsize mailboxes are queued."""
+        async def run():
+            queue = asgi.IngestQueue(MagicMock(), workers=1, maxsize=1)
+            return queue.submit('a@example.com', 1), queue.submit('b@example.com', 1)
+
+        assert asyncio.run(run()) == (True, False)
+
+    @patch('asgi.process_notification', new_callable=AsyncMock)
+    def test_drain_flushes_queued_work(self, mock_process):
+        """Test that drain finishes queued notifications and then refuses new ones."""
+        async def run():
+            queue = asgi.IngestQueue(MagicMock(), workers=2, maxsize=10)
+            queue.start()
+            for i in range(5):
+                queue.submit(f'user{i}@example.com', i + 1)
+            await queue.drain(timeout=5)
+            return queue.submit('late@example.com', 1)
+
+        accepted_after_drain = asyncio.run(run())
+
+        assert mock_process.await_count == 5
+        assert accepted_after_drain is False
+
+    @patch('asgi.record_ingest_failure_async', new_callable=AsyncMock, return_value=True)
+    @patch('asgi.process_notification', new_callable=AsyncMock, side_effect=RuntimeError('boom'))
+    def test_worker_survives_failures(self, mock_process, mock_record):
+        """Test that a failed notification is dead-lettered and does not stop the worker."""
+        async def run():
+            queue = asgi.IngestQueue(MagicMock(), workers=1, maxsize=10)
+            queue.start()
+            queue.submit('a@example.com', 1)
+            queue.submit('b@example.com', 2)
+            await queue.drain(timeout=5)
+
+        asyncio.run(run())
+
+        assert mock_process.await_count == 2
+        assert [c[0][:2] for c in mock_record.await_args_list] == [('a@example.com', 1), ('b@example.com', 2)]
+
+    def test_transient_classifies_async_gmail_errors(self):
+        """Test that throttled or failed async Gmail calls count as transient."""
+        import httpx
+        assert asgi._is_transient(asgi.GmailHTTPError(429, 'rate limited'))
+        assert not asgi._is_transient(asgi.GmailHTTPError(403, 'forbidden'))
+        assert asgi._is_transient(httpx.ConnectTimeout('timed out'))
+
+class TestProcessNotification:
+    """Test the async history scan."""
+
+    def _gmail(self, responses):
+        gmail = MagicMock()
+
+        responses.setdefault('labels', {'labels': [{'id': 'Label_7', 'name': 'school-events'}]})
+        calls = gmail.calls = []
+
+        async def get(user_email, path, **params):
+            calls.append((path, params))
+            result = responses[path]
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        gmail.get = get
+        return gmail
+
+    @patch('asgi.store_emails_async', new_callable=AsyncMock, return_value=True)
+    @patch('asgi.get_mailbox_cursor_async', new_callable=AsyncMock, return_value=None)
+    def test_fetches_and_stores_history(self, mock_cursor, mock_store):
+        """Test that added messages are fetched, stored and the cursor advanced."""
+        raw = base64.urlsafe_b64encode(b'Subject: Hi\r\n\r\nbody').decode()
+        gmail = self._gmail({
+            'history': {
+                'historyId': '200',
+                'history': [
+                    {'messagesAdded': [{'message': {'id': 'm1'}}]},
+                    {'messagesAdded': [{'message': {'id': 'm2'}}, {'message': {'id': 'm1'}}]},
+                ]
+            },
+            'messages/m1': {'raw': raw},
+            'messages/m2': asgi.GmailHTTPError(404, 'gone'),
+        })
+
+        processed = asyncio.run(asgi.process_notification(gmail, 'test@example.com', 150))
+
+        assert processed == 1
+        emails = mock_store.call_args[0][1]
+        assert [e['message_id'] for e in emails] == ['m1']
+        assert emails[0]['headers'] == {'subject': 'Hi'}
+        # The cursor moves to the newest history in the same store
+        assert mock_store.call_args[0][3] == 200
+        assert [params['labelId'] for path, params in gmail.calls if path == 'history'] == ['Label_7']
+
+    @patch('asgi.store_emails_async', new_callable=AsyncMock)
+    @patch('asgi.get_mailbox_cursor_async', new_callable=AsyncMock, return_value=300)
+    def test_skips_history_covered_by_cursor(self, mock_cursor, mock_store):
+        """Test that pushes at or below the cursor make no Gmail calls."""
+        gmail = self._gmail({})
+
+        assert asyncio.run(asgi.process_notification(gmail, 'test@example.com', 250)) == 0
+        assert gmail.calls == []
+        mock_store.assert_not_awaited()
+
+    @patch('asgi.store_emails_async', new_callable=AsyncMock, return_value=False)
+    @patch('asgi.get_mailbox_cursor_async', new_callable=AsyncMock, return_value=None)
+    def test_store_failure_keeps_cursor(self, mock_cursor, mock_store):
+        """Test that a failed store leaves the cursor for the next push to retry."""
+        raw = base64.urlsafe_b64encode(b'Subject: Hi\r\n\r\nbody').decode()
+        gmail = self._gmail({
+            'history': {'historyId': '200', 'history': [
+                {'messagesAdded': [{'message': {'id': 'm1'}}, {'message': {'id': 'm2'}}]}
+            ]},
+            'messages/m1': {'raw': raw},
+            'messages/m2': {'raw': raw},
+        })
+
+        with patch('asgi.GMAIL_BATCH_SIZE', 1), pytest.raises(RuntimeError):
+            asyncio.run(asgi.process_notification(gmail, 'test@example.com', 150))
+        # The scan stopped at the first batch, which doesn't move the cursor
+        mock_store.assert_awaited_once()
+        assert mock_store.call_args[0][3] is None
+
+    def test_transient_store_error_is_raised(self):
+        """Test that an unreachable database is raised instead of reported as a failed store."""
+        import psycopg
+        raw = b'Subject: Hi\r\n\r\nbody'
+        emails = [{'raw_body': raw, 'headers': {}, 'message_id': 'm1'}]
+        error = psycopg.OperationalError('connection refused')
+
+        with patch('asgi.get_async_db_pool', new=AsyncMock(side_effect=error)):
+            with pytest.raises(psycopg.OperationalError):
+                asyncio.run(asgi.store_emails_async('test@example.com', emails, '150'))
+        with patch('asgi.get_async_db_pool', new=AsyncMock(side_effect=ValueError('bad row'))):
+            assert asyncio.run(asgi.store_emails_async('test@example.com', emails, '150')) is False
+
+    @patch('asgi.store_emails_async', new_callable=AsyncMock, return_value=True)
+    @patch('asgi.get_mailbox_cursor_async', new_callable=AsyncMock, return_value=None)
+    def test_mailbox_without_label_is_not_scanned(self, mock_cursor, mock_store):
+        """Test that a mailbox lacking the watched label makes no history calls."""
+        gmail = self._gmail({'labels': {'labels': [{'id': 'INBOX', 'name': 'INBOX'}]}})
+
+        assert asyncio.run(asgi.process_notification(gmail, 'test@example.com', 150)) == 0
+        assert asyncio.run(asgi.process_notification(gmail, 'test@example.com', 160)) == 0
+        assert [path for path, params in gmail.calls] == ['labels']
+        # Nothing is stored, but each empty scan still moves the cursor
+        assert [(c[0][1], c[0][3]) for c in mock_store.await_args_list] == [([], 150), ([], 160)]
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -1,6 +1,7 @@
 import json
 import base64
 import pytest
+from datetime import datetime, timedelta
 from unittest.mock import Mock, patch, MagicMock
 import sys
 import os
@@ -8,8 +9,33 @@ import os
 # Add the parent directory to the path so we can import main
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import ingest_core
+import main
 from main import app, verify_google_jwt, get_gmail_service, fetch_email_content, store_email_in_database
 
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """Clear process-wide caches so tests don't leak state into each other."""
+    main._jwks_cache.clear()
+    main._verified_tokens.clear()
+    main._gmail_clients.reset()
+    main._user_ids.clear()
+    main._mailbox_cursors.clear()
+    ingest_core._label_ids.clear()
+    yield
+
+def labelled_service(labels=({'id': 'Label_7', 'name': 'school-events'},)):
+    """A mock Gmail service whose mailbox has the given labels."""
+    service = Mock()
+    service.users().labels().list().execute.return_value = {'labels': list(labels)}
+    return service
+
+@pytest.fixture
+def no_cursor():
+    """Stub out mailbox_cursors so the handler scans from the push's history ID."""
+    with patch('main.get_mailbox_cursor', return_value=None) as mock_get:
+        yield mock_get
+
 @pytest.fixture
 def client():
     """Create a test client for the Flask app."""
@@ -40,7 +66,7 @@ def sample_pubsub_message():
 def sample_email_data():
     """Sample email data from Gmail API."""
     return {
-        'raw_body': 'base64encodedrawemailcontent',
+        'raw_body': b'raw email content',
         'headers': {
             'from': 'sender@example.com',
             'to': 'test@example.com',
@@ -74,6 +100,7 @@ class TestJWTVerification:
                 }
             ]
         }
+        mock_response.headers = {'Cache-Control': 'public, max-age=21600'}
         mock_get.return_value = mock_response
         
         # Mock successful JWT decode
@@ -104,6 +131,7 @@ class TestJWTVerification:
                 }
             ]
         }
+        mock_response.headers = {'Cache-Control': 'public, max-age=21600'}
         mock_get.return_value = mock_response
         
         # Mock JWT decode raising an exception
@@ -114,15 +142,88 @@ class TestJWTVerification:
             result = verify_google_jwt('invalid.jwt.token')
             assert result is False
 
+    @patch('requests.get')
+    @patch('jwt.algorithms.RSAAlgorithm.from_jwk')
+    @patch('jwt.decode')
+    @patch('jwt.get_unverified_header')
+    def test_verify_google_jwt_caches_keys(self, mock_header, mock_decode, mock_from_jwk, mock_get):
+        """Test that Google's keys are fetched once and reused across tokens."""
+        mock_header.return_value = {'kid': 'test-key-id'}
+        mock_response = Mock()
+        mock_response.json.return_value = {'keys': [{'kid': 'test-key-id', 'kty': 'RSA'}]}
+        mock_response.headers = {'Cache-Control': 'public, max-age=21600'}
+        mock_get.return_value = mock_response
+        mock_decode.return_value = {'aud': 'test-project'}
+        
+        assert verify_google_jwt('first.jwt.token') is True
+        assert verify_google_jwt('second.jwt.token') is True
+        
+        mock_get.assert_called_once()
+        mock_from_jwk.assert_called_once()
+        assert mock_decode.call_count == 2
+
+    @patch('requests.get')
+    @patch('jwt.algorithms.RSAAlgorithm.from_jwk')
+    @patch('jwt.decode')
+    @patch('jwt.get_unverified_header')
+    def test_verify_google_jwt_caches_verified_tokens(self, mock_header, mock_decode, mock_from_jwk, mock_get):
+        """Test that a redelivered token skips signature verification."""
+        mock_header.return_value = {'kid': 'test-key-id'}
+        mock_response = Mock()
+        mock_response.json.return_value = {'keys': [{'kid': 'test-key-id', 'kty': 'RSA'}]}
+        mock_response.headers = {}
+        mock_get.return_value = mock_response
+        mock_decode.return_value = {'aud': 'test-project'}
+        
+        assert verify_google_jwt('same.jwt.token') is True
+        assert verify_google_jwt('same.jwt.token') is True
+        
+        mock_decode.assert_called_once()
+
+    @patch('requests.get')
+    @patch('jwt.algorithms.RSAAlgorithm.from_jwk')
+    @patch('jwt.decode')
+    @patch('jwt.get_unverified_header')
+    def test_verify_google_jwt_expired_token_not_cached(self, mock_header, mock_decode, mock_from_jwk, mock_get):
+        """Test that tokens past their expiry are never served from the cache."""
+        mock_header.return_value = {'kid': 'test-key-id'}
+        mock_response = Mock()
+        mock_response.json.return_value = {'keys': [{'kid': 'test-key-id', 'kty': 'RSA'}]}
+        mock_response.headers = {}
+        mock_get.return_value = mock_response
+        mock_decode.return_value = {'aud': 'test-project', 'exp': 1}
+        
+        verify_google_jwt('old.jwt.token')
+        verify_google_jwt('old.jwt.token')
+        
+        assert mock_decode.call_count == 2
+
+    @patch('requests.get')
+    @patch('jwt.algorithms.RSAAlgorithm.from_jwk')
+    @patch('jwt.get_unverified_header')
+    def test_verify_google_jwt_unknown_kid_refreshes_once(self, mock_header, mock_from_jwk, mock_get):
+        """Test that an unknown kid triggers a single throttled refresh."""
+        mock_header.return_value = {'kid': 'rotated-key-id'}
+        mock_response = Mock()
+        mock_response.json.return_value = {'keys': [{'kid': 'test-key-id', 'kty': 'RSA'}]}
+        mock_response.headers = {}
+        mock_get.return_value = mock_response
+        
+        assert verify_google_jwt('first.jwt.token') is False
+        assert verify_google_jwt('second.jwt.token') is False
+        
+        mock_get.assert_called_once()
+
 class TestGmailAPI:
     """Test Gmail API functionality."""
     
     @patch('main.service_account.Credentials.from_service_account_info')
-    @patch('main.build')
+    @patch('main.discovery.build_from_document')
     def test_get_gmail_service(self, mock_build, mock_credentials):
         """Test Gmail service creation."""
         mock_service = Mock()
         mock_build.return_value = mock_service
+        mock_credentials.return_value.expiry = None
         
         with patch.dict(os.environ, {
             'GOOGLE_PROJECT_ID': 'test-project',
@@ -131,55 +232,325 @@ class TestGmailAPI:
         }):
             service = get_gmail_service()
             assert service == mock_service
+            # Built from the bundled discovery document, not fetched
+            assert mock_build.call_args[0][0]['name'] == 'gmail'
+
+    @patch('main.service_account.Credentials.from_service_account_info')
+    @patch('main.discovery.build_from_document')
+    def test_get_gmail_service_reuses_client(self, mock_build, mock_credentials):
+        """Test that credentials and the service are reused across requests."""
+        mock_creds = Mock()
+        mock_creds.token = 'access-token'
+        mock_creds.expiry = datetime.utcnow() + timedelta(minutes=30)
+        mock_credentials.return_value = mock_creds
+        
+        first = get_gmail_service()
+        second = get_gmail_service()
+        
+        assert first is second
+        mock_credentials.assert_called_once()
+        mock_build.assert_called_once()
+        mock_creds.refresh.assert_not_called()
+
+    @patch('main.service_account.Credentials.from_service_account_info')
+    @patch('main.discovery.build_from_document')
+    def test_get_gmail_service_refreshes_near_expiry(self, mock_build, mock_credentials):
+        """Test that the access token is refreshed only when close to expiry."""
+        mock_creds = Mock()
+        mock_creds.token = 'access-token'
+        mock_creds.expiry = datetime.utcnow() + timedelta(minutes=1)
+        mock_credentials.return_value = mock_creds
+        
+        get_gmail_service()
+        
+        mock_creds.refresh.assert_called_once()
+
+    @patch('main.service_account.Credentials.from_service_account_info')
+    @patch('main.discovery.build_from_document')
+    def test_get_gmail_service_delegates_per_mailbox(self, mock_build, mock_credentials):
+        """Test that each mailbox gets delegated credentials and its own cached service."""
+        mock_credentials.return_value.with_subject.side_effect = lambda subject: Mock(
+            token='access-token', expiry=datetime.utcnow() + timedelta(minutes=30)
+        )
+        mock_build.side_effect = lambda *args, **kwargs: Mock()
+        
+        first = get_gmail_service('a@example.com')
+        second = get_gmail_service('b@example.com')
+        
+        assert first is not second
+        assert get_gmail_service('a@example.com') is first
+        assert [c[0][0] for c in mock_credentials.return_value.with_subject.call_args_list] == [
+            'a@example.com', 'b@example.com'
+        ]
+        mock_credentials.assert_called_once()
+        assert mock_build.call_count == 2
 
-    @patch('email.message_from_bytes')
-    @patch('base64.urlsafe_b64decode')
-    def test_fetch_email_content(self, mock_b64decode, mock_email_from_bytes):
+    @patch('main.service_account.Credentials.from_service_account_info')
+    @patch('main.discovery.build_from_document')
+    def test_gmail_client_cache_evicts_least_recently_used(self, mock_build, mock_credentials):
+        """Test that the cache holds at most maxsize mailboxes and drops the oldest."""
+        delegated = {}
+        def with_subject(subject):
+            delegated[subject] = Mock(token='access-token', expiry=datetime.utcnow() + timedelta(minutes=30))
+            return delegated[subject]
+        mock_credentials.return_value.with_subject.side_effect = with_subject
+        factory = main.GmailClientFactory(maxsize=2)
+        
+        factory.credentials('a@example.com')
+        factory.credentials('b@example.com')
+        factory.credentials('a@example.com')
+        factory.credentials('c@example.com')
+        
+        assert list(factory._mailboxes) == ['a@example.com', 'c@example.com']
+        assert factory.stats()['evictions'] == 1
+        assert 'gmail_client_cache_total{event="eviction"} 1' in factory.render()
+        b_credentials = delegated['b@example.com']
+        assert factory.credentials('b@example.com') is not b_credentials
+        assert 'gmail_client_cache_size 2' in factory.render()
+
+    @patch('main.service_account.Credentials.from_service_account_info')
+    def test_gmail_tokens_refresh_per_mailbox(self, mock_credentials):
+        """Test that only the mailbox whose token is expiring is refreshed."""
+        fresh = Mock(token='access-token', expiry=datetime.utcnow() + timedelta(minutes=30))
+        expiring = Mock(token='access-token', expiry=datetime.utcnow() + timedelta(minutes=1))
+        mock_credentials.return_value.with_subject.side_effect = [fresh, expiring]
+        factory = main.GmailClientFactory()
+        
+        factory.credentials('a@example.com')
+        factory.credentials('b@example.com')
+        
+        fresh.refresh.assert_not_called()
+        expiring.refresh.assert_called_once()
+
+    def test_fetch_email_content(self):
         """Test fetching email content from Gmail API."""
-        # Mock Gmail service
+        raw_message = (
+            b'From: sender@example.com\r\n'
+            b'To: recipient@example.com\r\n'
+            b'Subject: Test Subject\r\n'
+            b'\r\n'
+            b'raw email content\r\n'
+        )
+        raw_b64 = base64.urlsafe_b64encode(raw_message).decode('ascii')
         mock_service = Mock()
-        mock_message_response = {
-            'raw': 'base64encodedcontent'
+        mock_service.users().messages().get().execute.return_value = {'raw': raw_b64}
+        
+        result = fetch_email_content(mock_service, 'test@example.com', 'msg123')
+        
+        assert result['raw_body'] == raw_message
+        assert result['message_id'] == 'msg123'
+        assert result['headers'] == {
+            'from': 'sender@example.com',
+            'to': 'recipient@example.com',
+            'subject': 'Test Subject'
         }
-        mock_service.users().messages().get().execute.return_value = mock_message_response
+
+    def test_parse_headers_undecodable_bytes(self):
+        """Raw 8-bit header bytes are decoded leniently so they fit in jsonb."""
+        headers = main.parse_headers(b'Subject: caf\xc3\xa9\nFrom: Andr\xe9 <a@example.com>\n\nbody')
         
-        # Mock base64 decode
-        mock_b64decode.return_value = b'raw email content'
+        assert headers['Subject'] == 'caf\u00e9'
+        assert headers['From'] == 'Andr\u00e9 <a@example.com>'
+        json.dumps(headers).encode('utf-8')
+
+    def test_list_new_message_ids(self):
+        """Test that every messagesAdded entry in the delta is returned once."""
+        mock_service = labelled_service()
+        mock_service.users().history().list().execute.return_value = {
+            'history': [
+                {'messagesAdded': [{'message': {'id': 'msg1'}}, {'message': {'id': 'msg2'}}]},
+                {'messagesAdded': [{'message': {'id': 'msg2'}}]},
+                {'messagesAdded': [{'message': {'id': 'msg3'}}]}
+            ]
+        }
         
-        # Mock email parsing
-        mock_email_message = Mock()
-        mock_email_message.items.return_value = [
-            ('From', 'sender@example.com'),
-            ('To', 'recipient@example.com'),
-            ('Subject', 'Test Subject')
+        assert main.list_new_message_ids(mock_service, 'test@example.com', '100') == ['msg1', 'msg2', 'msg3']
+
+    def test_history_reader_follows_pages_lazily(self):
+        """Test that page tokens are followed only as ids are consumed."""
+        pages = {
+            None: {'history': [{'messagesAdded': [{'message': {'id': 'msg1'}}]}],
+                   'nextPageToken': 'page2', 'historyId': '150'},
+            'page2': {'history': [{'messagesAdded': [{'message': {'id': 'msg2'}}]}],
+                      'historyId': '160'}
+        }
+        mock_service = labelled_service()
+        mock_service.users().history().list.side_effect = \
+            lambda **kwargs: Mock(execute=Mock(return_value=pages[kwargs.get('pageToken')]))
+        mock_service.users().history().list.reset_mock()
+        
+        reader = main.HistoryReader(mock_service, 'test@example.com', '100')
+        ids = iter(reader)
+        
+        assert next(ids) == 'msg1'
+        assert mock_service.users().history().list.call_count == 1
+        assert list(ids) == ['msg2']
+        assert mock_service.users().history().list.call_count == 2
+        assert reader.checkpoint == main.HistoryCheckpoint('100', 'page2')
+        assert reader.history_id == '160'
+
+    def test_history_reader_resumes_from_checkpoint(self):
+        """Test that a scan resumes from a saved page token."""
+        mock_service = labelled_service()
+        mock_service.users().history().list().execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'msg9'}}]}]
+        }
+        mock_service.users().history().list.reset_mock()
+        
+        reader = main.HistoryReader(mock_service, 'test@example.com', '100',
+                                    resume_from=main.HistoryCheckpoint('100', 'page7'))
+        
+        assert list(reader) == ['msg9']
+        assert mock_service.users().history().list.call_args[1]['pageToken'] == 'page7'
+
+    def test_history_reader_falls_back_to_recent_messages(self):
+        """Test that an expired history ID pages through recent label messages."""
+        from googleapiclient.errors import HttpError
+        mock_service = labelled_service()
+        mock_service.users().history().list().execute.side_effect = HttpError(Mock(status=404), b'not found')
+        pages = {
+            None: {'messages': [{'id': 'msg1'}, {'id': 'msg2'}], 'nextPageToken': 'p2'},
+            'p2': {'messages': [{'id': 'msg3'}]}
+        }
+        mock_service.users().messages().list.side_effect = \
+            lambda **kwargs: Mock(execute=Mock(return_value=pages[kwargs.get('pageToken')]))
+        
+        reader = main.HistoryReader(mock_service, 'test@example.com', '1')
+        
+        assert list(reader) == ['msg1', 'msg2', 'msg3']
+        assert reader.fell_back is True
+
+    def test_history_reader_filters_by_label_id(self):
+        """Test that history and recent messages are filtered by the label's id, not its name."""
+        from googleapiclient.errors import HttpError
+        mock_service = labelled_service([{'id': 'INBOX', 'name': 'INBOX'},
+                                         {'id': 'Label_7', 'name': 'School-Events'}])
+        mock_service.users().history().list().execute.side_effect = HttpError(Mock(status=404), b'not found')
+        mock_service.users().messages().list().execute.return_value = {'messages': [{'id': 'msg1'}]}
+        
+        assert list(main.HistoryReader(mock_service, 'test@example.com', '1')) == ['msg1']
+        assert mock_service.users().history().list.call_args[1]['labelId'] == 'Label_7'
+        assert mock_service.users().messages().list.call_args[1]['labelIds'] == ['Label_7']
+
+    def test_label_id_resolved_once_per_mailbox(self):
+        """Test that labels.list is called once per mailbox and then served from the cache."""
+        mock_service = labelled_service()
+        mock_service.users().history().list().execute.return_value = {'history': []}
+        mock_service.users().labels().list.reset_mock()
+        
+        for _ in range(3):
+            list(main.HistoryReader(mock_service, 'a@example.com', '100'))
+        list(main.HistoryReader(mock_service, 'b@example.com', '100'))
+        
+        assert [c[1]['userId'] for c in mock_service.users().labels().list.call_args_list] == [
+            'a@example.com', 'b@example.com'
         ]
-        mock_email_from_bytes.return_value = mock_email_message
+
+    def test_mailbox_without_label_yields_nothing(self):
+        """Test that a mailbox lacking the label is never scanned."""
+        mock_service = labelled_service([{'id': 'INBOX', 'name': 'INBOX'}])
+        mock_service.users().history().list.reset_mock()
         
-        result = fetch_email_content(mock_service, 'test@example.com', 'msg123')
+        assert list(main.HistoryReader(mock_service, 'test@example.com', '100')) == []
+        assert list(main.HistoryReader(mock_service, 'test@example.com', '100')) == []
+        mock_service.users().history().list.assert_not_called()
+        assert ingest_core._label_ids.get('test@example.com') == ''
+
+    @patch('main.store_emails_in_database')
+    @patch('main.fetch_email_contents')
+    @patch('main.iter_new_message_ids')
+    @patch('main.get_gmail_service')
+    @patch('main.verify_google_jwt')
+    def test_handle_pubsub_processes_large_delta_in_chunks(self, mock_verify_jwt, mock_gmail_service,
+                                                         mock_iter_ids, mock_fetch, mock_store,
+                                                         client, no_cursor, sample_pubsub_message):
+        """Test that a large history gap is fetched and stored one batch at a time."""
+        mock_verify_jwt.return_value = True
+        mock_iter_ids.return_value = iter([f'msg{i}' for i in range(120)])
+        mock_fetch.side_effect = lambda service, email, ids: [{'message_id': mid} for mid in ids]
+        mock_store.return_value = True
         
-        assert result['raw_body'] == 'base64encodedcontent'
-        assert result['message_id'] == 'msg123'
-        assert 'from' in result['headers']
-        assert result['headers']['from'] == 'sender@example.com'
+        with patch('main.GMAIL_BATCH_SIZE', 50):
+            response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        assert [len(c[0][1]) for c in mock_store.call_args_list] == [50, 50, 20]
+        # Only the last batch carries the cursor advance
+        assert [c[0][3] for c in mock_store.call_args_list] == [None, None, 12345]
+
+    @patch('main._parse_raw_message')
+    def test_fetch_email_contents_batches(self, mock_parse):
+        """Test that messages are fetched through batch requests of GMAIL_BATCH_SIZE."""
+        mock_parse.side_effect = lambda response, message_id: {'message_id': message_id}
+        batches = []
+        
+        def new_batch(callback):
+            batch = Mock()
+            batch.ids = []
+            batch.add.side_effect = lambda request, request_id: batch.ids.append(request_id)
+            batch.execute.side_effect = lambda: [callback(mid, {'raw': 'x'}, None) for mid in batch.ids]
+            batches.append(batch)
+            return batch
+        
+        mock_service = Mock()
+        mock_service.new_batch_http_request.side_effect = new_batch
+        message_ids = [f'msg{i}' for i in range(120)]
+        
+        with patch('ingest_core.GMAIL_BATCH_SIZE', 50):
+            result = main.fetch_email_contents(mock_service, 'test@example.com', message_ids)
+        
+        assert [r['message_id'] for r in result] == message_ids
+        assert [len(b.ids) for b in batches] == [50, 50, 20]
+
+    @patch('main.time.sleep')
+    @patch('main._parse_raw_message')
+    def test_fetch_email_contents_retries_failed_items(self, mock_parse, mock_sleep):
+        """Test that only throttled items are retried and deleted messages skipped."""
+        from googleapiclient.errors import HttpError
+        mock_parse.side_effect = lambda response, message_id: {'message_id': message_id}
+        attempts = {}
+        
+        def respond(callback, mid):
+            attempts[mid] = attempts.get(mid, 0) + 1
+            if mid == 'throttled' and attempts[mid] == 1:
+                callback(mid, None, HttpError(Mock(status=429), b'rate limited'))
+            elif mid == 'deleted':
+                callback(mid, None, HttpError(Mock(status=404), b'not found'))
+            else:
+                callback(mid, {'raw': 'x'}, None)
+        
+        def new_batch(callback):
+            batch = Mock()
+            batch.ids = []
+            batch.add.side_effect = lambda request, request_id: batch.ids.append(request_id)
+            batch.execute.side_effect = lambda: [respond(callback, mid) for mid in batch.ids]
+            return batch
+        
+        mock_service = Mock()
+        mock_service.new_batch_http_request.side_effect = new_batch
+        
+        result = main.fetch_email_contents(mock_service, 'test@example.com', ['ok', 'throttled', 'deleted'])
+        
+        assert [r['message_id'] for r in result] == ['ok', 'throttled']
+        assert attempts == {'ok': 1, 'throttled': 2, 'deleted': 1}
 
 class TestDatabaseOperations:
     """Test database operations."""
     
-    @patch('psycopg.connect')
-    def test_store_email_in_database_success(self, mock_connect):
+    @patch('main.get_db_pool')
+    def test_store_email_in_database_success(self, mock_get_pool):
         """Test successful email storage in database."""
-        # Mock database connection and cursor
-        mock_conn = Mock()
-        mock_cursor = Mock()
-        mock_conn.__enter__.return_value = mock_conn
+        # Mock pooled database connection and cursor
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
         mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-        mock_connect.return_value = mock_conn
         
-        # Mock user lookup
-        mock_cursor.fetchone.return_value = ('user-uuid-123',)
+        # Mock combined user lookup + insert
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', True, None, None)]
         
         email_data = {
-            'raw_body': 'base64content',
+            'raw_body': b'base64content',
             'headers': {'from': 'test@example.com'},
             'message_id': 'msg123'
         }
@@ -189,24 +560,58 @@ class TestDatabaseOperations:
             assert result is True
             
             # Verify database calls
-            assert mock_cursor.execute.call_count == 2  # User lookup + insert
+            assert mock_cursor.execute.call_count == 1  # User lookup folded into insert
+            assert 'JOIN auth.users' in mock_cursor.execute.call_args[0][0]
             mock_conn.commit.assert_called_once()
 
-    @patch('psycopg.connect')
-    def test_store_email_in_database_user_not_found(self, mock_connect):
+    @patch('main.get_db_pool')
+    def test_store_email_in_database_uses_cached_user_id(self, mock_get_pool):
+        """Test that a known mailbox skips the auth.users lookup."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', True, None, None)]
+        
+        email_data = {'raw_body': b'base64content', 'headers': {}, 'message_id': 'msg123'}
+        store_email_in_database('test@example.com', email_data, 'hist1')
+        store_email_in_database('test@example.com', email_data, 'hist2')
+        
+        first_params = mock_cursor.execute.call_args_list[0][0][1]
+        second_params = mock_cursor.execute.call_args_list[1][0][1]
+        assert first_params[:2] == [['test@example.com'], [None]]
+        assert second_params[:2] == [['test@example.com'], ['user-uuid-123']]
+
+    @patch('main.get_db_pool')
+    def test_invalidate_user_id(self, mock_get_pool):
+        """Test that invalidation forces the next insert to resolve the user again."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', True, None, None)]
+        
+        email_data = {'raw_body': b'base64content', 'headers': {}, 'message_id': 'msg123'}
+        store_email_in_database('test@example.com', email_data, 'hist1')
+        main.invalidate_user_id('test@example.com')
+        store_email_in_database('test@example.com', email_data, 'hist2')
+        
+        assert mock_cursor.execute.call_args_list[1][0][1][1] == [None]
+
+    @patch('main.get_db_pool')
+    def test_store_email_in_database_user_not_found(self, mock_get_pool):
         """Test email storage when user is not found."""
-        # Mock database connection and cursor
-        mock_conn = Mock()
-        mock_cursor = Mock()
-        mock_conn.__enter__.return_value = mock_conn
+        # Mock pooled database connection and cursor
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
         mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-        mock_connect.return_value = mock_conn
         
-        # Mock user lookup returning None
-        mock_cursor.fetchone.return_value = None
+        # Mock user lookup finding nobody
+        mock_cursor.fetchall.return_value = [(0, None, False, None, None)]
         
         email_data = {
-            'raw_body': 'base64content',
+            'raw_body': b'base64content',
             'headers': {'from': 'test@example.com'},
             'message_id': 'msg123'
         }
@@ -215,16 +620,266 @@ class TestDatabaseOperations:
             result = store_email_in_database('nonexistent@example.com', email_data, 'hist123')
             assert result is False
 
+    @patch('main.psycopg_pool.ConnectionPool')
+    def test_get_db_pool_created_once(self, mock_pool_cls):
+        """Test that the connection pool is opened once and shared."""
+        with patch('main._db_pool', None):
+            first = main.get_db_pool()
+            second = main.get_db_pool()
+        
+        assert first is second
+        mock_pool_cls.assert_called_once()
+        kwargs = mock_pool_cls.call_args[1]
+        assert kwargs['min_size'] == main.DB_POOL_MIN_SIZE
+        assert kwargs['max_size'] == main.DB_POOL_MAX_SIZE
+        assert kwargs['check'] is not None
+        assert kwargs['kwargs']['prepare_threshold'] == 1
+
+def _multipart_email(attachment: bytes, subject: str = 'Newsletter') -> bytes:
+    """Build a raw multipart email carrying one PDF attachment."""
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    
+    message = MIMEMultipart()
+    message['From'] = 'office@school.example.com'
+    message['Subject'] = subject
+    message.attach(MIMEText('See attached.'))
+    message.attach(MIMEApplication(attachment, Name='newsletter.pdf'))
+    return message.as_bytes()
+
+class TestRawMessageStorage:
+    """Test compressed, content-addressed raw message storage."""
+    
+    def test_pack_round_trip(self):
+        """Test that a packed message reassembles byte for byte."""
+        raw = _multipart_email(os.urandom(20000))
+        packed = main.pack_raw_message(raw)
+        
+        assert len(packed.parts) == 1
+        assert len(packed.blobs) == 1
+        assert len(packed.body) < 2000
+        blobs = [packed.blobs[digest] for _, digest in packed.parts]
+        assert main.unpack_raw_message(packed.body, packed.parts, blobs) == raw
+
+    def test_repeated_attachment_shares_blob(self):
+        """Test that the same attachment in two emails hashes to one blob."""
+        attachment = os.urandom(20000)
+        first = main.pack_raw_message(_multipart_email(attachment, 'First'))
+        second = main.pack_raw_message(_multipart_email(attachment, 'Second'))
+        
+        assert first.parts[0][1] == second.parts[0][1]
+
+    def test_small_and_text_parts_stay_inline(self):
+        """Test that text and small parts are compressed with the message."""
+        raw = _multipart_email(b'tiny')
+        packed = main.pack_raw_message(raw)
+        
+        assert packed.parts == []
+        assert main.unpack_raw_message(packed.body, [], []) == raw
+
+    def test_unparseable_message_stored_whole(self):
+        """Test that a message with a broken MIME structure is still stored."""
+        raw = b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n--b\r\nno end'
+        packed = main.pack_raw_message(raw)
+        
+        assert main.unpack_raw_message(packed.body, packed.parts, []) == raw
+
+    @patch('main.get_db_pool')
+    def test_store_writes_blobs(self, mock_get_pool):
+        """Test that attachment blobs are written in the same statement as the emails."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', True, None, None), (1, 'user-uuid-123', True, None, None)]
+        
+        attachment = os.urandom(20000)
+        emails = [
+            {
+                'raw_body': _multipart_email(attachment, subject),
+                'headers': {},
+                'message_id': message_id
+            }
+            for message_id, subject in (('msg1', 'First'), ('msg2', 'Second'))
+        ]
+        assert main.store_emails_in_database('test@example.com', emails, 'hist1') is True
+        
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'INSERT INTO email_blobs' in sql
+        packed = main.pack_raw_message(emails[0]['raw_body'])
+        # Blob hashes and contents come before the (here empty) cursor arrays
+        assert params[-5] == [packed.parts[0][1]]
+        assert base64.b64decode(ingest_core._decompress(params[-4][0])) == attachment
+        assert params[-3:] == [[], [], []]
+
+def _raw_email(message_id):
+    raw = f'Subject: {message_id}\r\n\r\nbody'.encode()
+    return {'raw_body': raw, 'headers': {}, 'message_id': message_id}
+
+class TestEmailWriter:
+    """Test the micro-batched inbound_emails writer."""
+    
+    def _cursor(self, mock_get_pool):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        return mock_conn, mock_cursor
+    
+    @patch('main.get_db_pool')
+    def test_concurrent_writes_share_one_statement(self, mock_get_pool):
+        """Test that queued writes commit together and each caller gets its own result."""
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.fetchall.return_value = [
+            (0, 'user-a', True, None, None), (1, 'user-a', False, None, None), (2, None, False, None, None)
+        ]
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=200)
+        
+        first = writer.submit('a@example.com', [_raw_email('m1')], 'h1')
+        second = writer.submit('a@example.com', [_raw_email('m1'), _raw_email('m2')], 'h2')
+        third = writer.submit('b@example.com', [_raw_email('m3')], 'h3')
+        
+        assert first.result(5) == ingest_core.WriteResult('user-a', ['m1'], [])
+        assert second.result(5) == ingest_core.WriteResult('user-a', [], ['m1', 'm2'])
+        assert third.result(5) == ingest_core.WriteResult(None, [], [])
+        mock_cursor.execute.assert_called_once()
+        mock_conn.commit.assert_called_once()
+        # m1 is written once even though two requests carried it
+        params = mock_cursor.execute.call_args[0][1]
+        assert params[7] == ['m1', 'm2', 'm3']
+
+    @patch('main.get_db_pool')
+    def test_same_message_id_in_two_mailboxes(self, mock_get_pool):
+        """Test that a message id shared by two mailboxes is written for each of them."""
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.fetchall.return_value = [(0, 'user-a', True, None, None), (1, 'user-b', True, None, None)]
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=200)
+
+        first = writer.submit('a@example.com', [_raw_email('m1')], 'h1')
+        second = writer.submit('b@example.com', [_raw_email('m1')], 'h2')
+
+        assert first.result(5) == ingest_core.WriteResult('user-a', ['m1'], [])
+        assert second.result(5) == ingest_core.WriteResult('user-b', ['m1'], [])
+        params = mock_cursor.execute.call_args[0][1]
+        assert params[0] == ['a@example.com', 'b@example.com']
+
+    @patch('main.get_db_pool')
+    def test_cursor_advances_in_the_same_statement(self, mock_get_pool):
+        """Test that cursor advances are batched with the emails and reported per caller."""
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.fetchall.return_value = [
+            (0, 'user-a', True, None, None),
+            (None, 'user-a', False, 'a@example.com', 400),
+            (None, None, False, 'b@example.com', None),
+        ]
+        main._user_ids.set('a@example.com', 'user-a')
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=200)
+
+        first = writer.submit('a@example.com', [_raw_email('m1')], 'h1', cursor=400)
+        second = writer.submit('b@example.com', [], 'h2', cursor=300)
+
+        assert first.result(5) == ingest_core.WriteResult('user-a', ['m1'], [], 400)
+        assert second.result(5) == ingest_core.WriteResult(None, [], [], None)
+        mock_cursor.execute.assert_called_once()
+        params = mock_cursor.execute.call_args[0][1]
+        assert params[-3:] == [['a@example.com', 'b@example.com'], ['user-a', None], [400, 300]]
+
+    @patch('main.get_db_pool')
+    def test_full_batch_flushes_without_waiting(self, mock_get_pool):
+        """Test that reaching max_rows flushes before the delay expires."""
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.fetchall.return_value = [(0, 'user-a', True, None, None), (1, 'user-a', True, None, None)]
+        writer = main.EmailWriter(max_rows=2, max_delay_ms=60000)
+        
+        first = writer.submit('a@example.com', [_raw_email('m1')], 'h1')
+        second = writer.submit('a@example.com', [_raw_email('m2')], 'h1')
+        
+        assert first.result(5).inserted == ['m1']
+        assert second.result(5).inserted == ['m2']
+
+    @patch('main.get_db_pool')
+    def test_deleted_cached_user_is_resolved_again(self, mock_get_pool):
+        """Test that a foreign key violation retries the batch without cached user ids."""
+        import psycopg
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.execute.side_effect = [psycopg.errors.ForeignKeyViolation(), None]
+        mock_cursor.fetchall.return_value = [(0, 'user-new', True, None, None)]
+        main._user_ids.set('a@example.com', 'user-deleted')
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=0)
+        
+        result = writer.write('a@example.com', [_raw_email('m1')], 'h1')
+        
+        assert result.user_id == 'user-new'
+        mock_conn.rollback.assert_called_once()
+        first_params, retry_params = (call[0][1] for call in mock_cursor.execute.call_args_list)
+        assert first_params[1] == ['user-deleted']
+        assert retry_params[1] == [None]
+        assert main._user_ids.get('a@example.com') is None
+
+    @patch('main.get_db_pool')
+    def test_statement_is_the_same_for_every_batch_size(self, mock_get_pool):
+        """Test that the statement text doesn't change with the number of rows or blobs."""
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.fetchall.side_effect = [
+            [(0, 'user-a', True, None, None)],
+            [(0, 'user-a', True, None, None), (1, 'user-a', True, None, None)],
+        ]
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=0)
+        
+        writer.write('a@example.com', [_raw_email('m1')], 'h1')
+        writer.write('a@example.com', [_raw_email('m2'), _raw_email('m3')], 'h2')
+        
+        first_sql, second_sql = (call[0][0] for call in mock_cursor.execute.call_args_list)
+        assert first_sql == second_sql
+
+    @patch('main.get_db_pool')
+    def test_flush_failure_reaches_every_caller(self, mock_get_pool):
+        """Test that a failed batch fails each waiting caller."""
+        import psycopg
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        mock_cursor.execute.side_effect = psycopg.OperationalError('connection lost')
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=100)
+        
+        futures = [writer.submit(f'{i}@example.com', [_raw_email(f'm{i}')], 'h') for i in range(2)]
+        
+        for future in futures:
+            with pytest.raises(psycopg.OperationalError):
+                future.result(5)
+        mock_cursor.execute.assert_called_once()
+
+    @patch('main.get_db_pool')
+    def test_bad_row_fails_only_its_caller(self, mock_get_pool):
+        """Test that a rejected batch is retried per caller so only the bad request fails."""
+        import psycopg
+        mock_conn, mock_cursor = self._cursor(mock_get_pool)
+        
+        def execute(sql, params):
+            if 'bad@example.com' in params[0]:
+                raise psycopg.errors.UntranslatableCharacter('unsupported Unicode escape sequence')
+        mock_cursor.execute.side_effect = execute
+        mock_cursor.fetchall.return_value = [(0, 'user-a', True, None, None)]
+        writer = main.EmailWriter(max_rows=100, max_delay_ms=100)
+        
+        good = writer.submit('a@example.com', [_raw_email('m1')], 'h')
+        bad = writer.submit('bad@example.com', [_raw_email('m2')], 'h')
+        
+        assert good.result(5) == ingest_core.WriteResult('user-a', ['m1'], [])
+        with pytest.raises(psycopg.errors.UntranslatableCharacter):
+            bad.result(5)
+        assert mock_cursor.execute.call_count == 3
+
 class TestPubSubHandler:
     """Test the main Pub/Sub handler endpoint."""
     
-    @patch('main.store_email_in_database')
-    @patch('main.fetch_email_content')
+    @patch('main.store_emails_in_database')
+    @patch('main.fetch_email_contents')
+    @patch('main.iter_new_message_ids')
     @patch('main.get_gmail_service')
     @patch('main.verify_google_jwt')
-    def test_handle_pubsub_success(self, mock_verify_jwt, mock_gmail_service, 
+    def test_handle_pubsub_success(self, mock_verify_jwt, mock_gmail_service, mock_list_ids,
                                  mock_fetch_email, mock_store_email, client, 
-                                 sample_pubsub_message, sample_email_data):
+                                 no_cursor, sample_pubsub_message, sample_email_data):
         """Test successful Pub/Sub message handling."""
         # Mock all dependencies
         mock_verify_jwt.return_value = True
@@ -232,12 +887,10 @@ class TestPubSubHandler:
         mock_service = Mock()
         mock_gmail_service.return_value = mock_service
         
-        # Mock Gmail messages list response
-        mock_service.users().messages().list().execute.return_value = {
-            'messages': [{'id': 'msg123'}]
-        }
+        # Mock the Gmail history delta
+        mock_list_ids.return_value = iter(['msg123'])
         
-        mock_fetch_email.return_value = sample_email_data
+        mock_fetch_email.return_value = [sample_email_data]
         mock_store_email.return_value = True
         
         with patch.dict(os.environ, {'GMAIL_WATCH_LABEL': 'school-events'}):
@@ -248,6 +901,27 @@ class TestPubSubHandler:
             assert response.status_code == 204
             mock_verify_jwt.assert_called_once()
             mock_store_email.assert_called_once()
+            mock_fetch_email.assert_called_once_with(mock_service, 'test@example.com', ['msg123'])
+
+    @patch('main.store_emails_in_database')
+    @patch('main.fetch_email_contents')
+    @patch('main.iter_new_message_ids')
+    @patch('main.get_gmail_service')
+    @patch('main.verify_google_jwt')
+    def test_handle_pubsub_stores_whole_delta(self, mock_verify_jwt, mock_gmail_service, mock_list_ids,
+                                            mock_fetch_email, mock_store_email, client,
+                                            no_cursor, sample_pubsub_message, sample_email_data):
+        """Test that every message in a burst is fetched and stored together."""
+        mock_verify_jwt.return_value = True
+        mock_list_ids.return_value = iter(['msg1', 'msg2', 'msg3'])
+        emails = [{**sample_email_data, 'message_id': mid} for mid in ['msg1', 'msg2', 'msg3']]
+        mock_fetch_email.return_value = emails
+        mock_store_email.return_value = True
+        
+        response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        mock_store_email.assert_called_once_with('test@example.com', emails, '12345', 12345)
 
     @patch('main.verify_google_jwt')
     def test_handle_pubsub_invalid_jwt(self, mock_verify_jwt, client, sample_pubsub_message):
@@ -292,6 +966,140 @@ class TestPubSubHandler:
         assert response.status_code == 400
         assert 'No data in message' in response.get_json()['error']
 
+class TestMailboxCursors:
+    """Test per-mailbox history cursors and scan coalescing."""
+    
+    @patch('main.get_gmail_service')
+    @patch('main.get_mailbox_cursor')
+    @patch('main.verify_google_jwt')
+    def test_push_older_than_cursor_skips_gmail(self, mock_verify_jwt, mock_get_cursor,
+                                               mock_gmail_service, client, sample_pubsub_message):
+        """Test that a push already covered by the cursor makes no Gmail call."""
+        mock_verify_jwt.return_value = True
+        mock_get_cursor.return_value = 20000
+        
+        response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        mock_gmail_service.assert_not_called()
+
+    @patch('main.store_emails_in_database')
+    @patch('main.fetch_email_contents')
+    @patch('main.iter_new_message_ids')
+    @patch('main.get_gmail_service')
+    @patch('main.get_mailbox_cursor')
+    @patch('main.verify_google_jwt')
+    def test_scan_starts_from_cursor_and_advances_it(self, mock_verify_jwt, mock_get_cursor, mock_gmail_service,
+                                                    mock_iter_ids, mock_fetch, mock_store,
+                                                    client, sample_pubsub_message):
+        """Test that the scan resumes at the cursor and moves it to the newest history."""
+        mock_verify_jwt.return_value = True
+        mock_get_cursor.return_value = 12000
+        reader = Mock()
+        reader.__iter__ = Mock(return_value=iter(['msg1']))
+        reader.history_id = '12400'
+        mock_iter_ids.return_value = reader
+        mock_fetch.return_value = [{'message_id': 'msg1'}]
+        mock_store.return_value = True
+        
+        response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        assert mock_iter_ids.call_args[0][2] == '12000'
+        mock_store.assert_called_once_with('test@example.com', [{'message_id': 'msg1'}], '12345', 12400)
+
+    @patch('main.record_ingest_failure', return_value=False)
+    @patch('main.store_emails_in_database')
+    @patch('main.get_gmail_service')
+    @patch('main.get_mailbox_cursor')
+    @patch('main.verify_google_jwt')
+    def test_failed_store_does_not_advance_cursor(self, mock_verify_jwt, mock_get_cursor, mock_gmail_service,
+                                                 mock_store, mock_record, client, sample_pubsub_message):
+        """Test that the cursor only moves once everything is stored."""
+        mock_verify_jwt.return_value = True
+        mock_get_cursor.return_value = None
+        mock_store.return_value = False
+        
+        with patch('main.GMAIL_BATCH_SIZE', 1), \
+             patch('main.iter_new_message_ids', return_value=iter(['msg1', 'msg2'])), \
+             patch('main.fetch_email_contents', return_value=[{'message_id': 'msg1'}]):
+            response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 500
+        # The scan stopped at the first batch, which doesn't move the cursor
+        mock_store.assert_called_once()
+        assert mock_store.call_args[0][3] is None
+
+    @patch('main.get_db_pool')
+    def test_store_remembers_advanced_cursor(self, mock_get_pool):
+        """Test that an empty scan still goes through the writer to move the cursor."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(None, 'user-a', False, 'test@example.com', 12400)]
+        
+        assert main.store_emails_in_database('test@example.com', [], '12345', 12400) is True
+        assert main.get_mailbox_cursor('test@example.com', 12400) == 12400
+        
+        mock_cursor.fetchall.return_value = [(None, None, False, 'test@example.com', None)]
+        with pytest.raises(main.UnknownUserError):
+            main.store_emails_in_database('test@example.com', [], '12345', 12500)
+        assert main._mailbox_cursors.cached('test@example.com') == 12400
+
+    @patch('main.get_db_pool')
+    def test_get_mailbox_cursor_uses_local_copy(self, mock_get_pool):
+        """Test that a cursor known to cover the push needs no query."""
+        main._mailbox_cursors.remember('test@example.com', 500)
+        
+        assert main.get_mailbox_cursor('test@example.com', 400) == 500
+        mock_get_pool.assert_not_called()
+
+    def test_keyed_locks_serialize_same_mailbox(self):
+        """Test that only one holder per mailbox runs at a time."""
+        import threading
+        import time
+        locks = main.KeyedLocks()
+        active = []
+        overlaps = []
+        
+        def scan(key):
+            with locks.hold(key) as acquired:
+                assert acquired
+                active.append(key)
+                if active.count(key) > 1:
+                    overlaps.append(key)
+                time.sleep(0.01)
+                active.remove(key)
+        
+        threads = [threading.Thread(target=scan, args=('a@example.com',)) for _ in range(5)]
+        threads += [threading.Thread(target=scan, args=('b@example.com',)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        assert overlaps == []
+        assert locks._locks == {}
+
+    def test_keyed_locks_timeout(self):
+        """Test that a waiter gives up after the timeout."""
+        import threading
+        locks = main.KeyedLocks()
+        result = []
+        
+        def waiter():
+            with locks.hold('a@example.com', timeout=0.01) as acquired:
+                result.append(acquired)
+        
+        with locks.hold('a@example.com'):
+            t = threading.Thread(target=waiter)
+            t.start()
+            t.join()
+        
+        assert result == [False]
+        assert locks._locks == {}
+
 class TestHealthCheck:
     """Test health check endpoint."""
     
@@ -302,16 +1110,27 @@ class TestHealthCheck:
         assert response.status_code == 200
         assert response.get_json()['status'] == 'healthy'
 
+    def test_health_check_reports_pool_stats(self, client):
+        """Test that pool saturation and wait time are exposed once the pool is open."""
+        mock_pool = Mock()
+        mock_pool.get_stats.return_value = {'pool_size': 4, 'pool_available': 1, 'requests_wait_ms': 12}
+        
+        with patch('main._db_pool', mock_pool):
+            response = client.get('/health')
+        
+        assert response.get_json()['db_pool']['requests_wait_ms'] == 12
+
 class TestIdempotency:
     """Test idempotency of email processing."""
     
-    @patch('main.store_email_in_database')
-    @patch('main.fetch_email_content')
+    @patch('main.store_emails_in_database')
+    @patch('main.fetch_email_contents')
+    @patch('main.iter_new_message_ids')
     @patch('main.get_gmail_service')
     @patch('main.verify_google_jwt')
-    def test_duplicate_history_id_handling(self, mock_verify_jwt, mock_gmail_service,
+    def test_duplicate_history_id_handling(self, mock_verify_jwt, mock_gmail_service, mock_list_ids,
                                          mock_fetch_email, mock_store_email, client,
-                                         sample_pubsub_message, sample_email_data):
+                                         no_cursor, sample_pubsub_message, sample_email_data):
         """Test that duplicate historyId doesn't create duplicate records."""
         # Mock all dependencies
         mock_verify_jwt.return_value = True
@@ -319,11 +1138,9 @@ class TestIdempotency:
         mock_service = Mock()
         mock_gmail_service.return_value = mock_service
         
-        mock_service.users().messages().list().execute.return_value = {
-            'messages': [{'id': 'msg123'}]
-        }
+        mock_list_ids.side_effect = lambda *args: iter(['msg123'])
         
-        mock_fetch_email.return_value = sample_email_data
+        mock_fetch_email.return_value = [sample_email_data]
         mock_store_email.return_value = True
         
         with patch.dict(os.environ, {'GMAIL_WATCH_LABEL': 'school-events'}):
@@ -343,5 +1160,322 @@ class TestIdempotency:
             # Both should succeed due to ON CONFLICT DO NOTHING
             assert mock_store_email.call_count == 2
 
+    @patch('main.get_db_pool')
+    def test_insert_conflicts_on_gmail_message_id(self, mock_get_pool):
+        """Test that messages are deduplicated by Gmail message id within a user's mailbox."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', False, None, None)]
+        
+        email_data = {'raw_body': b'base64content', 'headers': {}, 'message_id': 'msg123'}
+        assert store_email_in_database('test@example.com', email_data, 'hist1') is True
+        
+        sql = mock_cursor.execute.call_args[0][0]
+        assert 'ON CONFLICT (user_id, gmail_message_id) DO NOTHING' in sql
+
+class TestMetrics:
+    """Test stage histograms, email counters and the /metrics route."""
+    
+    def test_histogram_renders_cumulative_buckets(self):
+        """Test that observations land in cumulative le buckets with sum and count."""
+        histogram = main.Histogram('test_seconds', 'Test.', 'stage', buckets=(0.1, 1.0))
+        histogram.observe('a', 0.05)
+        histogram.observe('a', 0.1)
+        histogram.observe('a', 5.0)
+        
+        lines = histogram.render()
+        
+        assert '# TYPE test_seconds histogram' in lines
+        assert 'test_seconds_bucket{stage="a",le="0.1"} 2' in lines
+        assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+        assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+        assert 'test_seconds_sum{stage="a"} 5.15' in lines
+        assert 'test_seconds_count{stage="a"} 3' in lines
+    
+    def test_histogram_time_records_on_error(self):
+        """Test that a failing stage is still timed."""
+        histogram = main.Histogram('test_seconds', 'Test.', 'stage')
+        with pytest.raises(ValueError):
+            with histogram.time('a'):
+                raise ValueError('boom')
+        
+        assert 'test_seconds_count{stage="a"} 1' in histogram.render()
+    
+    @patch('main.get_db_pool')
+    def test_store_counts_inserted_and_duplicates(self, mock_get_pool):
+        """Test that stored emails are counted as inserted or duplicate."""
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(0, 'user-uuid-123', True, None, None), (1, 'user-uuid-123', False, None, None)]
+        emails = [
+            {'raw_body': b'base64content', 'headers': {}, 'message_id': 'm1'},
+            {'raw_body': b'base64content', 'headers': {}, 'message_id': 'm2'},
+        ]
+        
+        with patch('main._emails_total', main.Counter('t', 'T.', 'result')) as counter:
+            assert main.store_emails_in_database('test@example.com', emails, 'hist1') is True
+        
+        assert counter.render()[2:] == ['t{result="duplicate"} 1', 't{result="inserted"} 1']
+    
+    def test_metrics_route(self, client):
+        """Test that /metrics serves every stage in the Prometheus text format."""
+        response = client.get('/metrics')
+        
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        body = response.get_data(as_text=True)
+        for stage in main.INGEST_STAGES:
+            assert f'ingest_stage_seconds_count{{stage="{stage}"}}' in body
+        assert 'ingest_emails_total{result="inserted"}' in body
+
+class TestColdStart:
+    """Test deferred imports and the warm-up hook."""
+    
+    def test_import_defers_client_libraries(self):
+        """Test that importing main loads none of the Google, psycopg or JWT libraries."""
+        import subprocess
+        code = (
+            "import sys, main; "
+            "print(sorted(m for m in ('googleapiclient', 'google.oauth2', 'jwt', 'psycopg', 'zstandard') "
+            "if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        )
+        assert result.stdout.strip() == '[]'
+    
+    def test_lazy_module_imports_on_first_use(self):
+        """Test that a LazyModule imports its module once, on first attribute access."""
+        module = main.LazyModule('json')
+        assert module._module is None
+        assert module.dumps([1]) == '[1]'
+        assert module.load() is json
+    
+    @patch('main.get_db_pool', side_effect=RuntimeError('db down'))
+    @patch.object(main._gmail_clients, 'prepare')
+    @patch.object(main._jwks_cache, 'refresh')
+    def test_warm_up_continues_past_failures(self, mock_refresh, mock_gmail, mock_pool):
+        """Test that one failing warm-up step doesn't stop the others."""
+        with patch('main.GOOGLE_PRIVATE_KEY', 'key'), patch('main.SUPABASE_DB_URL', 'postgresql://test'):
+            main.warm_up()
+        
+        mock_refresh.assert_called_once()
+        mock_gmail.assert_called_once()
+        mock_pool.assert_called_once()
+
+class TestLoadShedding:
+    """Test the adaptive concurrency limit and transient error handling."""
+    
+    def test_limiter_rejects_at_limit(self):
+        """Test that requests beyond the limit are refused until one is released."""
+        limiter = main.AdaptiveLimiter(2, 1, 10)
+        assert limiter.acquire()
+        assert limiter.acquire()
+        assert not limiter.acquire()
+        
+        limiter.release()
+        assert limiter.acquire()
+    
+    def test_limiter_follows_latency(self):
+        """Test that the limit grows at steady latency and shrinks when latency rises."""
+        limiter = main.AdaptiveLimiter(10, 2, 100)
+        for _ in range(50):
+            while limiter.acquire():
+                pass
+            limiter.release(0.1)
+        grown = limiter.limit
+        assert grown > 10
+        
+        for _ in range(50):
+            while limiter.acquire():
+                pass
+            limiter.release(2.0)
+        assert limiter.limit < grown / 2
+    
+    def test_limiter_ignores_latency_when_underused(self):
+        """Test that latency seen far below the limit doesn't move it."""
+        limiter = main.AdaptiveLimiter(10, 2, 100)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.1)
+        
+        assert limiter.limit == 10
+    
+    def test_limiter_backs_off_on_drop(self):
+        """Test that a failed request cuts the limit, but not below the minimum."""
+        limiter = main.AdaptiveLimiter(10, 8, 100)
+        limiter.acquire()
+        limiter.release(dropped=True)
+        assert limiter.limit == 9
+        
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(dropped=True)
+        assert limiter.limit == 8
+    
+    def test_is_transient(self):
+        """Test that throttling, 5xx and connection failures are transient and the rest aren't."""
+        import psycopg
+        from googleapiclient.errors import HttpError
+        
+        assert main.is_transient(HttpError(Mock(status=429), b'rate limited'))
+        assert main.is_transient(HttpError(Mock(status=503), b'unavailable'))
+        assert not main.is_transient(HttpError(Mock(status=403), b'forbidden'))
+        assert main.is_transient(psycopg.OperationalError('connection refused'))
+        assert not main.is_transient(psycopg.errors.UndefinedTable('no table'))
+        assert not main.is_transient(ValueError('bad'))
+        
+        try:
+            try:
+                raise ConnectionResetError()
+            except OSError as e:
+                raise RuntimeError('wrapped') from e
+        except RuntimeError as e:
+            assert main.is_transient(e)
+    
+    def test_retry_after_uses_gmail_header(self):
+        """Test that Gmail's own Retry-After is passed on."""
+        from googleapiclient.errors import HttpError
+        resp = Mock(status=429)
+        resp.get.return_value = '120'
+        
+        assert main.retry_after(HttpError(resp, b'rate limited')) == 120
+        assert main.retry_after(ConnectionResetError()) == ingest_core.TRANSIENT_RETRY_AFTER
+    
+    @patch('main.ingest_mailbox')
+    @patch('main.verify_google_jwt', return_value=True)
+    def test_handle_pubsub_sheds_when_saturated(self, mock_verify_jwt, mock_ingest, client, sample_pubsub_message):
+        """Test that a push beyond the concurrency limit gets a 429 with Retry-After."""
+        limiter = main.AdaptiveLimiter(1, 1, 1)
+        limiter.acquire()
+        with patch('main._ingest_limiter', limiter):
+            response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == str(main.OVERLOAD_RETRY_AFTER)
+        mock_ingest.assert_not_called()
+    
+    @patch('main.record_ingest_failure', return_value=False)
+    @patch('main.verify_google_jwt', return_value=True)
+    def test_handle_pubsub_transient_error_backs_off(self, mock_verify_jwt, mock_record, client, sample_pubsub_message):
+        """Test that a throttled Gmail call gets a 503 with Retry-After and lowers the limit."""
+        from googleapiclient.errors import HttpError
+        limiter = main.AdaptiveLimiter(10, 1, 100)
+        error = HttpError(Mock(status=503), b'backend error')
+        with patch('main._ingest_limiter', limiter), patch('main.ingest_mailbox', side_effect=error):
+            response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(ingest_core.TRANSIENT_RETRY_AFTER)
+        assert limiter.limit < 10
+        assert limiter.in_flight == 0
+    
+    @patch('main.record_ingest_failure', return_value=False)
+    @patch('main.verify_google_jwt', return_value=True)
+    def test_handle_pubsub_permanent_error_is_500(self, mock_verify_jwt, mock_record, client, sample_pubsub_message):
+        """Test that a non-transient Gmail error is still a 500 and leaves the limit alone."""
+        from googleapiclient.errors import HttpError
+        limiter = main.AdaptiveLimiter(10, 1, 100)
+        error = HttpError(Mock(status=403), b'forbidden')
+        with patch('main._ingest_limiter', limiter), patch('main.ingest_mailbox', side_effect=error):
+            response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 500
+        assert limiter.limit == 10
+        assert limiter.in_flight == 0
+
+class TestDeadLetter:
+    """Test recording failed notifications in ingest_failures."""
+    
+    @patch('main.get_db_pool')
+    def test_record_ingest_failure(self, mock_get_pool):
+        """Test that a failure is upserted with its class, type and backoff settings."""
+        mock_conn = MagicMock()
+        mock_get_pool.return_value.connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.execute.return_value.fetchone.return_value = (3,)
+        
+        assert main.record_ingest_failure('test@example.com', '12345', ConnectionResetError('reset'))
+        
+        sql, params = mock_conn.execute.call_args[0]
+        assert 'ON CONFLICT (email_address)' in sql
+        assert params['history_id'] == 12345
+        assert params['error_class'] == 'transient'
+        assert params['error_type'] == 'ConnectionResetError'
+        assert params['base'] == ingest_core.DEAD_LETTER_RETRY_BASE
+    
+    @patch('main.get_db_pool')
+    def test_record_ingest_failure_reports_db_errors(self, mock_get_pool):
+        """Test that a failure that can't be written is reported rather than raised."""
+        mock_get_pool.return_value.connection.side_effect = RuntimeError('db down')
+        
+        assert main.record_ingest_failure('test@example.com', '12345', ValueError('bad')) is False
+    
+    @patch('main.get_db_pool')
+    def test_record_ingest_failure_disabled(self, mock_get_pool):
+        """Test that nothing is written when dead-lettering is off."""
+        with patch('main.DEAD_LETTER_ENABLED', False):
+            assert main.record_ingest_failure('test@example.com', '12345', ValueError('bad')) is False
+        mock_get_pool.assert_not_called()
+    
+    @patch('main.record_ingest_failure', return_value=True)
+    @patch('main.ingest_mailbox', side_effect=main.StoreError('db error'))
+    @patch('main.verify_google_jwt', return_value=True)
+    def test_handle_pubsub_acks_dead_lettered_failure(self, mock_verify_jwt, mock_ingest,
+                                                     mock_record, client, sample_pubsub_message):
+        """Test that a recorded failure is acknowledged with 204."""
+        response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        email, history_id, error = mock_record.call_args[0]
+        assert (email, history_id) == ('test@example.com', '12345')
+        assert isinstance(error, main.StoreError)
+    
+    @patch('main.record_ingest_failure')
+    @patch('main.ingest_mailbox', side_effect=main.UnknownUserError('User not found'))
+    @patch('main.verify_google_jwt', return_value=True)
+    def test_handle_pubsub_acks_unknown_user(self, mock_verify_jwt, mock_ingest, mock_record,
+                                            client, sample_pubsub_message):
+        """Test that a push for an address with no user is acknowledged, not dead-lettered."""
+        response = client.post('/handle_pubsub', json=sample_pubsub_message)
+        
+        assert response.status_code == 204
+        mock_record.assert_not_called()
+
+class TestPushRecorder:
+    """Test recording of push envelopes for replay."""
+    
+    def test_record_appends_compact_lines(self, tmp_path):
+        """Test that each push is appended as one JSON line with its auth header."""
+        path = tmp_path / 'pushes.jsonl'
+        recorder = main.PushRecorder(str(path))
+        recorder.record({'message': {'data': 'e30='}}, 'Bearer token')
+        recorder.record({'message': {'data': 'e30='}})
+        
+        lines = path.read_text().splitlines()
+        assert len(lines) == 2
+        first = json.loads(lines[0])
+        assert first['e'] == {'message': {'data': 'e30='}}
+        assert first['a'] == 'Bearer token'
+        assert 'a' not in json.loads(lines[1])
+        assert ': ' not in lines[0]
+    
+    def test_record_failure_does_not_raise(self, tmp_path):
+        """Test that an unwritable log doesn't fail the push."""
+        recorder = main.PushRecorder(str(tmp_path / 'missing' / 'pushes.jsonl'))
+        recorder.record({'message': {}})
+    
+    def test_handle_pubsub_records_envelope(self, client, tmp_path):
+        """Test that handle_pubsub records the envelope when recording is enabled."""
+        path = tmp_path / 'pushes.jsonl'
+        with patch('main._push_recorder', main.PushRecorder(str(path))):
+            client.post('/handle_pubsub', json={'message': {}})
+        
+        assert json.loads(path.read_text())['e'] == {'message': {}}
+
 if __name__ == '__main__':
     pytest.main([__file__])
\ No newline at end of file
@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+# Add the parent directory to the path so we can import replay_failures
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import replay_failures
+
+def _ingest(failures, errors=None):
+    """A stand-in for main that hands out failures in claim-sized batches."""
+    errors = errors or {}
+    pending = list(failures)
+    ingest = MagicMock()
+    ingest.is_transient.side_effect = main.is_transient
+    ingest.UnknownUserError = main.UnknownUserError
+    ingest._mailbox_locks = main.KeyedLocks()
+    ingest.MAILBOX_LOCK_TIMEOUT = 0.01
+
+    def claim(limit, lease, max_attempts):
+        batch = pending[:limit]
+        del pending[:limit]
+        return batch
+
+    def ingest_mailbox(email_address, history_id):
+        if email_address in errors:
+            raise errors[email_address]
+        return 1
+
+    ingest.claim_ingest_failures.side_effect = claim
+    ingest.ingest_mailbox.side_effect = ingest_mailbox
+    return ingest
+
+def _failure(email_address, history_id=10, attempts=1):
+    return main.IngestFailure(email_address, history_id, attempts)
+
+class TestReplay:
+    """Test replaying dead-lettered notifications."""
+
+    def test_resolves_stored_and_records_failed(self):
+        """Test that stored mailboxes are resolved and failed ones recorded again."""
+        ingest = _ingest(
+            [_failure('a@example.com'), _failure('b@example.com', 20)],
+            errors={'b@example.com': ConnectionResetError('reset')}
+        )
+
+        results = replay_failures.replay(ingest, rate=0)
+
+        assert results == {'resolved': 1, 'transient': 1}
+        ingest.resolve_ingest_failure.assert_called_once_with('a@example.com', 10)
+        email, history_id, error = ingest.record_ingest_failure.call_args[0]
+        assert (email, history_id) == ('b@example.com', '20')
+        assert isinstance(error, ConnectionResetError)
+
+    def test_claims_in_batches_until_empty(self):
+        """Test that rows are claimed batch by batch until none are due."""
+        ingest = _ingest([_failure(f"{i}@example.com") for i in range(5)])
+
+        results = replay_failures.replay(ingest, batch_size=2, rate=0)
+
+        assert results['resolved'] == 5
+        assert [c[0][0] for c in ingest.claim_ingest_failures.call_args_list] == [2, 2, 2, 2]
+
+    def test_limit(self):
+        """Test that no more than limit rows are claimed."""
+        ingest = _ingest([_failure(f"{i}@example.com") for i in range(5)])
+
+        results = replay_failures.replay(ingest, batch_size=2, rate=0, limit=3)
+
+        assert results['resolved'] == 3
+        assert [c[0][0] for c in ingest.claim_ingest_failures.call_args_list] == [2, 1]
+
+    def test_stops_while_dependency_is_down(self):
+        """Test that a run of transient failures stops the replay."""
+        failures = [_failure(f"{i}@example.com") for i in range(6)]
+        ingest = _ingest(failures, errors={f.email_address: TimeoutError() for f in failures})
+
+        results = replay_failures.replay(ingest, batch_size=2, workers=1, rate=0, stop_after=2)
+
+        assert results == {'transient': 2}
+
+    def test_permanent_failures_do_not_stop_replay(self):
+        """Test that permanent failures are recorded without stopping the run."""
+        failures = [_failure(f"{i}@example.com") for i in range(4)]
+        ingest = _ingest(failures, errors={f.email_address: ValueError('bad') for f in failures})
+
+        results = replay_failures.replay(ingest, batch_size=2, rate=0, stop_after=2)
+
+        assert results == {'permanent': 4}
+
+    def test_unknown_user_is_resolved(self):
+        """Test that a mailbox with no user is dropped instead of recorded again."""
+        ingest = _ingest([_failure('a@example.com')],
+                         errors={'a@example.com': main.UnknownUserError('User not found')})
+
+        results = replay_failures.replay(ingest, rate=0)
+
+        assert results == {'resolved': 1}
+        ingest.resolve_ingest_failure.assert_called_once_with('a@example.com', 10)
+        ingest.record_ingest_failure.assert_not_called()
+
+    def test_busy_mailbox_is_left_for_later(self):
+        """Test that a mailbox being scanned by a push is not replayed alongside it."""
+        ingest = _ingest([_failure('a@example.com')])
+
+        with ingest._mailbox_locks.hold('a@example.com'):
+            results = replay_failures.replay(ingest, rate=0)
+
+        assert results == {'busy': 1}
+        ingest.ingest_mailbox.assert_not_called()
+        ingest.resolve_ingest_failure.assert_not_called()
+        ingest.record_ingest_failure.assert_not_called()
+
+class TestRateLimiter:
+    """Test spacing of replays."""
+
+    def test_spaces_calls(self):
+        """Test that calls are spaced by the interval."""
+        limiter = replay_failures.RateLimiter(50)
+        started = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+
+        assert time.monotonic() - started >= 5 / 50
+
+    def test_zero_rate_is_unlimited(self):
+        """Test that a rate of 0 never waits."""
+        limiter = replay_failures.RateLimiter(0)
+        started = time.monotonic()
+        for _ in range(1000):
+            limiter.wait()
+
+        assert time.monotonic() - started < 0.5
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,154 @@
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+# Add the parent directory to the path so we can import subscriber
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import subscriber
+
+def _message(email_address='test@example.com', history_id=100, data=None):
+    message = MagicMock()
+    if data is None:
+        data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode()
+    message.data = data
+    message.message_id = f'{email_address}-{history_id}'
+    return message
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+class TestProcessBatch:
+    """Test batch processing and bulk acknowledgement."""
+
+    def test_one_scan_per_mailbox(self, executor):
+        """Test that notifications for a mailbox fold into one scan at the highest history ID."""
+        ingest = MagicMock(return_value=True)
+        messages = [_message('a@example.com', 5), _message('a@example.com', 9), _message('b@example.com', 3)]
+
+        subscriber.process_batch(messages, executor, ingest)
+
+        assert sorted(call[0] for call in ingest.call_args_list) == [
+            ('a@example.com', 9), ('b@example.com', 3)
+        ]
+        for message in messages:
+            message.ack.assert_called_once()
+            message.nack.assert_not_called()
+
+    def test_failed_mailbox_is_nacked(self, executor):
+        """Test that only the messages of a failed mailbox are redelivered."""
+        ingest = MagicMock(side_effect=lambda email, history: email != 'bad@example.com')
+        good, bad = _message('good@example.com', 1), _message('bad@example.com', 2)
+
+        subscriber.process_batch([good, bad], executor, ingest)
+
+        good.ack.assert_called_once()
+        bad.nack.assert_called_once()
+        bad.ack.assert_not_called()
+
+    def test_malformed_message_is_acked(self, executor):
+        """Test that notifications that cannot be parsed are dropped, not redelivered."""
+        ingest = MagicMock(return_value=True)
+        malformed = _message(data=b'not json')
+
+        subscriber.process_batch([malformed], executor, ingest)
+
+        malformed.ack.assert_called_once()
+        ingest.assert_not_called()
+
+    @patch('subscriber.record_ingest_failure', return_value=False)
+    @patch('subscriber.ingest_mailbox', side_effect=RuntimeError('Gmail down'))
+    def test_ingest_errors_report_failure(self, mock_ingest, mock_record):
+        """Test that ingest errors are reported as a failed mailbox when they can't be dead-lettered."""
+        assert subscriber._ingest('test@example.com', 10) is False
+        mock_ingest.assert_called_once_with('test@example.com', '10')
+
+    @patch('subscriber.record_ingest_failure', return_value=True)
+    @patch('subscriber.ingest_mailbox', side_effect=RuntimeError('Gmail down'))
+    def test_dead_lettered_errors_are_acked(self, mock_ingest, mock_record):
+        """Test that a dead-lettered failure is acked rather than redelivered."""
+        assert subscriber._ingest('test@example.com', 10) is True
+        assert mock_record.call_args[0][:2] == ('test@example.com', '10')
+
+class TestNotificationBatcher:
+    """Test batching by size and by wait time."""
+
+    def _batcher(self, **kwargs):
+        batches = []
+        processed = threading.Event()
+
+        def process(batch, executor):
+            batches.append(batch)
+            processed.set()
+
+        batcher = subscriber.NotificationBatcher(process=process, workers=1, **kwargs)
+        return batcher, batches, processed
+
+    def test_flushes_full_batch(self):
+        """Test that a full batch is processed without waiting."""
+        batcher, batches, processed = self._batcher(batch_size=3, max_wait=60)
+        for i in range(3):
+            batcher.add(_message(history_id=i))
+
+        assert processed.wait(2)
+        assert len(batches[0]) == 3
+        batcher.close()
+
+    def test_flushes_after_max_wait(self):
+        """Test that a partial batch is processed once its first message has waited max_wait."""
+        batcher, batches, processed = self._batcher(batch_size=100, max_wait=0.1)
+        start = time.monotonic()
+        batcher.add(_message())
+
+        assert processed.wait(2)
+        assert time.monotonic() - start >= 0.1
+        assert len(batches[0]) == 1
+        batcher.close()
+
+    def test_close_flushes_and_nacks_late_messages(self):
+        """Test that close processes buffered messages and nacks later arrivals."""
+        batcher, batches, processed = self._batcher(batch_size=100, max_wait=60)
+        batcher.add(_message())
+        batcher.close()
+        late = _message(history_id=2)
+        batcher.add(late)
+
+        assert len(batches) == 1
+        late.nack.assert_called_once()
+
+class TestRun:
+    """Test subscriber wiring."""
+
+    def test_subscription_path(self):
+        """Test that short names are qualified with the project."""
+        with patch('subscriber.GOOGLE_PROJECT_ID', 'proj'):
+            assert subscriber.subscription_path('sub') == 'projects/proj/subscriptions/sub'
+        assert subscriber.subscription_path('projects/x/subscriptions/y') == 'projects/x/subscriptions/y'
+
+    @patch('subscriber.signal.signal')
+    @patch('subscriber.pubsub_v1.SubscriberClient')
+    def test_subscribes_with_flow_control(self, mock_client_cls, mock_signal):
+        """Test that the stream is opened with flow control and stopped cleanly."""
+        future = mock_client_cls.return_value.subscribe.return_value
+        future.done.return_value = True
+
+        subscriber.run('projects/p/subscriptions/s')
+
+        args, kwargs = mock_client_cls.return_value.subscribe.call_args
+        assert args[0] == 'projects/p/subscriptions/s'
+        flow_control = kwargs['flow_control']
+        assert flow_control.max_messages == subscriber.SUBSCRIBER_MAX_MESSAGES
+        assert flow_control.max_bytes == subscriber.SUBSCRIBER_MAX_BYTES
+        assert flow_control.max_lease_duration == subscriber.SUBSCRIBER_MAX_LEASE
+        future.cancel.assert_called_once()
+
+if __name__ == '__main__':
+    pytest.main([__file__])
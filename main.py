@@ -7,35 +7,102 @@ in the inbound_emails table for further processing.
 """
 
 import os
+import atexit
 import json
 import base64
 import logging
+import sys
+import threading
+import time
 from datetime import datetime
-from typing import Dict, Any, Optional, Tuple
-import email
-from email.mime.text import MIMEText
-
-import jwt
-import psycopg
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
 import functions_framework
 
+# Gmail clients, history reading and fetching, message packing, the batched
+# inbound_emails writer, mailbox cursors and dead letters are shared with the
+# Cloud Run service in email-ingest-service/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email-ingest-service'))
+import ingest_core
+from ingest_core import (
+    AdaptiveLimiter,
+    DEAD_LETTER_ENABLED,
+    EmailColumns,
+    GMAIL_BATCH_SIZE,
+    GOOGLE_PROJECT_ID,
+    GmailClientFactory,
+    HistoryReader,
+    IngestFailure,
+    KeyedLocks,
+    LazyModule,
+    MAILBOX_LOCK_TIMEOUT,
+    PushRecorder,
+    TTLCache,
+    _chunked_last,
+    discovery,
+    discovery_cache,
+    fetch_messages,
+    google_auth_httplib2,
+    googleapiclient_errors,
+    googleapiclient_http,
+    is_transient,
+    pack_raw_message,
+    parse_headers,
+    psycopg,
+    requests,
+    retry_after,
+    service_account,
+    unpack_raw_message,
+    zstandard,
+)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The Google client libraries, psycopg and PyJWT dominate cold start, so they
+# are imported by the first request that needs them. functions_framework is
+# already loaded by the time the framework imports this module. The ones
+# ingest_core uses are its LazyModules.
+jwt = LazyModule('jwt')
+psycopg_pool = LazyModule('psycopg_pool')
+_DEFERRED_MODULES = (
+    jwt, psycopg, psycopg_pool, requests, service_account, discovery, discovery_cache,
+    googleapiclient_http, google_auth_httplib2, googleapiclient_errors, zstandard
+)
+
 # Environment variables
 SUPABASE_DB_URL = os.getenv('SUPABASE_DB_URL')
 SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-GOOGLE_CLIENT_EMAIL = os.getenv('GOOGLE_CLIENT_EMAIL')
-GOOGLE_PRIVATE_KEY = os.getenv('GOOGLE_PRIVATE_KEY', '').replace('\\n', '\n')
-GOOGLE_PROJECT_ID = os.getenv('GOOGLE_PROJECT_ID')
-GMAIL_WATCH_LABEL = os.getenv('GMAIL_WATCH_LABEL', 'school-events')
 SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
+# Postgres connection pool sizing; keep DB_POOL_MAX_SIZE in line with the
+# function's concurrency so requests rarely wait for a connection.
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Executions before psycopg server-side prepares a statement; empty disables
+DB_PREPARE_THRESHOLD = os.getenv('DB_PREPARE_THRESHOLD', '1')
+
+# email address -> auth.users id cache; unknown addresses are remembered
+# briefly so repeated pushes for them don't reach Gmail
+USER_ID_CACHE_TTL = int(os.getenv('USER_ID_CACHE_TTL', '600'))
+USER_ID_NEGATIVE_TTL = int(os.getenv('USER_ID_NEGATIVE_TTL', '60'))
+USER_ID_CACHE_SIZE = int(os.getenv('USER_ID_CACHE_SIZE', '1000'))
+
+# Build clients in a background thread once the instance is serving, so
+# the first push doesn't pay for imports, the token fetch and the pool
+WARM_UP = os.getenv('WARM_UP', 'false').lower() == 'true'
+
+# Load shedding: pushes beyond the adaptive concurrency limit get a 429 and
+# transient Gmail or database failures a 503, both with Retry-After
+CONCURRENCY_LIMIT_INITIAL = int(os.getenv('CONCURRENCY_LIMIT_INITIAL', '20'))
+CONCURRENCY_LIMIT_MIN = int(os.getenv('CONCURRENCY_LIMIT_MIN', '2'))
+CONCURRENCY_LIMIT_MAX = int(os.getenv('CONCURRENCY_LIMIT_MAX', '200'))
+OVERLOAD_RETRY_AFTER = int(os.getenv('OVERLOAD_RETRY_AFTER', '5'))
 
-# Validate required environment variables
+# Required environment variables, checked by the first request (or warm-up)
+# rather than at import
 REQUIRED_ENV_VARS = [
     'SUPABASE_DB_URL',
     'SUPABASE_SERVICE_ROLE_KEY', 
@@ -44,9 +111,22 @@ REQUIRED_ENV_VARS = [
     'GOOGLE_PROJECT_ID'
 ]
 
-for var in REQUIRED_ENV_VARS:
-    if not os.getenv(var):
-        raise ValueError(f"Missing required environment variable: {var}")
+_env_validated = False
+
+def validate_env() -> None:
+    """
+    Check that every required environment variable is set.
+    
+    Raises:
+        ValueError: Naming the first missing variable
+    """
+    global _env_validated
+    if _env_validated:
+        return
+    for var in REQUIRED_ENV_VARS:
+        if not os.getenv(var):
+            raise ValueError(f"Missing required environment variable: {var}")
+    _env_validated = True
 
 class EmailIngestError(Exception):
     """Base exception for email ingest errors"""
@@ -64,6 +144,68 @@ class DatabaseError(EmailIngestError):
     """Database operation failed"""
     pass
 
+class UnknownUserError(EmailIngestError):
+    """No user has the mailbox's email address"""
+    pass
+
+_UNKNOWN_USER = ''
+_user_ids = TTLCache(maxsize=USER_ID_CACHE_SIZE, ttl=USER_ID_CACHE_TTL)
+
+def invalidate_user_id(email_address: Optional[str] = None) -> None:
+    """
+    Forget the cached user id for an address, or for every address.
+    
+    Args:
+        email_address: Address to forget; None clears the whole cache
+    """
+    if email_address is None:
+        _user_ids.clear()
+    else:
+        _user_ids.pop(email_address)
+
+_db_pool: Optional['psycopg_pool.ConnectionPool'] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> 'psycopg_pool.ConnectionPool':
+    """
+    Return the process-wide Postgres connection pool, opening it on first use.
+    
+    Connections are health-checked on checkout and keep their prepared
+    statements across requests.
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = psycopg_pool.ConnectionPool(
+                    SUPABASE_DB_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    timeout=DB_POOL_TIMEOUT,
+                    check=psycopg_pool.ConnectionPool.check_connection,
+                    kwargs={
+                        'prepare_threshold': int(DB_PREPARE_THRESHOLD) if DB_PREPARE_THRESHOLD else None
+                    },
+                    name='inbound-emails',
+                    open=True
+                )
+                atexit.register(pool.close)
+                _db_pool = pool
+    return _db_pool
+
+def db_pool_stats() -> Dict[str, int]:
+    """
+    Return pool size, saturation and wait-time counters.
+    
+    Returns:
+        psycopg_pool stats (pool_size, pool_available, requests_waiting,
+        requests_wait_ms, ...), empty until the pool has been opened
+    """
+    if _db_pool is None:
+        return {}
+    return _db_pool.get_stats()
+
 def verify_pubsub_jwt(request) -> Dict[str, Any]:
     """
     Verify Google-signed JWT from Pub/Sub push notification.
@@ -164,9 +306,15 @@ def extract_pubsub_data(request) -> Tuple[str, str]:
         logger.error(f"Failed to extract Pub/Sub data: {str(e)}")
         raise EmailIngestError(f"Failed to extract Pub/Sub data: {str(e)}")
 
-def get_gmail_service():
+_gmail_clients = GmailClientFactory()
+
+def get_gmail_service(email_address: Optional[str] = None):
     """
-    Create authenticated Gmail API service.
+    Return an authenticated Gmail API service for a mailbox.
+    
+    Args:
+        email_address: Mailbox to act as through domain-wide delegation;
+            None for the service account itself
     
     Returns:
         Gmail API service object
@@ -175,120 +323,102 @@ def get_gmail_service():
         GmailAPIError: If service creation fails
     """
     try:
-        # Create credentials from service account
-        credentials_info = {
-            "type": "service_account",
-            "project_id": GOOGLE_PROJECT_ID,
-            "private_key_id": "",
-            "private_key": GOOGLE_PRIVATE_KEY,
-            "client_email": GOOGLE_CLIENT_EMAIL,
-            "client_id": "",
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs"
-        }
-        
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info,
-            scopes=['https://www.googleapis.com/auth/gmail.readonly']
-        )
-        
-        # Build Gmail service
-        service = build('gmail', 'v1', credentials=credentials)
-        return service
+        return _gmail_clients.service(email_address)
         
     except Exception as e:
         logger.error(f"Failed to create Gmail service: {str(e)}")
         raise GmailAPIError(f"Failed to create Gmail service: {str(e)}")
 
-def fetch_email_content(email_address: str, history_id: str) -> Tuple[str, Dict[str, str]]:
+def parse_raw_message(raw_data: str) -> Tuple[bytes, Dict[str, str]]:
     """
-    Fetch email content using Gmail API.
+    Decode a format='raw' Gmail message and extract its headers.
     
     Args:
-        email_address: Gmail address to fetch from
-        history_id: History ID from Pub/Sub notification
+        raw_data: base64url-encoded MIME message
         
     Returns:
-        Tuple of (raw_body, headers_dict)
-        
-    Raises:
-        GmailAPIError: If Gmail API operation fails
+        Tuple of (raw message bytes, headers_dict)
     """
+    raw_body = base64.urlsafe_b64decode(raw_data)
+    
     try:
-        service = get_gmail_service()
-        
-        # Get history to find new messages
-        try:
-            history_response = service.users().history().list(
-                userId=email_address,
-                startHistoryId=history_id,
-                labelId=GMAIL_WATCH_LABEL
-            ).execute()
-        except HttpError as e:
-            if e.resp.status == 404:
-                # History ID not found, might be too old
-                logger.warning(f"History ID {history_id} not found, fetching recent messages")
-                # Fallback to recent messages
-                messages_response = service.users().messages().list(
-                    userId=email_address,
-                    labelIds=[GMAIL_WATCH_LABEL],
-                    maxResults=1
-                ).execute()
-                
-                messages = messages_response.get('messages', [])
-                if not messages:
-                    raise GmailAPIError("No messages found")
-                    
-                message_id = messages[0]['id']
-            else:
-                raise GmailAPIError(f"Gmail API error: {str(e)}")
-        else:
-            # Extract message ID from history
-            history = history_response.get('history', [])
-            if not history:
-                raise GmailAPIError("No history found")
-            
-            # Get the most recent message from history
-            messages_added = []
-            for h in history:
-                messages_added.extend(h.get('messagesAdded', []))
-            
-            if not messages_added:
-                raise GmailAPIError("No new messages in history")
-            
-            message_id = messages_added[-1]['message']['id']
+        headers = parse_headers(raw_body)
+    except Exception as e:
+        logger.warning(f"Failed to parse email headers: {str(e)}")
+        headers = {}
+    
+    return raw_body, headers
+
+def load_raw_message(user_id: str, gmail_message_id: str) -> Optional[bytes]:
+    """
+    Read back the original raw message a user received as a Gmail message.
+    
+    Args:
+        user_id: User whose mailbox received the message
+        gmail_message_id: Gmail message id, unique within that mailbox
         
-        # Fetch full message content
-        try:
-            message = service.users().messages().get(
-                userId=email_address,
-                id=message_id,
-                format='raw'
-            ).execute()
-        except HttpError as e:
-            raise GmailAPIError(f"Failed to fetch message {message_id}: {str(e)}")
-        
-        # Decode raw message
-        raw_data = message.get('raw', '')
-        if not raw_data:
-            raise GmailAPIError("No raw data in message")
+    Returns:
+        Raw message bytes, or None if no such email is stored
         
-        try:
-            raw_body = base64.urlsafe_b64decode(raw_data).decode('utf-8')
-        except UnicodeDecodeError:
-            # Try latin-1 as fallback
-            raw_body = base64.urlsafe_b64decode(raw_data).decode('latin-1')
+    Raises:
+        DatabaseError: If database operation fails
+    """
+    try:
+        with get_db_pool().connection() as conn:
+            row = conn.execute("""
+                SELECT e.raw_body, e.raw_parts, ARRAY(
+                    SELECT b.content
+                    FROM jsonb_array_elements(e.raw_parts) WITH ORDINALITY AS p(part, n)
+                    JOIN email_blobs b ON b.hash = p.part->>1
+                    ORDER BY p.n
+                )
+                FROM inbound_emails e
+                WHERE e.user_id = %s AND e.gmail_message_id = %s
+            """, (user_id, gmail_message_id)).fetchone()
+    except Exception as e:
+        logger.error(f"Failed to load raw message: {str(e)}")
+        raise DatabaseError(f"Failed to load raw message: {str(e)}")
+    
+    if not row:
+        return None
+    return unpack_raw_message(row[0], row[1], row[2])
+
+def _parse_message(response: Dict[str, Any], message_id: str) -> Dict[str, Any]:
+    """
+    Turn a format='raw' messages.get response into the stored email dict.
+    
+    Raises:
+        GmailAPIError: If the response has no raw message
+    """
+    raw_data = response.get('raw', '')
+    if not raw_data:
+        raise GmailAPIError("No raw data in message")
+    raw_body, headers = parse_raw_message(raw_data)
+    return {
+        'message_id': message_id,
+        'raw_body': raw_body,
+        'headers': headers
+    }
+
+def fetch_email_content(reader: HistoryReader) -> Iterator[Tuple[List[Dict[str, Any]], bool]]:
+    """
+    Stream every message a history reader yields, one Gmail batch at a time.
+    
+    Args:
+        reader: HistoryReader positioned at the first unprocessed history ID
         
-        # Parse email to extract headers
-        try:
-            email_msg = email.message_from_string(raw_body)
-            headers = dict(email_msg.items())
-        except Exception as e:
-            logger.warning(f"Failed to parse email headers: {str(e)}")
-            headers = {}
+    Yields:
+        Tuples of (at most GMAIL_BATCH_SIZE {'message_id', 'raw_body', 'headers'}
+        dicts, whether it is the last batch). The last batch may be empty, and
+        once it comes reader.history_id is the newest history Gmail reported.
         
-        return raw_body, headers
+    Raises:
+        GmailAPIError: If Gmail API operation fails
+    """
+    try:
+        for message_ids, last in _chunked_last(reader, GMAIL_BATCH_SIZE):
+            emails = fetch_messages(reader.service, reader.user_email, message_ids, _parse_message) if message_ids else []
+            yield emails, last
         
     except GmailAPIError:
         raise
@@ -296,83 +426,279 @@ def fetch_email_content(email_address: str, history_id: str) -> Tuple[str, Dict[
         logger.error(f"Failed to fetch email content: {str(e)}")
         raise GmailAPIError(f"Failed to fetch email content: {str(e)}")
 
-def find_user_id(email_address: str) -> Optional[str]:
+class MailboxCursors(ingest_core.MailboxCursors):
+    """ingest_core.MailboxCursors on the function's connection pool."""
+    
+    def connection(self):
+        return get_db_pool().connection()
+
+# Only one history scan per mailbox runs at a time in this process; pushes
+# that arrive meanwhile wait for it and are then usually already covered by
+# the cursor it left behind.
+_mailbox_locks = KeyedLocks()
+_mailbox_cursors = MailboxCursors()
+
+def get_mailbox_cursor(email_address: str, min_history_id: Optional[int] = None) -> Optional[int]:
     """
-    Find user_id based on email address.
+    Return the last fully processed history ID for a mailbox.
     
     Args:
-        email_address: Email address to look up
+        email_address: Mailbox to look up
+        min_history_id: If the in-process copy already covers this, no query is made
         
     Returns:
-        User ID if found, None otherwise
+        History ID, or None if the mailbox has never been processed
         
     Raises:
         DatabaseError: If database operation fails
     """
     try:
-        with psycopg.connect(SUPABASE_DB_URL) as conn:
-            with conn.cursor() as cur:
-                # Look up user by email in auth.users table
-                cur.execute(
-                    "SELECT id FROM auth.users WHERE email = %s",
-                    (email_address,)
-                )
-                result = cur.fetchone()
-                return result[0] if result else None
-                
+        return _mailbox_cursors.get(email_address, min_history_id)
     except Exception as e:
-        logger.error(f"Failed to find user ID: {str(e)}")
-        raise DatabaseError(f"Failed to find user ID: {str(e)}")
+        logger.error(f"Failed to read mailbox cursor: {str(e)}")
+        raise DatabaseError(f"Failed to read mailbox cursor: {str(e)}")
 
-def store_email(user_id: str, raw_body: str, headers: Dict[str, str], history_id: str) -> bool:
+def _pack_emails(emails: List[Dict[str, Any]], history_id: str) -> Tuple[List[tuple], Dict[str, bytes]]:
     """
-    Store email in inbound_emails table.
+    Pack emails into inbound_emails column values and the blobs they reference.
     
     Args:
-        user_id: User ID to associate email with
-        raw_body: Raw email content
-        headers: Email headers dictionary
-        history_id: Gmail history ID for idempotency
+        emails: {'message_id', 'raw_body', 'headers'} dicts
+        history_id: Gmail history ID of the notification
         
     Returns:
-        True if inserted, False if duplicate (idempotent)
+        Tuple of (rows, blobs); each row holds the INBOUND_EMAIL_COLUMNS
+        values: (raw_body, raw_parts, subject, from_email, headers,
+        gmail_history, received_at, gmail_message_id)
+    """
+    received_at = datetime.utcnow()
+    rows = []
+    blobs: Dict[str, bytes] = {}
+    for e in emails:
+        headers = e['headers']
+        packed = pack_raw_message(e['raw_body'])
+        blobs.update(packed.blobs)
+        rows.append((
+            packed.body, json.dumps(packed.parts), headers.get('Subject', ''),
+            headers.get('From', ''), json.dumps(headers), history_id, received_at,
+            e['message_id']
+        ))
+    return rows, blobs
+
+# inbound_emails as the function writes it; _pack_emails produces the values
+INBOUND_EMAIL_COLUMNS = EmailColumns(
+    values=(
+        ('raw_body', 'bytea'),
+        ('raw_parts', 'jsonb'),
+        ('subject', 'text'),
+        ('from_email', 'text'),
+        ('headers', 'jsonb'),
+        ('gmail_history', 'text'),
+        ('received_at', 'timestamp'),
+        ('gmail_message_id', 'text'),
+    ),
+    computed=(('processed', 'false'),),
+)
+
+class EmailWriter(ingest_core.EmailWriter):
+    """ingest_core.EmailWriter for the function's columns, pool and user id cache."""
+    
+    columns = INBOUND_EMAIL_COLUMNS
+    
+    def pack(self, emails: List[Dict[str, Any]], history_id: str) -> Tuple[List[tuple], Dict[str, bytes]]:
+        return _pack_emails(emails, history_id)
+    
+    def connection(self):
+        return get_db_pool().connection()
+    
+    def cached_user_id(self, mailbox: str) -> Optional[str]:
+        # _UNKNOWN_USER is resolved again by the statement
+        return _user_ids.get(mailbox) or None
+    
+    def forget_user_id(self, mailbox: str) -> None:
+        invalidate_user_id(mailbox)
+
+_email_writer = EmailWriter()
+
+def cached_user_id(email_address: str) -> Optional[str]:
+    """
+    Return the cached user_id for an address without touching the database.
+    
+    Args:
+        email_address: Email address to look up
+        
+    Returns:
+        User ID if cached, _UNKNOWN_USER if the address recently had no
+        user, None if nothing is cached
+    """
+    return _user_ids.get(email_address)
+
+def store_emails(email_address: str, emails: List[Dict[str, Any]], history_id: str,
+                 cursor: Optional[int] = None) -> Tuple[int, Optional[str]]:
+    """
+    Store a batch of emails in inbound_emails through the shared write buffer.
+    
+    The emails are committed together with those of any concurrent requests,
+    in one statement that also resolves the user when it isn't cached and
+    advances the mailbox cursor when asked to.
+    
+    Args:
+        email_address: Mailbox the emails were delivered to
+        emails: {'message_id', 'raw_body', 'headers'} dicts; raw_body is the
+            raw message bytes and is stored through pack_raw_message
+        history_id: Gmail history ID of the notification
+        cursor: History ID the mailbox cursor moves forward to once the
+            emails are stored, if they complete a scan
+        
+    Returns:
+        Tuple of (number inserted, user_id); duplicates are not counted and
+        user_id is None if no user has this address
         
     Raises:
         DatabaseError: If database operation fails
     """
+    if not emails and cursor is None:
+        return 0, _user_ids.get(email_address) or None
     try:
-        with psycopg.connect(SUPABASE_DB_URL) as conn:
-            with conn.cursor() as cur:
-                # Extract common headers
-                subject = headers.get('Subject', '')
-                from_email = headers.get('From', '')
-                received_at = datetime.utcnow()
-                
-                # Insert with conflict handling for idempotency
-                cur.execute("""
-                    INSERT INTO inbound_emails (
-                        id, user_id, raw_body, subject, from_email, 
-                        headers, gmail_history, received_at, processed
-                    )
-                    VALUES (
-                        gen_random_uuid(), %s, %s, %s, %s, %s, %s, %s, false
-                    )
-                    ON CONFLICT (gmail_history) DO NOTHING
-                    RETURNING id
-                """, (
-                    user_id, raw_body, subject, from_email,
-                    json.dumps(headers), history_id, received_at
-                ))
-                
-                result = cur.fetchone()
-                conn.commit()
-                
-                # Return True if inserted, False if duplicate
-                return result is not None
-                
+        result = _email_writer.write(email_address, emails, history_id, cursor)
     except Exception as e:
         logger.error(f"Failed to store email: {str(e)}")
         raise DatabaseError(f"Failed to store email: {str(e)}")
+    
+    if result.user_id:
+        _user_ids.set(email_address, result.user_id)
+        if result.cursor is not None:
+            _mailbox_cursors.remember(email_address, result.cursor)
+    else:
+        _user_ids.set(email_address, _UNKNOWN_USER, ttl=USER_ID_NEGATIVE_TTL)
+    return len(result.inserted), result.user_id
+
+def ingest_mailbox(email_address: str, history_id: str) -> Tuple[int, int]:
+    """
+    Store every message added to a mailbox since its cursor, then advance it.
+    
+    The caller must hold the mailbox's lock. The cursor moves in the same
+    statement that stores the last of the messages, so only once everything
+    is stored.
+    
+    Args:
+        email_address: Mailbox to scan
+        history_id: History ID from the notification
+        
+    Returns:
+        Tuple of (emails fetched, emails newly inserted)
+        
+    Raises:
+        UnknownUserError: If no user has this address
+        GmailAPIError: If Gmail API calls fail
+        DatabaseError: If database operation fails
+    """
+    # Skip pushes already covered by an earlier scan
+    cursor = get_mailbox_cursor(email_address, int(history_id))
+    if cursor is not None and int(history_id) <= cursor:
+        logger.info(f"History {history_id} already processed for {email_address} (cursor {cursor})")
+        return 0, 0
+    
+    # Stream every message since the last processed history ID using
+    # batched Gmail API calls and store each batch in one transaction
+    start_history_id = str(cursor) if cursor is not None else history_id
+    logger.info(f"Fetching email content from history {start_history_id}")
+    reader = HistoryReader(get_gmail_service(email_address), email_address, start_history_id)
+    fetched = 0
+    inserted = 0
+    for emails, last in fetch_email_content(reader):
+        logger.info(f"Storing {len(emails)} emails in database")
+        # Everything up to the newest history Gmail reported is stored along
+        # with the last batch, in the same statement
+        advance_to = max(int(reader.history_id or 0), int(history_id)) if last else None
+        batch_inserted, user_id = store_emails(email_address, emails, history_id, advance_to)
+        if not user_id:
+            raise UnknownUserError(f"No user found for email {email_address}")
+        fetched += len(emails)
+        inserted += batch_inserted
+    
+    if not fetched:
+        logger.info(f"No new messages since history {start_history_id}")
+    if inserted:
+        logger.info(f"Successfully stored {inserted} new emails for user {user_id}")
+    if inserted < fetched:
+        logger.info(f"{fetched - inserted} emails already exist (history {history_id})")
+    return fetched, inserted
+
+_ingest_limiter = AdaptiveLimiter(CONCURRENCY_LIMIT_INITIAL, CONCURRENCY_LIMIT_MIN, CONCURRENCY_LIMIT_MAX)
+
+class IngestFailures(ingest_core.IngestFailures):
+    """ingest_core.IngestFailures on the function's connection pool."""
+    
+    def connection(self):
+        return get_db_pool().connection()
+
+_ingest_failures = IngestFailures()
+
+def record_ingest_failure(email_address: str, history_id: str, error: BaseException) -> bool:
+    """
+    Persist a failed notification to ingest_failures for a later replay.
+    
+    There is one row per mailbox: a scan always starts from the mailbox
+    cursor, so the newest failed history ID covers the older ones. Each
+    further failure doubles the wait before the next attempt.
+    
+    Args:
+        email_address: Mailbox whose ingest failed
+        history_id: History ID of the notification
+        error: The exception that failed it
+        
+    Returns:
+        True if recorded; False if dead-lettering is off or the row could
+        not be written, in which case the push has to be redelivered
+    """
+    if not DEAD_LETTER_ENABLED:
+        return False
+    error_class = 'transient' if is_transient(error) else 'permanent'
+    try:
+        attempts = _ingest_failures.record(email_address, history_id, error, error_class)
+    except Exception as e:
+        logger.error(f"Failed to record ingest failure for {email_address}: {str(e)}")
+        return False
+    logger.warning(
+        f"Dead-lettered history {history_id} for {email_address} after {error_class} "
+        f"{type(error).__name__} (attempt {attempts}): {str(error)}"
+    )
+    return True
+
+def claim_ingest_failures(limit: int, lease: float, max_attempts: int) -> List[IngestFailure]:
+    """
+    Claim failures that are due for another attempt.
+    
+    Claimed rows are not due again for lease seconds, so concurrent replays
+    don't pick them up; recording or resolving a failure ends the lease.
+    
+    Args:
+        limit: Most rows to claim
+        lease: Seconds before an unresolved claim is due again
+        max_attempts: Rows that failed this often are left alone
+        
+    Returns:
+        The claimed failures, longest overdue first
+    """
+    return _ingest_failures.claim(limit, lease, max_attempts)
+
+def resolve_ingest_failure(email_address: str, history_id: int) -> None:
+    """
+    Drop a mailbox's failure once history_id is stored.
+    
+    Args:
+        email_address: Mailbox that was replayed
+        history_id: History ID that is now stored; a newer failure recorded
+            meanwhile is kept
+    """
+    _ingest_failures.resolve(email_address, history_id)
+
+# Append every push envelope to this file for
+# email-ingest-service/benchmarks/push_replay.py
+PUSH_RECORD_FILE = os.getenv('PUSH_RECORD_FILE')
+
+_push_recorder = PushRecorder(PUSH_RECORD_FILE) if PUSH_RECORD_FILE else None
 
 @functions_framework.http
 def handle_pubsub(request):
@@ -386,6 +712,11 @@ def handle_pubsub(request):
         HTTP response
     """
     try:
+        validate_env()
+        
+        if _push_recorder is not None:
+            _push_recorder.record(request.get_json(silent=True), request.headers.get('Authorization'))
+        
         # Step 1: Verify Google-signed JWT
         logger.info("Verifying Pub/Sub JWT")
         jwt_payload = verify_pubsub_jwt(request)
@@ -396,26 +727,64 @@ def handle_pubsub(request):
         history_id, email_address = extract_pubsub_data(request)
         logger.info(f"Processing history {history_id} for {email_address}")
         
-        # Step 3: Find user ID
-        logger.info(f"Finding user ID for {email_address}")
-        user_id = find_user_id(email_address)
-        if not user_id:
+        # Step 3: Check the user ID cache; on a miss the lookup is folded
+        # into the insert in step 5
+        user_id = cached_user_id(email_address)
+        if user_id == _UNKNOWN_USER:
+            # Acknowledge: Pub/Sub would redeliver anything but a 2xx, and
+            # nothing changes until the user signs up
             logger.warning(f"No user found for email {email_address}")
-            return ("User not found", 404)
-        
-        # Step 4: Fetch email content using Gmail API
-        logger.info(f"Fetching email content for history {history_id}")
-        raw_body, headers = fetch_email_content(email_address, history_id)
-        logger.info(f"Fetched email: {headers.get('Subject', 'No Subject')}")
-        
-        # Step 5: Store in database
-        logger.info("Storing email in database")
-        inserted = store_email(user_id, raw_body, headers, history_id)
-        
-        if inserted:
-            logger.info(f"Successfully stored new email for user {user_id}")
-        else:
-            logger.info(f"Email already exists (duplicate history {history_id})")
+            return ("", 204)
+        
+        # Shed load once the concurrency limit is reached, before any Gmail
+        # or database work
+        if not _ingest_limiter.acquire():
+            logger.warning(
+                f"Concurrency limit {int(_ingest_limiter.limit)} reached, shedding push for {email_address}"
+            )
+            return ("Overloaded", 429, {'Retry-After': str(OVERLOAD_RETRY_AFTER)})
+        
+        latency = None
+        dropped = False
+        try:
+            with _mailbox_locks.hold(email_address, timeout=MAILBOX_LOCK_TIMEOUT) as acquired:
+                if not acquired:
+                    logger.warning(f"History scan for {email_address} still running, asking for redelivery")
+                    return ("Mailbox busy", 503, {'Retry-After': str(OVERLOAD_RETRY_AFTER)})
+                
+                started = time.perf_counter()
+                try:
+                    # Steps 4 and 5: scan the mailbox's history from its
+                    # cursor and store every new message
+                    ingest_mailbox(email_address, history_id)
+                    latency = time.perf_counter() - started
+                except UnknownUserError as e:
+                    # Acknowledged without dead-lettering, as above
+                    logger.warning(str(e))
+                    return ("", 204)
+                except Exception as e:
+                    dropped = is_transient(e)
+                    # Acknowledge once the failure is recorded; replay_failures.py
+                    # retries it at a controlled rate
+                    if record_ingest_failure(email_address, history_id, e):
+                        return ("", 204)
+                    raise
+        finally:
+            _ingest_limiter.release(latency, dropped)
+        
+        # Pool and client stats for tuning; too chatty for INFO on every push
+        if logger.isEnabledFor(logging.DEBUG):
+            stats = db_pool_stats()
+            logger.debug(
+                f"DB pool: size={stats.get('pool_size')} available={stats.get('pool_available')} "
+                f"waiting={stats.get('requests_waiting')} wait_ms={stats.get('requests_wait_ms')}"
+            )
+            gmail_stats = _gmail_clients.stats()
+            logger.debug(
+                f"Gmail clients: cached={gmail_stats['size']} hits={gmail_stats['hits']} "
+                f"misses={gmail_stats['misses']} evictions={gmail_stats['evictions']} "
+                f"token_refreshes={gmail_stats['token_refreshes']}"
+            )
         
         # Step 6: Return success
         return ("", 204)
@@ -424,21 +793,60 @@ def handle_pubsub(request):
         logger.error(f"JWT verification failed: {str(e)}")
         return (f"Invalid JWT: {str(e)}", 400)
         
-    except EmailIngestError as e:
-        logger.error(f"Email ingest error: {str(e)}")
-        return (f"Bad request: {str(e)}", 400)
-        
     except Exception as e:
+        # Throttling and unavailable dependencies are retried later instead
+        # of being redelivered straight into the same failure
+        if is_transient(e):
+            logger.warning(f"Transient error, asking for redelivery later: {str(e)}")
+            return ("Temporarily unavailable", 503, {'Retry-After': str(retry_after(e))})
+        if isinstance(e, (GmailAPIError, DatabaseError)):
+            logger.error(f"Downstream error: {str(e)}")
+            return ("Internal server error", 500)
+        if isinstance(e, EmailIngestError):
+            logger.error(f"Email ingest error: {str(e)}")
+            return (f"Bad request: {str(e)}", 400)
         logger.error(f"Unexpected error: {str(e)}")
         # Don't leak stack traces in production
         return ("Internal server error", 500)
 
+def warm_up() -> None:
+    """
+    Import the deferred modules and build the Gmail client and database pool.
+    
+    Failures are logged and left for the first request to hit again.
+    """
+    try:
+        validate_env()
+    except ValueError as e:
+        logger.warning(f"Skipping warm-up: {str(e)}")
+        return
+    
+    steps = (
+        ('imports', lambda: [module.load() for module in _DEFERRED_MODULES]),
+        ('Gmail client', _gmail_clients.prepare),
+        ('database pool', get_db_pool),
+    )
+    ingest_core.warm_up(steps)
+
+def start_warm_up() -> threading.Thread:
+    """Run warm_up() on a daemon thread, once per process."""
+    return ingest_core.start_warm_up(warm_up)
+
+if WARM_UP:
+    # functions-framework imports this module in the gunicorn arbiter and
+    # only then forks the workers; warming each worker after the fork keeps
+    # the pool, its threads and the Gmail credentials out of the parent
+    os.register_at_fork(after_in_child=start_warm_up)
+
 # For local testing
 if __name__ == "__main__":
     from flask import Flask, request
     
     app = Flask(__name__)
     
+    if WARM_UP:
+        start_warm_up()
+    
     @app.route('/', methods=['POST'])
     def local_handler():
         return handle_pubsub(request)
@@ -14,8 +14,15 @@ from worker.main import (
     create_calendar_event,
     create_reminder_notifications,
     send_push_notification,
-    get_user_calendar_service
+    get_user_calendar_service,
+    get_user_credentials,
+    fetch_user_tokens,
+    create_calendar_events,
+    schedule_reminders,
+    mark_events_synced
 )
+import worker.main as main
+from exponent_server_sdk import PushTicketError
 
 @pytest.fixture
 def mock_supabase():
@@ -50,6 +57,7 @@ def sample_reminder():
         'id': 'reminder-789',
         'event_id': 'event-123',
         'reminder_type': '24_hours',
+        'notify_at_ts': datetime.utcnow().isoformat(),
         'retry_count': 0,
         'events': {
             'title': 'School Meeting',
@@ -80,6 +88,28 @@ class TestCalendarIntegration:
             assert service == mock_service
             mock_creds.refresh.assert_called_once()
 
+    @patch.dict('worker.main._user_credentials', clear=True)
+    @patch('worker.main.Credentials')
+    @patch('worker.main.requests.Request')
+    def test_user_credentials_cached_until_expiry(self, mock_request, mock_credentials):
+        """Test that a user's token is refreshed again only when close to expiry."""
+        mock_creds = Mock(refresh_token='test-refresh-token')
+        mock_creds.refresh.side_effect = lambda request: setattr(mock_creds, 'token', 'access-token')
+        mock_creds.expiry = datetime.utcnow() + timedelta(minutes=30)
+        mock_credentials.return_value = mock_creds
+        
+        get_user_credentials('test-refresh-token', 'user-456')
+        get_user_credentials('test-refresh-token', 'user-456')
+        
+        mock_credentials.assert_called_once()
+        assert mock_creds.refresh.call_count == 1
+        
+        mock_creds.expiry = datetime.utcnow() + timedelta(minutes=1)
+        get_user_credentials('test-refresh-token', 'user-456')
+        
+        assert mock_creds.refresh.call_count == 2
+        mock_credentials.assert_called_once()
+
     def test_create_calendar_event_new(self):
         """Test creating a new calendar event."""
         mock_service = Mock()
@@ -125,6 +155,97 @@ class TestCalendarIntegration:
         assert result == 'cal-event-123'
         mock_events.update.assert_called_once()
 
+class FakeBatch:
+    """Stand-in for a Calendar batch request that answers each call from outcomes."""
+    
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.request_ids = []
+    
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+    
+    def execute(self):
+        self.service.batches.append(self.request_ids)
+        for request_id in self.request_ids:
+            outcome = self.service.outcomes[request_id].pop(0)
+            if isinstance(outcome, Exception):
+                self.callback(request_id, None, outcome)
+            else:
+                self.callback(request_id, {'id': outcome, 'etag': '"1"'}, None)
+
+def _calendar_service(outcomes):
+    service = Mock()
+    service.outcomes = outcomes
+    service.batches = []
+    service.new_batch_http_request.side_effect = lambda callback: FakeBatch(service, callback)
+    return service
+
+def _http_error(status):
+    from googleapiclient.errors import HttpError
+    return HttpError(Mock(status=status), b'error')
+
+def _events(*event_ids):
+    return [{
+        'id': event_id,
+        'title': 'School Event',
+        'start_time': datetime.utcnow(),
+        'end_time': datetime.utcnow() + timedelta(hours=1),
+    } for event_id in event_ids]
+
+class TestCalendarBatch:
+    """Test syncing events with Calendar batch requests."""
+    
+    @patch('worker.main.CALENDAR_BATCH_SIZE', 2)
+    def test_events_sent_in_chunks(self):
+        """Test that events go out in batches of CALENDAR_BATCH_SIZE with trimmed responses."""
+        service = _calendar_service({f"e{i}": [f"cal-{i}"] for i in range(5)})
+        
+        result = create_calendar_events(service, _events(*(f"e{i}" for i in range(5))))
+        
+        assert result == {f"e{i}": f"cal-{i}" for i in range(5)}
+        assert service.batches == [['e0', 'e1'], ['e2', 'e3'], ['e4']]
+        assert service.events().insert.call_args[1]['fields'] == 'id,etag'
+    
+    @patch('worker.main.time.sleep')
+    def test_only_failed_items_retried(self, mock_sleep):
+        """Test that rate-limited calls are retried alone and permanent failures dropped."""
+        service = _calendar_service({
+            'e1': ['cal-1'],
+            'e2': [_http_error(429), 'cal-2'],
+            'e3': [_http_error(400)],
+        })
+        
+        result = create_calendar_events(service, _events('e1', 'e2', 'e3'))
+        
+        assert result == {'e1': 'cal-1', 'e2': 'cal-2'}
+        assert service.batches == [['e1', 'e2', 'e3'], ['e2']]
+        mock_sleep.assert_called_once()
+    
+    @patch('worker.main.time.sleep')
+    def test_retries_are_bounded(self, mock_sleep):
+        """Test that a call failing every time is given up after CALENDAR_BATCH_RETRIES."""
+        service = _calendar_service({'e1': [_http_error(503)] * 4})
+        
+        assert create_calendar_events(service, _events('e1')) == {}
+        assert len(service.batches) == 4
+    
+    @patch('worker.main.time.sleep')
+    def test_only_connection_errors_retried(self, mock_sleep):
+        """Test that dropped connections are retried and other errors are not."""
+        import httplib2
+        service = _calendar_service({
+            'e1': [ConnectionResetError(), 'cal-1'],
+            'e2': [httplib2.ServerNotFoundError(), 'cal-2'],
+            'e3': [KeyError('id')],
+        })
+        
+        result = create_calendar_events(service, _events('e1', 'e2', 'e3'))
+        
+        assert result == {'e1': 'cal-1', 'e2': 'cal-2'}
+        assert service.batches == [['e1', 'e2', 'e3'], ['e1', 'e2']]
+
 class TestReminderCreation:
     """Test reminder creation functionality."""
     
@@ -141,8 +262,10 @@ class TestReminderCreation:
         result = create_reminder_notifications('event-123', event_start_time)
         
         assert result is True
-        # Should create 3 reminders (24h, 3h, 30min)
-        assert mock_table.upsert.call_count == 3
+        # Should create 3 reminders (24h, 3h, 30min) in one upsert
+        mock_table.upsert.assert_called_once()
+        rows = mock_table.upsert.call_args[0][0]
+        assert [row['reminder_type'] for row in rows] == ['24_hours', '3_hours', '30_minutes']
 
     @patch('worker.main.supabase')
     def test_create_reminder_notifications_past_time(self, mock_supabase):
@@ -159,7 +282,62 @@ class TestReminderCreation:
         
         assert result is True
         # Should only create 1 reminder (30min)
-        assert mock_table.upsert.call_count == 1
+        rows = mock_table.upsert.call_args[0][0]
+        assert [row['reminder_type'] for row in rows] == ['30_minutes']
+
+class TestBulkWrites:
+    """Test bulk reminder scheduling and status updates."""
+    
+    @patch('worker.main.UPSERT_CHUNK_SIZE', 4)
+    def test_schedule_reminders_in_chunks(self, mock_supabase):
+        """Test that every event's reminders go out in chunked upserts, past ones dropped."""
+        now = datetime.utcnow()
+        events = [(f"event-{i}", now + timedelta(hours=25)) for i in range(2)]
+        events.append(('event-soon', now + timedelta(hours=1)))
+        events.append(('event-past', now - timedelta(hours=1)))
+        
+        assert schedule_reminders(events) is True
+        
+        upserts = mock_supabase.table.return_value.upsert.call_args_list
+        assert [len(c[0][0]) for c in upserts] == [4, 3]
+        rows = [row for c in upserts for row in c[0][0]]
+        assert [row['event_id'] for row in rows].count('event-soon') == 1
+        assert 'event-past' not in [row['event_id'] for row in rows]
+        assert all(c[1]['on_conflict'] == 'event_id,reminder_type' for c in upserts)
+    
+    def test_reminder_rows_accept_offset_timestamps(self):
+        """Test that timezone-aware start times from Supabase are handled."""
+        start_time = datetime.fromisoformat('2030-09-01T08:00:00+00:00')
+        
+        rows = main.reminder_rows('event-1', start_time)
+        
+        assert [row['notify_at_ts'] for row in rows] == [
+            '2030-08-31T08:00:00+00:00', '2030-09-01T05:00:00+00:00', '2030-09-01T07:30:00+00:00'
+        ]
+    
+    @patch('worker.main.UPSERT_CHUNK_SIZE', 2)
+    def test_mark_events_synced_updates_only_sync_columns(self, mock_supabase, sample_event):
+        """Test that synced events go out in chunked RPC calls writing only the sync columns."""
+        events = [({**sample_event, 'id': f"event-{i}"}, f"cal-{i}") for i in range(3)]
+        
+        assert mark_events_synced(events) == events
+        
+        mock_supabase.table.return_value.upsert.assert_not_called()
+        calls = mock_supabase.rpc.call_args_list
+        assert [c[0][0] for c in calls] == ['mark_events_synced'] * 2
+        rows = [row for c in calls for row in c[0][1]['updates']]
+        assert [(row['id'], row['google_calendar_id'], row['status']) for row in rows] == [
+            (f"event-{i}", f"cal-{i}", 'synced') for i in range(3)
+        ]
+        assert set(rows[0]) == {'id', 'google_calendar_id', 'status', 'synced_at'}
+    
+    @patch('worker.main.UPSERT_CHUNK_SIZE', 2)
+    def test_mark_events_synced_reports_stored_chunks(self, mock_supabase, sample_event):
+        """Test that a failed chunk is left out of the result and the other chunks still go out."""
+        events = [({**sample_event, 'id': f"event-{i}"}, f"cal-{i}") for i in range(5)]
+        mock_supabase.rpc.return_value.execute.side_effect = [Mock(), Exception('timeout'), Mock()]
+        
+        assert mark_events_synced(events) == [events[0], events[1], events[4]]
 
 class TestPushNotifications:
     """Test push notification functionality."""
@@ -200,8 +378,8 @@ class TestEventProcessing:
     """Test event processing workflow."""
     
     @patch('worker.main.get_user_calendar_service')
-    @patch('worker.main.create_calendar_event')
-    @patch('worker.main.create_reminder_notifications')
+    @patch('worker.main.create_calendar_events')
+    @patch('worker.main.schedule_reminders')
     def test_process_events_success(self, mock_create_reminders, mock_create_calendar, 
                                   mock_get_service, mock_supabase, sample_event):
         """Test successful event processing."""
@@ -227,33 +405,73 @@ class TestEventProcessing:
         # Mock user query
         mock_user_select = Mock()
         mock_users_table.select.return_value = mock_user_select
-        mock_user_eq = Mock()
-        mock_user_select.eq.return_value = mock_user_eq
-        mock_user_eq.execute.return_value = Mock(data=[{
+        mock_user_in = Mock()
+        mock_user_select.in_.return_value = mock_user_in
+        mock_user_in.execute.return_value = Mock(data=[{
+            'id': 'user-456',
             'google_refresh_token': 'test-refresh-token'
         }])
         
-        # Mock update
-        mock_update = Mock()
-        mock_events_table.update.return_value = mock_update
-        mock_update_eq = Mock()
-        mock_update.eq.return_value = mock_update_eq
-        mock_update_eq.execute.return_value = Mock()
-        
         # Mock calendar service and event creation
         mock_service = Mock()
         mock_get_service.return_value = mock_service
-        mock_create_calendar.return_value = 'cal-event-123'
+        mock_create_calendar.return_value = {'event-123': 'cal-event-123'}
         mock_create_reminders.return_value = True
         
         # Run the function
         process_events()
         
         # Verify calls
-        mock_get_service.assert_called_once_with('test-refresh-token')
+        mock_get_service.assert_called_once_with('test-refresh-token', 'user-456')
         mock_create_calendar.assert_called_once()
         mock_create_reminders.assert_called_once()
-        mock_events_table.update.assert_called_once()
+        assert [event_id for event_id, start_time in mock_create_reminders.call_args[0][0]] == ['event-123']
+        mock_events_table.upsert.assert_not_called()
+        mock_supabase.rpc.assert_called_once()
+        row = mock_supabase.rpc.call_args[0][1]['updates'][0]
+        assert (row['id'], row['google_calendar_id'], row['status']) == ('event-123', 'cal-event-123', 'synced')
+
+    @patch('worker.main.get_user_calendar_service')
+    @patch('worker.main.create_calendar_events')
+    @patch('worker.main.schedule_reminders')
+    @patch('worker.main.mark_events_synced', side_effect=lambda synced: synced)
+    def test_process_events_one_service_per_user(self, mock_mark_synced, mock_schedule, mock_create_calendar,
+                                                 mock_get_service, mock_supabase, sample_event):
+        """Test that each user gets one client and their statuses and reminders written after their batch."""
+        events = [
+            {**sample_event, 'id': event_id, 'user_id': user_id,
+             'start_time': sample_event['start_time'].isoformat(),
+             'end_time': sample_event['end_time'].isoformat()}
+            for event_id, user_id in (('event-1', 'user-456'), ('event-2', 'user-789'), ('event-3', 'user-456'))
+        ]
+        mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value = \
+            Mock(data=events)
+        mock_supabase.table.return_value.select.return_value.in_.return_value.execute.return_value = Mock(data=[
+            {'id': 'user-456', 'google_refresh_token': 'token-456'},
+            {'id': 'user-789', 'google_refresh_token': 'token-789'},
+        ])
+        mock_get_service.side_effect = lambda refresh_token, user_id: f"service-{user_id}"
+        mock_create_calendar.side_effect = lambda service, events: {
+            event['id']: f"cal-{event['id']}" for event in events
+        }
+        
+        process_events()
+        
+        assert [(c[0][0], [e['id'] for e in c[0][1]]) for c in mock_create_calendar.call_args_list] == [
+            ('service-user-456', ['event-1', 'event-3']), ('service-user-789', ['event-2'])
+        ]
+        assert [c[0] for c in mock_get_service.call_args_list] == [
+            ('token-456', 'user-456'), ('token-789', 'user-789')
+        ]
+        assert [[calendar_id for event, calendar_id in c[0][0]] for c in mock_mark_synced.call_args_list] == [
+            ['cal-event-1', 'cal-event-3'], ['cal-event-2']
+        ]
+        assert [[event_id for event_id, start_time in c[0][0]] for c in mock_schedule.call_args_list] == [
+            ['event-1', 'event-3'], ['event-2']
+        ]
+        mock_supabase.table.return_value.select.return_value.in_.assert_called_once_with(
+            'id', ['user-456', 'user-789']
+        )
 
     def test_process_events_no_google_token(self, mock_supabase, sample_event):
         """Test event processing when user has no Google token."""
@@ -275,20 +493,38 @@ class TestEventProcessing:
         # Mock user query - no refresh token
         mock_user_select = Mock()
         mock_users_table.select.return_value = mock_user_select
-        mock_user_eq = Mock()
-        mock_user_select.eq.return_value = mock_user_eq
-        mock_user_eq.execute.return_value = Mock(data=[{
+        mock_user_in = Mock()
+        mock_user_select.in_.return_value = mock_user_in
+        mock_user_in.execute.return_value = Mock(data=[{
+            'id': 'user-456',
             'google_refresh_token': None
         }])
         
         # Should not raise exception, just skip the event
         process_events()
 
+class TestUserTokens:
+    """Test bulk auth.users token lookups."""
+    
+    @patch('worker.main.USER_LOOKUP_CHUNK_SIZE', 2)
+    def test_fetch_user_tokens_in_chunks(self, mock_supabase):
+        """Test that distinct user ids are looked up a chunk at a time."""
+        mock_in = mock_supabase.table.return_value.select.return_value.in_
+        mock_in.side_effect = lambda column, ids: Mock(execute=Mock(return_value=Mock(
+            data=[{'id': user_id, 'expo_push_token': f"token-{user_id}"} for user_id in ids]
+        )))
+        
+        tokens = fetch_user_tokens(['u1', 'u2', 'u1', None, 'u3'], 'expo_push_token')
+        
+        assert tokens == {'u1': 'token-u1', 'u2': 'token-u2', 'u3': 'token-u3'}
+        assert [c[0][1] for c in mock_in.call_args_list] == [['u1', 'u2'], ['u3']]
+        mock_supabase.table.return_value.select.assert_called_with('id, expo_push_token')
+
 class TestPushNotificationProcessing:
     """Test push notification processing workflow."""
     
-    @patch('worker.main.send_push_notification')
-    def test_process_push_notifications_success(self, mock_send_push, mock_supabase, sample_reminder):
+    @patch('worker.main.publish_push_messages')
+    def test_process_push_notifications_success(self, mock_publish, mock_supabase, sample_reminder):
         """Test successful push notification processing."""
         # Mock Supabase responses
         mock_reminders_table = Mock()
@@ -312,31 +548,30 @@ class TestPushNotificationProcessing:
         # Mock user query
         mock_user_select = Mock()
         mock_users_table.select.return_value = mock_user_select
-        mock_user_eq = Mock()
-        mock_user_select.eq.return_value = mock_user_eq
-        mock_user_eq.execute.return_value = Mock(data=[{
+        mock_user_in = Mock()
+        mock_user_select.in_.return_value = mock_user_in
+        mock_user_in.execute.return_value = Mock(data=[{
+            'id': 'user-456',
             'expo_push_token': 'ExponentPushToken[test]'
         }])
         
-        # Mock update
-        mock_update = Mock()
-        mock_reminders_table.update.return_value = mock_update
-        mock_update_eq = Mock()
-        mock_update.eq.return_value = mock_update_eq
-        mock_update_eq.execute.return_value = Mock()
-        
         # Mock successful push
-        mock_send_push.return_value = True
+        mock_publish.return_value = [None]
         
         # Run the function
         process_push_notifications()
         
         # Verify calls
-        mock_send_push.assert_called_once()
+        mock_publish.assert_called_once()
+        assert mock_publish.call_args[0][0][0].to == 'ExponentPushToken[test]'
+        mock_reminders_table.upsert.assert_not_called()
         mock_reminders_table.update.assert_called_once()
+        values = mock_reminders_table.update.call_args[0][0]
+        assert set(values) == {'status', 'sent_at_ts'} and values['status'] == 'sent'
+        mock_reminders_table.update.return_value.in_.assert_called_once_with('id', ['reminder-789'])
 
-    @patch('worker.main.send_push_notification')
-    def test_process_push_notifications_retry(self, mock_send_push, mock_supabase, sample_reminder):
+    @patch('worker.main.publish_push_messages')
+    def test_process_push_notifications_retry(self, mock_publish, mock_supabase, sample_reminder):
         """Test push notification retry logic."""
         # Mock Supabase responses
         mock_reminders_table = Mock()
@@ -360,21 +595,15 @@ class TestPushNotificationProcessing:
         # Mock user query
         mock_user_select = Mock()
         mock_users_table.select.return_value = mock_user_select
-        mock_user_eq = Mock()
-        mock_user_select.eq.return_value = mock_user_eq
-        mock_user_eq.execute.return_value = Mock(data=[{
+        mock_user_in = Mock()
+        mock_user_select.in_.return_value = mock_user_in
+        mock_user_in.execute.return_value = Mock(data=[{
+            'id': 'user-456',
             'expo_push_token': 'ExponentPushToken[test]'
         }])
         
-        # Mock update
-        mock_update = Mock()
-        mock_reminders_table.update.return_value = mock_update
-        mock_update_eq = Mock()
-        mock_update.eq.return_value = mock_update_eq
-        mock_update_eq.execute.return_value = Mock()
-        
         # Mock failed push
-        mock_send_push.return_value = False
+        mock_publish.return_value = ['Push notification failed']
         
         # Run the function
         process_push_notifications()
@@ -382,8 +611,87 @@ class TestPushNotificationProcessing:
         # Verify retry count was incremented
         mock_reminders_table.update.assert_called_once()
         update_call = mock_reminders_table.update.call_args[0][0]
-        assert update_call['retry_count'] == 1
-        assert update_call['status'] == 'pending'
+        assert update_call == {'status': 'pending', 'retry_count': 1, 'error_message': None}
+
+    def test_process_push_notifications_bulk(self, mock_supabase, mock_push_client, sample_reminder):
+        """Test that due reminders go out in publish_multiple chunks with grouped status updates."""
+        reminders = [{**sample_reminder, 'id': f"reminder-{i}",
+                      'events': {**sample_reminder['events'], 'user_id': f"user-{i % 3}"}}
+                     for i in range(150)]
+        reminders[0]['events'] = {**sample_reminder['events'], 'user_id': 'user-without-token'}
+        mock_supabase.table.return_value.select.return_value.lte.return_value.is_.return_value \
+            .lt.return_value.execute.return_value = Mock(data=reminders)
+        mock_supabase.table.return_value.select.return_value.in_.return_value.execute.return_value = Mock(data=[
+            {'id': f"user-{i}", 'expo_push_token': f"ExponentPushToken[{i}]"} for i in range(3)
+        ])
+        
+        def publish_multiple(messages):
+            tickets = [Mock(push_message=message, message=None) for message in messages]
+            # The second message of every request is rejected
+            tickets[1].validate_response.side_effect = PushTicketError(tickets[1])
+            tickets[1].message = 'MessageRateExceeded'
+            return tickets
+        mock_push_client.publish_multiple.side_effect = publish_multiple
+        
+        process_push_notifications()
+        
+        assert [len(c[0][0]) for c in mock_push_client.publish_multiple.call_args_list] == [100, 49]
+        mock_table = mock_supabase.table.return_value
+        mock_table.upsert.assert_not_called()
+        updates = [(c[0][0], c_in[0][1]) for c, c_in in
+                   zip(mock_table.update.call_args_list, mock_table.update.return_value.in_.call_args_list)]
+        # Sent reminders in one update, written before the failed ones
+        values, ids = updates[0]
+        assert values['status'] == 'sent' and len(ids) == 147
+        assert updates[1:] == [
+            ({'status': 'failed', 'error_message': 'No push token available'}, ['reminder-0']),
+            # reminder-2 and reminder-102 were second in their requests
+            ({'status': 'pending', 'retry_count': 1, 'error_message': None}, ['reminder-2', 'reminder-102']),
+        ]
+
+    @patch('worker.main.UPDATE_ID_CHUNK_SIZE', 2)
+    def test_update_grouped_in_chunks(self, mock_supabase):
+        """Test that rows with the same values share an update, a chunk of ids at a time."""
+        main._update_grouped('reminders', [
+            ('r1', {'status': 'sent'}), ('r2', {'status': 'failed'}),
+            ('r3', {'status': 'sent'}), ('r4', {'status': 'sent'}),
+        ])
+        
+        mock_table = mock_supabase.table.return_value
+        assert [c[0][0] for c in mock_table.update.call_args_list] == [
+            {'status': 'sent'}, {'status': 'sent'}, {'status': 'failed'}
+        ]
+        assert [c[0][1] for c in mock_table.update.return_value.in_.call_args_list] == [
+            ['r1', 'r3'], ['r4'], ['r2']
+        ]
+
+    def test_publish_push_messages_failed_request(self, mock_push_client):
+        """Test that a failed request fails only its own chunk."""
+        from exponent_server_sdk import PushServerError
+        messages = [Mock() for _ in range(120)]
+        mock_push_client.publish_multiple.side_effect = [
+            PushServerError('Request failed', Mock()),
+            [Mock(push_message=message, message=None) for message in messages[100:]]
+        ]
+        
+        errors = main.publish_push_messages(messages)
+        
+        assert errors[:100] == ['Request failed'] * 100
+        assert errors[100:] == [None] * 20
+    
+    def test_publish_push_messages_matches_tickets_to_messages(self, mock_push_client):
+        """Test that tickets are matched by their message and a message without one fails."""
+        messages = [Mock() for _ in range(3)]
+        rejected = Mock(push_message=messages[0], message='MessageRateExceeded')
+        rejected.validate_response.side_effect = PushTicketError(rejected)
+        # Out of order, and no ticket for the second message
+        mock_push_client.publish_multiple.return_value = [
+            Mock(push_message=messages[2], message=None), rejected
+        ]
+        
+        errors = main.publish_push_messages(messages)
+        
+        assert errors == ['MessageRateExceeded', 'No push ticket returned', None]
 
 class TestIdempotency:
     """Test idempotency of operations."""
@@ -404,8 +712,9 @@ class TestIdempotency:
         create_reminder_notifications('event-123', event_start_time)
         
         # Should use upsert with conflict resolution
-        assert mock_table.upsert.call_count == 6  # 3 reminders × 2 calls
+        assert mock_table.upsert.call_count == 2  # one per call, 3 reminders each
         for call in mock_table.upsert.call_args_list:
+            assert len(call[0][0]) == 3
             assert call[1]['on_conflict'] == 'event_id,reminder_type'
 
 if __name__ == '__main__':
@@ -1,10 +1,12 @@
 import json
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Any, Tuple
 import time
 
+import httplib2
 import psycopg
 from google.auth.transport import requests
 from google.oauth2 import service_account
@@ -31,11 +33,53 @@ GOOGLE_CLIENT_EMAIL = os.environ.get('GOOGLE_CLIENT_EMAIL')
 GOOGLE_PRIVATE_KEY = os.environ.get('GOOGLE_PRIVATE_KEY', '').replace('\\n', '\n')
 GOOGLE_PROJECT_ID = os.environ.get('GOOGLE_PROJECT_ID')
 EXPO_ACCESS_TOKEN = os.environ.get('EXPO_ACCESS_TOKEN')
+# Seconds between runs when the worker runs as a long-lived daemon; 0 runs
+# once and exits, as under cron
+WORKER_INTERVAL = float(os.environ.get('WORKER_INTERVAL', 0))
+
+CALENDAR_SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# User ids per auth.users lookup; keeps the PostgREST query string well
+# under URL length limits
+USER_LOOKUP_CHUNK_SIZE = 200
+# Calendar calls per batch request. The API takes up to 1000 but throttles
+# large batches, so default to the recommended 50.
+CALENDAR_BATCH_SIZE = min(int(os.environ.get('CALENDAR_BATCH_SIZE', 50)), 1000)
+CALENDAR_BATCH_RETRIES = 3
+CALENDAR_BATCH_RETRY_DELAY = 1.0
+CALENDAR_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Rows per PostgREST bulk upsert
+UPSERT_CHUNK_SIZE = 500
+# Row ids per PostgREST update filter; like user lookups they go in the
+# query string
+UPDATE_ID_CHUNK_SIZE = 200
+
+# Messages per Expo push request (the API's limit)
+EXPO_PUSH_CHUNK_SIZE = 100
+MAX_PUSH_ATTEMPTS = 5
+
+REMINDER_OFFSETS = (
+    ('24_hours', timedelta(hours=24)),
+    ('3_hours', timedelta(hours=3)),
+    ('30_minutes', timedelta(minutes=30)),
+)
 
 # Initialize clients
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 push_client = PushClient()
 
+def fetch_user_tokens(user_ids: Iterable[str], column: str) -> Dict[str, Optional[str]]:
+    """Fetch one token column of auth.users for many users with a bulk in_() query per chunk."""
+    user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    tokens: Dict[str, Optional[str]] = {}
+    for start in range(0, len(user_ids), USER_LOOKUP_CHUNK_SIZE):
+        response = supabase.table('auth.users').select(
+            f'id, {column}'
+        ).in_('id', user_ids[start:start + USER_LOOKUP_CHUNK_SIZE]).execute()
+        for row in response.data or []:
+            tokens[row['id']] = row.get(column)
+    return tokens
+
 def get_service_account_credentials():
     """Create service account credentials for Google Calendar API."""
     try:
@@ -53,7 +97,7 @@ def get_service_account_credentials():
         
         credentials = service_account.Credentials.from_service_account_info(
             credentials_info,
-            scopes=['https://www.googleapis.com/auth/calendar']
+            scopes=CALENDAR_SCOPES
         )
         
         return credentials
@@ -62,22 +106,43 @@ def get_service_account_credentials():
         logger.error(f"Failed to create service account credentials: {e}")
         raise
 
-def get_user_calendar_service(refresh_token: str):
-    """Create Calendar API service using user's OAuth token."""
-    try:
-        # Create credentials from refresh token
+# user_id -> OAuth credentials. In daemon mode they outlive a run, so a
+# user's access token is only refreshed once it is close to expiry.
+_user_credentials: Dict[str, Credentials] = {}
+
+def _token_expiring(credentials) -> bool:
+    if not credentials.token or credentials.expiry is None:
+        return True
+    return credentials.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
+def get_user_credentials(refresh_token: str, user_id: Optional[str] = None) -> Credentials:
+    """Return OAuth credentials for a user, refreshing the access token only when needed."""
+    credentials = _user_credentials.get(user_id) if user_id else None
+    if credentials is None or credentials.refresh_token != refresh_token:
         credentials = Credentials(
             token=None,
             refresh_token=refresh_token,
             token_uri="https://oauth2.googleapis.com/token",
             client_id=os.environ.get('GOOGLE_CLIENT_ID'),
             client_secret=os.environ.get('GOOGLE_CLIENT_SECRET'),
-            scopes=['https://www.googleapis.com/auth/calendar']
+            scopes=CALENDAR_SCOPES
         )
-        
-        # Refresh the token
         credentials.refresh(requests.Request())
-        
+    elif _token_expiring(credentials):
+        try:
+            credentials.refresh(requests.Request())
+        except Exception:
+            # A revoked refresh token; start over next time
+            _user_credentials.pop(user_id, None)
+            raise
+    if user_id:
+        _user_credentials[user_id] = credentials
+    return credentials
+
+def get_user_calendar_service(refresh_token: str, user_id: Optional[str] = None):
+    """Create Calendar API service using user's OAuth token."""
+    try:
+        credentials = get_user_credentials(refresh_token, user_id)
         service = build('calendar', 'v3', credentials=credentials)
         return service
         
@@ -85,52 +150,52 @@ def get_user_calendar_service(refresh_token: str):
         logger.error(f"Failed to create user calendar service: {e}")
         raise
 
+def _calendar_event_body(event_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert event data to Google Calendar format."""
+    return {
+        'summary': event_data['title'],
+        'description': event_data.get('description', ''),
+        'start': {
+            'dateTime': event_data['start_time'].isoformat(),
+            'timeZone': 'UTC',
+        },
+        'end': {
+            'dateTime': event_data['end_time'].isoformat(),
+            'timeZone': 'UTC',
+        },
+        'location': event_data.get('location', ''),
+        'reminders': {
+            'useDefault': False,
+            'overrides': [
+                {'method': 'popup', 'minutes': 24 * 60},  # 24 hours
+                {'method': 'popup', 'minutes': 3 * 60},   # 3 hours
+                {'method': 'popup', 'minutes': 30},       # 30 minutes
+            ],
+        },
+    }
+
+def _calendar_request(service, event_data: Dict[str, Any]):
+    """Build the insert, or the update if the event was synced before; only id and etag come back."""
+    if event_data.get('google_calendar_id'):
+        return service.events().update(
+            calendarId='primary',
+            eventId=event_data['google_calendar_id'],
+            body=_calendar_event_body(event_data),
+            fields='id,etag'
+        )
+    return service.events().insert(
+        calendarId='primary',
+        body=_calendar_event_body(event_data),
+        fields='id,etag'
+    )
+
 def create_calendar_event(service, event_data: Dict[str, Any]) -> Optional[str]:
     """Create or update a Google Calendar event."""
     try:
-        # Convert event data to Google Calendar format
-        calendar_event = {
-            'summary': event_data['title'],
-            'description': event_data.get('description', ''),
-            'start': {
-                'dateTime': event_data['start_time'].isoformat(),
-                'timeZone': 'UTC',
-            },
-            'end': {
-                'dateTime': event_data['end_time'].isoformat(),
-                'timeZone': 'UTC',
-            },
-            'location': event_data.get('location', ''),
-            'reminders': {
-                'useDefault': False,
-                'overrides': [
-                    {'method': 'popup', 'minutes': 24 * 60},  # 24 hours
-                    {'method': 'popup', 'minutes': 3 * 60},   # 3 hours
-                    {'method': 'popup', 'minutes': 30},       # 30 minutes
-                ],
-            },
-        }
-        
-        # Check if event already exists (using external_id)
-        if event_data.get('google_calendar_id'):
-            # Update existing event
-            updated_event = service.events().update(
-                calendarId='primary',
-                eventId=event_data['google_calendar_id'],
-                body=calendar_event
-            ).execute()
-            
-            logger.info(f"Updated calendar event: {updated_event['id']}")
-            return updated_event['id']
-        else:
-            # Create new event
-            created_event = service.events().insert(
-                calendarId='primary',
-                body=calendar_event
-            ).execute()
-            
-            logger.info(f"Created calendar event: {created_event['id']}")
-            return created_event['id']
+        calendar_event = _calendar_request(service, event_data).execute()
+        action = 'Updated' if event_data.get('google_calendar_id') else 'Created'
+        logger.info(f"{action} calendar event: {calendar_event['id']}")
+        return calendar_event['id']
             
     except HttpError as e:
         logger.error(f"Google Calendar API error: {e}")
@@ -139,40 +204,120 @@ def create_calendar_event(service, event_data: Dict[str, Any]) -> Optional[str]:
         logger.error(f"Failed to create/update calendar event: {e}")
         return None
 
-def create_reminder_notifications(event_id: str, event_start_time: datetime) -> bool:
-    """Create reminder entries for an event."""
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        return error.resp.status in CALENDAR_RETRY_STATUSES
+    # Dropped connections and timeouts fail the whole batch request
+    return isinstance(error, (OSError, socket.timeout, httplib2.HttpLib2Error))
+
+def create_calendar_events(service, events: List[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Create or update many events of one user with Calendar batch requests.
+
+    Returns event id -> calendar event id for the events that synced. Items
+    that failed with a rate limit, server error or connection problem are
+    sent again in a new batch, up to CALENDAR_BATCH_RETRIES times; other failures are logged
+    and left out.
+    """
+    synced: Dict[str, str] = {}
+    pending = {event['id']: event for event in events}
+    for attempt in range(CALENDAR_BATCH_RETRIES + 1):
+        failed: Dict[str, Exception] = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                synced[request_id] = response['id']
+
+        items = list(pending.items())
+        for start in range(0, len(items), CALENDAR_BATCH_SIZE):
+            chunk = items[start:start + CALENDAR_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for event_id, event in chunk:
+                batch.add(_calendar_request(service, event), request_id=event_id)
+            try:
+                batch.execute()
+            except Exception as e:
+                for event_id, _ in chunk:
+                    if event_id not in synced:
+                        failed.setdefault(event_id, e)
+
+        retry = {event_id: pending[event_id] for event_id, e in failed.items() if _retryable(e)}
+        for event_id, e in failed.items():
+            if event_id not in retry or attempt == CALENDAR_BATCH_RETRIES:
+                logger.error(f"Google Calendar API error for event {event_id}: {e}")
+        if not retry or attempt == CALENDAR_BATCH_RETRIES:
+            break
+        logger.warning(f"Retrying {len(retry)} of {len(pending)} calendar calls")
+        time.sleep(CALENDAR_BATCH_RETRY_DELAY * 2 ** attempt)
+        pending = retry
+
+    logger.info(f"Synced {len(synced)} of {len(events)} calendar events")
+    return synced
+
+def _as_utc(value: datetime) -> datetime:
+    # Supabase returns offsets; naive datetimes are taken to be UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+def reminder_rows(event_id: str, event_start_time: datetime, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Reminder rows for an event (24 hours, 3 hours and 30 minutes before), leaving out past ones."""
+    now = now or datetime.now(timezone.utc)
+    start_time = _as_utc(event_start_time)
+    return [{
+        'event_id': event_id,
+        'reminder_type': reminder_type,
+        'notify_at_ts': (start_time - offset).isoformat(),
+        'status': 'pending',
+        'retry_count': 0
+    } for reminder_type, offset in REMINDER_OFFSETS if start_time - offset > now]
+
+def _upsert_chunked(table: str, rows: List[Dict[str, Any]], on_conflict: str) -> None:
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        supabase.table(table).upsert(rows[start:start + UPSERT_CHUNK_SIZE], on_conflict=on_conflict).execute()
+
+def schedule_reminders(events: Iterable[Tuple[str, datetime]]) -> bool:
+    """Create the reminders of many events with one chunked upsert; idempotent on event_id,reminder_type."""
     try:
-        # Calculate notification times
-        reminder_times = [
-            event_start_time - timedelta(hours=24),   # 24 hours before
-            event_start_time - timedelta(hours=3),    # 3 hours before
-            event_start_time - timedelta(minutes=30), # 30 minutes before
-        ]
-        
-        reminder_types = ['24_hours', '3_hours', '30_minutes']
-        
-        for reminder_time, reminder_type in zip(reminder_times, reminder_types):
-            # Skip if reminder time is in the past
-            if reminder_time <= datetime.utcnow():
-                continue
-                
-            # Insert reminder with conflict handling for idempotency
-            response = supabase.table('reminders').upsert({
-                'event_id': event_id,
-                'reminder_type': reminder_type,
-                'notify_at_ts': reminder_time.isoformat(),
-                'status': 'pending',
-                'retry_count': 0
-            }, on_conflict='event_id,reminder_type').execute()
-            
-            logger.info(f"Created reminder for event {event_id}: {reminder_type}")
-        
+        now = datetime.now(timezone.utc)
+        rows = [row for event_id, start_time in events for row in reminder_rows(event_id, start_time, now)]
+        _upsert_chunked('reminders', rows, 'event_id,reminder_type')
+        logger.info(f"Scheduled {len(rows)} reminders")
         return True
         
     except Exception as e:
-        logger.error(f"Failed to create reminders for event {event_id}: {e}")
+        logger.error(f"Failed to create reminders: {e}")
         return False
 
+def create_reminder_notifications(event_id: str, event_start_time: datetime) -> bool:
+    """Create reminder entries for an event."""
+    return schedule_reminders([(event_id, event_start_time)])
+
+def mark_events_synced(synced: List[Tuple[Dict[str, Any], str]]) -> List[Tuple[Dict[str, Any], str]]:
+    """
+    Store calendar event IDs and mark events as synced with the chunked
+    mark_events_synced RPC. Returns the events whose chunk was stored.
+    """
+    synced_at = datetime.utcnow().isoformat()
+    stored: List[Tuple[Dict[str, Any], str]] = []
+    for start in range(0, len(synced), UPSERT_CHUNK_SIZE):
+        chunk = synced[start:start + UPSERT_CHUNK_SIZE]
+        # An UPDATE, not an upsert: it leaves every other column alone and
+        # never brings back an event deleted since it was read
+        rows = [{
+            'id': event['id'],
+            'google_calendar_id': calendar_event_id,
+            'status': 'synced',
+            'synced_at': synced_at
+        } for event, calendar_event_id in chunk]
+        try:
+            supabase.rpc('mark_events_synced', {'updates': rows}).execute()
+        except Exception as e:
+            logger.error(f"Failed to mark {len(chunk)} events as synced: {e}")
+            continue
+        stored.extend(chunk)
+    return stored
+
 def process_events():
     """Main function to process pending events."""
     try:
@@ -184,49 +329,58 @@ def process_events():
         events = response.data
         logger.info(f"Processing {len(events)} pending events")
         
+        processed = 0
+        
+        # One token refresh and one Calendar client per user, not per event
+        events_by_user: Dict[str, List[Dict[str, Any]]] = {}
         for event in events:
+            events_by_user.setdefault(event['user_id'], []).append(event)
+        
+        # Every user's Google refresh token in one lookup
+        refresh_tokens = fetch_user_tokens(events_by_user, 'google_refresh_token')
+        
+        for user_id, user_events in events_by_user.items():
             try:
-                # Get user's Google refresh token
-                user_response = supabase.table('auth.users').select(
-                    'google_refresh_token'
-                ).eq('id', event['user_id']).execute()
-                
-                if not user_response.data or not user_response.data[0].get('google_refresh_token'):
-                    logger.warning(f"No Google refresh token for user {event['user_id']}")
+                refresh_token = refresh_tokens.get(user_id)
+                if not refresh_token:
+                    logger.warning(f"No Google refresh token for user {user_id}")
                     continue
                 
-                refresh_token = user_response.data[0]['google_refresh_token']
-                
                 # Create calendar service for user
-                calendar_service = get_user_calendar_service(refresh_token)
+                calendar_service = get_user_calendar_service(refresh_token, user_id)
                 
+            except Exception as e:
+                logger.error(f"Error preparing calendar for user {user_id}, "
+                             f"skipping {len(user_events)} events: {e}")
+                continue
+            
+            for event in user_events:
                 # Convert string timestamps to datetime objects
                 event['start_time'] = datetime.fromisoformat(event['start_time'].replace('Z', '+00:00'))
                 event['end_time'] = datetime.fromisoformat(event['end_time'].replace('Z', '+00:00'))
-                
-                # Create/update Google Calendar event
-                calendar_event_id = create_calendar_event(calendar_service, event)
-                
+            
+            # Create/update the user's Google Calendar events a batch at a time
+            try:
+                calendar_event_ids = create_calendar_events(calendar_service, user_events)
+            except Exception as e:
+                logger.error(f"Error syncing calendar for user {user_id}: {e}")
+                continue
+            
+            synced: List[Tuple[Dict[str, Any], str]] = []
+            for event in user_events:
+                calendar_event_id = calendar_event_ids.get(event['id'])
                 if calendar_event_id:
-                    # Update event with calendar ID and mark as synced
-                    supabase.table('events').update({
-                        'google_calendar_id': calendar_event_id,
-                        'status': 'synced',
-                        'synced_at': datetime.utcnow().isoformat()
-                    }).eq('id', event['id']).execute()
-                    
-                    # Create reminder notifications
-                    create_reminder_notifications(event['id'], event['start_time'])
-                    
-                    logger.info(f"Successfully processed event {event['id']}")
+                    synced.append((event, calendar_event_id))
                 else:
                     logger.error(f"Failed to create calendar event for {event['id']}")
-                    
-            except Exception as e:
-                logger.error(f"Error processing event {event['id']}: {e}")
-                continue
+            
+            # Store the user's calendar event IDs before moving on, so a failure
+            # later in the run can't get these events created in Calendar again
+            stored = mark_events_synced(synced)
+            if stored and schedule_reminders((event['id'], event['start_time']) for event, _ in stored):
+                processed += len(stored)
         
-        logger.info("Completed processing events")
+        logger.info(f"Completed processing events: {processed} of {len(events)} synced")
         
     except Exception as e:
         logger.error(f"Error in process_events: {e}")
@@ -265,6 +419,84 @@ def send_push_notification(push_token: str, title: str, body: str, data: Dict =
         logger.error(f"Failed to send push notification: {e}")
         return False
 
+REMINDER_TIME_TEXT = {
+    '24_hours': '24 hours',
+    '3_hours': '3 hours',
+    '30_minutes': '30 minutes'
+}
+
+def build_push_message(push_token: str, reminder: Dict[str, Any]) -> PushMessage:
+    """Create the notification for a due reminder."""
+    time_text = REMINDER_TIME_TEXT.get(reminder['reminder_type'], reminder['reminder_type'])
+    return PushMessage(
+        to=push_token,
+        title=f"Upcoming Event: {reminder['events']['title']}",
+        body=f"Your event starts in {time_text}",
+        data={
+            'event_id': reminder['event_id'],
+            'reminder_type': reminder['reminder_type']
+        },
+        sound='default',
+        badge=1
+    )
+
+def publish_push_messages(messages: List[PushMessage]) -> List[Optional[str]]:
+    """
+    Send push notifications with publish_multiple, EXPO_PUSH_CHUNK_SIZE per request.
+
+    Returns one entry per message, in order: None if Expo accepted it,
+    otherwise the error. A failed request only fails its own chunk, and a
+    message that got no ticket back counts as failed.
+    """
+    errors: List[Optional[str]] = []
+    for start in range(0, len(messages), EXPO_PUSH_CHUNK_SIZE):
+        chunk = messages[start:start + EXPO_PUSH_CHUNK_SIZE]
+        try:
+            tickets = push_client.publish_multiple(chunk)
+        except Exception as e:
+            logger.error(f"Push request for {len(chunk)} notifications failed: {e}")
+            errors.extend([str(e)] * len(chunk))
+            continue
+        
+        # Each ticket carries the message it answers; match on that rather
+        # than on position
+        positions = {id(message): i for i, message in enumerate(chunk)}
+        chunk_errors: List[Optional[str]] = ['No push ticket returned'] * len(chunk)
+        for ticket in tickets:
+            i = positions.get(id(ticket.push_message))
+            if i is None:
+                continue
+            try:
+                ticket.validate_response()
+                chunk_errors[i] = None
+            except DeviceNotRegisteredError:
+                logger.warning(f"Device not registered: {ticket.push_message.to}")
+                chunk_errors[i] = 'Device not registered'
+            except PushTicketError as e:
+                logger.error(f"Push notification error: {ticket.message or e}")
+                chunk_errors[i] = ticket.message or 'Push notification failed'
+        errors.extend(chunk_errors)
+    return errors
+
+def _update_grouped(table: str, updates: List[Tuple[str, Dict[str, Any]]]) -> None:
+    # Rows getting the same values share one UPDATE ... WHERE id IN (...),
+    # which only touches those columns and never inserts
+    groups: Dict[Tuple, List[str]] = {}
+    for row_id, values in updates:
+        groups.setdefault(tuple(values.items()), []).append(row_id)
+    for values, ids in groups.items():
+        for start in range(0, len(ids), UPDATE_ID_CHUNK_SIZE):
+            supabase.table(table).update(dict(values)).in_('id', ids[start:start + UPDATE_ID_CHUNK_SIZE]).execute()
+
+def _failed_attempt(reminder: Dict[str, Any], error: str) -> Dict[str, Any]:
+    retry_count = reminder.get('retry_count', 0) + 1
+    status = 'failed' if retry_count >= MAX_PUSH_ATTEMPTS else 'pending'
+    return {
+        'status': status,
+        'retry_count': retry_count,
+        'error_message': error if status == 'failed' else None
+    }
+
 def process_push_notifications():
     """Process pending push notifications."""
     try:
@@ -272,92 +504,55 @@ def process_push_notifications():
         current_time = datetime.utcnow().isoformat()
         
         response = supabase.table('reminders').select(
-            'id, event_id, reminder_type, retry_count, events(title, start_time, user_id)'
-        ).lte('notify_at_ts', current_time).is_('sent_at_ts', 'null').lt('retry_count', 5).execute()
+            'id, event_id, reminder_type, notify_at_ts, retry_count, events(title, start_time, user_id)'
+        ).lte('notify_at_ts', current_time).is_('sent_at_ts', 'null').lt('retry_count', MAX_PUSH_ATTEMPTS).execute()
         
         reminders = response.data
         logger.info(f"Processing {len(reminders)} pending reminders")
         
+        # Every user's push token in one lookup
+        push_tokens = fetch_user_tokens(
+            ((reminder.get('events') or {}).get('user_id') for reminder in reminders),
+            'expo_push_token'
+        )
+        
+        sent_updates: List[Tuple[str, Dict[str, Any]]] = []
+        failed_updates: List[Tuple[str, Dict[str, Any]]] = []
+        outgoing: List[Tuple[Dict[str, Any], PushMessage]] = []
         for reminder in reminders:
             try:
-                event = reminder['events']
-                user_id = event['user_id']
-                
-                # Get user's push token
-                user_response = supabase.table('auth.users').select(
-                    'expo_push_token'
-                ).eq('id', user_id).execute()
-                
-                if not user_response.data or not user_response.data[0].get('expo_push_token'):
+                user_id = reminder['events']['user_id']
+                push_token = push_tokens.get(user_id)
+                if not push_token:
                     logger.warning(f"No push token for user {user_id}")
-                    # Mark as failed
-                    supabase.table('reminders').update({
+                    failed_updates.append((reminder['id'], {
                         'status': 'failed',
                         'error_message': 'No push token available'
-                    }).eq('id', reminder['id']).execute()
+                    }))
                     continue
-                
-                push_token = user_response.data[0]['expo_push_token']
-                
-                # Create notification content
-                reminder_type_map = {
-                    '24_hours': '24 hours',
-                    '3_hours': '3 hours',
-                    '30_minutes': '30 minutes'
-                }
-                
-                time_text = reminder_type_map.get(reminder['reminder_type'], reminder['reminder_type'])
-                title = f"Upcoming Event: {event['title']}"
-                body = f"Your event starts in {time_text}"
-                
-                # Send push notification
-                success = send_push_notification(
-                    push_token=push_token,
-                    title=title,
-                    body=body,
-                    data={
-                        'event_id': reminder['event_id'],
-                        'reminder_type': reminder['reminder_type']
-                    }
-                )
-                
-                if success:
-                    # Mark as sent
-                    supabase.table('reminders').update({
-                        'status': 'sent',
-                        'sent_at_ts': datetime.utcnow().isoformat()
-                    }).eq('id', reminder['id']).execute()
-                    
-                    logger.info(f"Sent reminder {reminder['id']} for event {reminder['event_id']}")
-                else:
-                    # Increment retry count
-                    new_retry_count = reminder['retry_count'] + 1
-                    status = 'failed' if new_retry_count >= 5 else 'pending'
-                    
-                    supabase.table('reminders').update({
-                        'retry_count': new_retry_count,
-                        'status': status,
-                        'error_message': 'Push notification failed' if status == 'failed' else None
-                    }).eq('id', reminder['id']).execute()
-                    
-                    logger.warning(f"Failed to send reminder {reminder['id']}, retry count: {new_retry_count}")
+                outgoing.append((reminder, build_push_message(push_token, reminder)))
                 
             except Exception as e:
                 logger.error(f"Error processing reminder {reminder['id']}: {e}")
-                
-                # Increment retry count on error
-                new_retry_count = reminder.get('retry_count', 0) + 1
-                status = 'failed' if new_retry_count >= 5 else 'pending'
-                
-                supabase.table('reminders').update({
-                    'retry_count': new_retry_count,
-                    'status': status,
-                    'error_message': str(e) if status == 'failed' else None
-                }).eq('id', reminder['id']).execute()
-                
-                continue
+                failed_updates.append((reminder['id'], _failed_attempt(reminder, str(e))))
+        
+        # Send everything due in as few requests as possible
+        errors = publish_push_messages([message for _, message in outgoing])
+        sent_at_ts = datetime.utcnow().isoformat()
+        for (reminder, _), error in zip(outgoing, errors):
+            if error is None:
+                sent_updates.append((reminder['id'], {'status': 'sent', 'sent_at_ts': sent_at_ts}))
+            else:
+                failed_updates.append((reminder['id'], _failed_attempt(reminder, error)))
+                logger.warning(f"Failed to send reminder {reminder['id']}, "
+                               f"retry count: {reminder['retry_count'] + 1}")
         
-        logger.info("Completed processing push notifications")
+        # Delivered reminders are recorded first and on their own, so a
+        # failing write of the others can't get them pushed again next run
+        _update_grouped('reminders', sent_updates)
+        _update_grouped('reminders', failed_updates)
+        
+        logger.info(f"Completed processing push notifications: {len(sent_updates)} of {len(reminders)} sent")
         
     except Exception as e:
         logger.error(f"Error in process_push_notifications: {e}")
@@ -380,7 +575,21 @@ def main():
         logger.error(f"Reminder worker failed: {e}")
         raise
 
+def run_daemon(interval: float):
+    """Run the worker every interval seconds, keeping caches between runs."""
+    while True:
+        started = time.monotonic()
+        try:
+            main()
+        except Exception:
+            # Already logged; try again next run
+            pass
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
 if __name__ == '__main__':
-    main()
+    if WORKER_INTERVAL > 0:
+        run_daemon(WORKER_INTERVAL)
+    else:
+        main()
 
   #we couuld receive real time to supabase but essentially sub/pub shoudl trigger it to the database and we read it from there
\ No newline at end of file